@@ -0,0 +1,171 @@
+import asyncio
+
+import pandas as pd
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import SB_DB_Governor
+
+
+# -----------------------------------------------------------------
+# Async execution mode (--async)
+# -----------------------------------------------------------------
+# Runs the report queries as asyncio tasks on SQLAlchemy's async engine instead
+# of one blocking pd.read_sql after the other. Each query is a task with its own
+# timeout (cancelled on the server when it's hit), at most
+# DB_MAX_CONCURRENT_QUERIES run at once, and every result is handed to a
+# callback as soon as it's ready (so the Excel writer can start right away).
+#
+# The same coroutines can be awaited from an async web process:
+#     results = await run_report_queries(DB_CONFIG, {"packing": sql, ...})
+#
+# Needs an async driver next to the usual one (see requirements.txt):
+#   MySQL -> aiomysql, PostgreSQL -> asyncpg, SQL Server -> aioodbc, SQLite -> aiosqlite
+
+# the async driver to use for each DB_DRIVER from .env
+ASYNC_DRIVERS = {
+    'mysql': 'mysql+aiomysql',
+    'mysql+pymysql': 'mysql+aiomysql',
+    'mysql+mysqlconnector': 'mysql+aiomysql',
+    'mysql+aiomysql': 'mysql+aiomysql',
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'postgresql+asyncpg': 'postgresql+asyncpg',
+    'mssql+pyodbc': 'mssql+aioodbc',
+    'mssql+aioodbc': 'mssql+aioodbc',
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+aiosqlite': 'sqlite+aiosqlite',
+}
+
+
+def create_async_report_engine(db_config, settings):
+    """Creates the async engine (same .env settings and read replica routing as the governor)."""
+    driver = db_config['driver']
+    if driver not in ASYNC_DRIVERS:
+        raise ValueError(f"no async driver known for DB_DRIVER '{driver}' (known: {', '.join(ASYNC_DRIVERS)})")
+
+    async_config = dict(db_config, driver=ASYNC_DRIVERS[driver])
+    host, port = SB_DB_Governor.get_report_host_port(db_config, settings)
+    engine = create_async_engine(
+        SB_DB_Governor.build_connection_string(async_config, host, port),
+        pool_size=settings['max_concurrent_queries'] + 1,
+        max_overflow=0,
+        pool_pre_ping=True,
+    )
+
+    # same server side statement timeout as the sync engine
+    dialect = engine.dialect.name
+    timeout_ms = int(settings['statement_timeout_seconds'] * 1000)
+    if timeout_ms > 0:
+        @event.listens_for(engine.sync_engine, 'connect')
+        def set_statement_timeout(dbapi_connection, connection_record):
+            SB_DB_Governor.set_session_statement_timeout(dbapi_connection, dialect, timeout_ms)
+
+    SB_DB_Governor.log_connection_usage(engine)
+    return engine
+
+
+async def wait_for_server_load(engine, settings):
+    """Async version of the governor back-off: waits while the server is busier than DB_MAX_RUNNING_THREADS."""
+    load_query = SB_DB_Governor.SERVER_LOAD_QUERIES.get(engine.dialect.name)
+    if load_query is None or settings['max_running_threads'] <= 0:
+        return
+
+    waited_seconds = 0
+    delay_seconds = 5
+    while True:
+        try:
+            async with engine.connect() as connection:
+                row = (await connection.execute(text(load_query))).fetchone()
+            running_threads = int(row[1])
+        except Exception as e:
+            print(f"    > Could not read server load ({e}), continuing without the load check.")
+            return
+        if running_threads <= settings['max_running_threads']:
+            return
+        if waited_seconds >= settings['backoff_max_seconds']:
+            raise TimeoutError(
+                f"the database stayed busy ({running_threads} running statements) "
+                f"for {waited_seconds:.0f} seconds, query not started")
+        print(f"    > Database is busy ({running_threads} running statements), waiting {delay_seconds}s...")
+        await asyncio.sleep(delay_seconds)
+        waited_seconds += delay_seconds
+        delay_seconds = min(delay_seconds * 2, 60)
+
+
+async def cancel_on_server(engine, backend_id):
+    """Stops a timed out query on the server, through a separate connection."""
+    dialect = engine.dialect.name
+    if backend_id is None or dialect not in SB_DB_Governor.CANCEL_STATEMENTS:
+        return
+    try:
+        async with engine.connect() as cancel_connection:
+            await cancel_connection.execute(
+                text(SB_DB_Governor.CANCEL_STATEMENTS[dialect].format(backend_id=int(backend_id))))
+            await cancel_connection.commit()
+    except Exception as e:
+        print(f"    > Could not cancel the query on the server: {e}")
+
+
+async def read_sql_async(engine, sql_query, timeout_seconds):
+    """Runs one query and returns a DataFrame; raises TimeoutError (and cancels the query) after timeout_seconds."""
+    async with engine.connect() as connection:
+        backend_id = await connection.run_sync(SB_DB_Governor.get_backend_id, engine.dialect.name)
+        # pd.read_sql runs on the async connection through its sync facade (no thread per query)
+        read_query = connection.run_sync(lambda sync_connection: pd.read_sql(sql_query, con=sync_connection))
+        try:
+            return await asyncio.wait_for(read_query, timeout_seconds if timeout_seconds > 0 else None)
+        except asyncio.TimeoutError:
+            await cancel_on_server(engine, backend_id)
+            raise TimeoutError(f"query cancelled after {timeout_seconds:g} seconds (DB_STATEMENT_TIMEOUT_SECONDS)")
+
+
+async def run_one_query(engine, settings, query_slots, sheet_name, sql_query):
+    """One report query as a task; returns (sheet_name, DataFrame) - an 'Error' table if it failed."""
+    async with query_slots:
+        print(f"  > Running query: '{sheet_name}'...")
+        try:
+            await wait_for_server_load(engine, settings)
+            results_table_df = await read_sql_async(engine, sql_query, settings['statement_timeout_seconds'])
+            print(f"    > Success! '{sheet_name}' found {len(results_table_df)} records.")
+        except Exception as e:
+            print(f"    > !!! FAILED !!! Query '{sheet_name}' execution failed: {e}")
+            results_table_df = pd.DataFrame({'Error': [str(e)]})
+    return sheet_name, results_table_df
+
+
+async def run_report_queries(db_config, formatted_queries, on_result=None, settings=None):
+    """
+    Runs all queries ({sheet name: ready-to-run SQL}) concurrently.
+    on_result(sheet_name, df) is called for every query as soon as it finishes.
+    Returns {sheet name: DataFrame} in the original order.
+    """
+    settings = settings or SB_DB_Governor.get_governor_settings()
+    engine = create_async_report_engine(db_config, settings)
+    query_slots = asyncio.Semaphore(settings['max_concurrent_queries'])
+
+    results = {}
+    try:
+        tasks = [
+            asyncio.create_task(run_one_query(engine, settings, query_slots, sheet_name, sql_query))
+            for sheet_name, sql_query in formatted_queries.items()
+        ]
+        try:
+            for finished_task in asyncio.as_completed(tasks):
+                sheet_name, results_table_df = await finished_task
+                results[sheet_name] = results_table_df
+                if on_result is not None:
+                    on_result(sheet_name, results_table_df)
+        finally:
+            # if we were cancelled (or the callback failed), don't leave queries running
+            for task in tasks:
+                task.cancel()
+    finally:
+        await engine.dispose()
+
+    return {sheet_name: results[sheet_name] for sheet_name in formatted_queries if sheet_name in results}
+
+
+def run_report_queries_blocking(db_config, formatted_queries, on_result=None):
+    """Entry point for the command line scripts (starts and closes the event loop)."""
+    return asyncio.run(run_report_queries(db_config, formatted_queries, on_result=on_result))
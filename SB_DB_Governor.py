@@ -0,0 +1,305 @@
+import hashlib
+import os
+import re
+import threading
+import time
+
+import pandas as pd
+from sqlalchemy import create_engine, event, text
+
+
+# -----------------------------------------------------------------
+# DB load governor
+# -----------------------------------------------------------------
+# The reports run against the same database that serves live orders, so every
+# report query goes through this module instead of calling pd.read_sql on a bare
+# engine. It:
+#   1. routes the reports to a read replica when DB_REPLICA_HOST is set
+#   2. limits how many report queries run at the same time
+#   3. gives every query a statement timeout, and cancels it on the server when it's hit
+#   4. backs off (waits) while the server is busy, before starting a new query
+#
+# All settings are optional and read from .env (defaults in brackets):
+#   DB_REPLICA_HOST / DB_REPLICA_PORT       read replica to run the reports on [none - use DB_HOST]
+#   DB_MAX_CONCURRENT_QUERIES               report queries allowed at once [1]
+#   DB_STATEMENT_TIMEOUT_SECONDS            per query timeout, 0 = no timeout [900]
+#   DB_MAX_RUNNING_THREADS                  busy threshold (running statements), 0 = no check [32]
+#   DB_BACKOFF_MAX_SECONDS                  how long to wait for a busy server before giving up [600]
+#   SB_CONNECTION_LOG                       file to log every connection open/checkout/checkin/close to
+#                                           (set by SB_Stress_Test.py to measure connection usage) [none]
+
+
+# how to ask each DB how busy it is (the 2nd column is the number of running statements)
+SERVER_LOAD_QUERIES = {
+    'mysql': "SHOW GLOBAL STATUS LIKE 'Threads_running'",
+    'postgresql': "SELECT 'active', count(*) FROM pg_stat_activity WHERE state = 'active'",
+}
+
+# how to get the server side id of a connection, and how to stop the query running on it
+BACKEND_ID_QUERIES = {
+    'mysql': "SELECT CONNECTION_ID()",
+    'postgresql': "SELECT pg_backend_pid()",
+    'mssql': "SELECT @@SPID",
+}
+CANCEL_STATEMENTS = {
+    'mysql': "KILL QUERY {backend_id}",
+    'postgresql': "SELECT pg_cancel_backend({backend_id})",
+    'mssql': "KILL {backend_id}",
+}
+
+
+def get_governor_settings():
+    """Reads the governor settings from the environment (.env)."""
+    return {
+        'replica_host': os.getenv('DB_REPLICA_HOST') or None,
+        'replica_port': os.getenv('DB_REPLICA_PORT') or None,
+        'max_concurrent_queries': max(1, int(os.getenv('DB_MAX_CONCURRENT_QUERIES') or 1)),
+        'statement_timeout_seconds': float(os.getenv('DB_STATEMENT_TIMEOUT_SECONDS') or 900),
+        'max_running_threads': int(os.getenv('DB_MAX_RUNNING_THREADS') or 32),
+        'backoff_max_seconds': float(os.getenv('DB_BACKOFF_MAX_SECONDS') or 600),
+    }
+
+
+def get_missing_config(db_config):
+    """Returns the names of the missing connection details (a local SQLite file only needs driver + database)."""
+    if (db_config.get('driver') or '').startswith('sqlite'):
+        return [key for key in ('driver', 'database') if not db_config.get(key)]
+    return [key for key, value in db_config.items() if not value]
+
+
+def build_connection_string(db_config, host=None, port=None):
+    """
+    Builds the SQLAlchemy URL from DB_CONFIG.
+    host/port override the ones in DB_CONFIG (used for the read replica).
+    """
+    #a local SQLite file (e.g. a stand-in database for testing) has no user/host/port
+    if db_config['driver'].startswith('sqlite'):
+        return f"{db_config['driver']}:///{db_config['database']}"
+
+    return (
+        f"{db_config['driver']}://"
+        f"{db_config['username']}:{db_config['password']}"
+        f"@{host or db_config['host']}:{port or db_config['port']}"
+        f"/{db_config['database']}"
+    )
+
+
+def get_db_identity(db_config):
+    """
+    Which database the reports read, without the credentials (e.g. 'mysql+pymysql://db.host:3306/shop').
+    It's the primary's host/port even when the queries go to the read replica (same data).
+    """
+    if db_config['driver'].startswith('sqlite'):
+        return f"{db_config['driver']}:///{os.path.abspath(db_config['database'])}"
+    return f"{db_config['driver']}://{db_config['host']}:{db_config['port']}/{db_config['database']}"
+
+
+def get_db_folder_name(db_identity):
+    """
+    A folder name for what is kept locally from one database (the partials store, the sketches):
+    its name and a short hash of the whole identity, e.g. 'shop_3f2a9c1b07'.
+    """
+    database_name = re.sub(r'[^\w\-]', '_', re.split(r'[/\\]', db_identity)[-1])[:40]
+    return f"{database_name}_{hashlib.sha1(db_identity.encode()).hexdigest()[:10]}"
+
+
+def get_report_host_port(db_config, settings):
+    """Returns the host/port the reports should run on (the read replica when DB_REPLICA_HOST is set)."""
+    host, port = db_config.get('host'), db_config.get('port')
+    if settings['replica_host']:
+        host = settings['replica_host']
+        port = settings['replica_port'] or port
+        print(f"  > Routing report queries to read replica: {host}")
+    return host, port
+
+
+def create_governor(db_config, settings=None):
+    """
+    Creates the engine for the reports and wraps it with the governor settings.
+    Returns a dictionary with the engine and everything read_sql() needs.
+    """
+    settings = settings or get_governor_settings()
+    host, port = get_report_host_port(db_config, settings)
+
+    # the pool never opens more connections than the number of queries we allow at once
+    # (+1 for the load checks / query cancellation)
+    engine = create_engine(
+        build_connection_string(db_config, host, port),
+        pool_size=settings['max_concurrent_queries'] + 1,
+        max_overflow=0,
+        pool_pre_ping=True,
+    )
+    dialect = engine.dialect.name
+
+    # every new connection gets a server side statement timeout, as a second line of defence
+    # in case our own cancellation (below) can't reach the server
+    timeout_ms = int(settings['statement_timeout_seconds'] * 1000)
+    if timeout_ms > 0:
+        @event.listens_for(engine, 'connect')
+        def set_statement_timeout(dbapi_connection, connection_record):
+            set_session_statement_timeout(dbapi_connection, dialect, timeout_ms)
+
+    log_connection_usage(engine)
+
+    return {
+        'engine': engine,
+        'dialect': dialect,
+        'db_identity': get_db_identity(db_config),
+        'settings': settings,
+        # one "slot" per query that may run at the same time
+        'query_slots': threading.BoundedSemaphore(settings['max_concurrent_queries']),
+    }
+
+
+def log_connection_usage(engine):
+    """
+    When SB_CONNECTION_LOG is set, appends one line per pool event ("<time> <pid> open|checkout|checkin|close")
+    to that file, so a load test can count how many connections were open / in use at once.
+    """
+    log_filename = os.getenv('SB_CONNECTION_LOG')
+    if not log_filename:
+        return
+    log_lock = threading.Lock()
+
+    def log_event(event_name):
+        with log_lock, open(log_filename, 'a', encoding='utf-8') as log_file:
+            log_file.write(f"{time.time():.6f} {os.getpid()} {event_name}\n")
+
+    # the async engine's pool events are on its sync_engine
+    pool = getattr(engine, 'sync_engine', engine).pool
+    event.listen(pool, 'connect', lambda *args: log_event('open'))
+    event.listen(pool, 'checkout', lambda *args: log_event('checkout'))
+    event.listen(pool, 'checkin', lambda *args: log_event('checkin'))
+    event.listen(pool, 'close', lambda *args: log_event('close'))
+
+
+def set_session_statement_timeout(dbapi_connection, dialect, timeout_ms):
+    """Sets the per-session statement timeout (each DB has its own setting; unknown ones are skipped)."""
+    statements = {
+        # MySQL 5.7+ uses max_execution_time (ms), MariaDB uses max_statement_time (seconds)
+        'mysql': [f"SET SESSION max_execution_time = {timeout_ms}",
+                  f"SET SESSION max_statement_time = {timeout_ms / 1000}"],
+        'postgresql': [f"SET statement_timeout = {timeout_ms}"],
+    }
+    for statement in statements.get(dialect, []):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(statement)
+            break
+        except Exception:
+            # this server doesn't know this setting - try the next one
+            continue
+        finally:
+            cursor.close()
+
+
+def get_server_load(governor):
+    """Returns the number of statements currently running on the server, or None if we can't tell."""
+    load_query = SERVER_LOAD_QUERIES.get(governor['dialect'])
+    if load_query is None:
+        return None
+    try:
+        with governor['engine'].connect() as connection:
+            row = connection.execute(text(load_query)).fetchone()
+        return int(row[1])
+    except Exception as e:
+        print(f"    > Could not read server load ({e}), continuing without the load check.")
+        return None
+
+
+def wait_for_server_load(governor):
+    """
+    Waits (5s, 10s, 20s... up to a minute between checks) while the server is busier
+    than DB_MAX_RUNNING_THREADS. Gives up after DB_BACKOFF_MAX_SECONDS.
+    """
+    settings = governor['settings']
+    if settings['max_running_threads'] <= 0:
+        return
+
+    waited_seconds = 0
+    delay_seconds = 5
+    while True:
+        running_threads = get_server_load(governor)
+        if running_threads is None or running_threads <= settings['max_running_threads']:
+            return
+        if waited_seconds >= settings['backoff_max_seconds']:
+            raise TimeoutError(
+                f"the database stayed busy ({running_threads} running statements) "
+                f"for {waited_seconds:.0f} seconds, query not started")
+        print(f"    > Database is busy ({running_threads} running statements), waiting {delay_seconds}s...")
+        time.sleep(delay_seconds)
+        waited_seconds += delay_seconds
+        delay_seconds = min(delay_seconds * 2, 60)
+
+
+def get_backend_id(connection, dialect):
+    """Returns the server side id of a connection, used to cancel its running query."""
+    if dialect not in BACKEND_ID_QUERIES:
+        return None
+    return connection.execute(text(BACKEND_ID_QUERIES[dialect])).scalar()
+
+
+def cancel_running_query(governor, connection, backend_id):
+    """Stops a running query on the server (called from the timeout timer thread)."""
+    dialect = governor['dialect']
+    try:
+        if dialect == 'sqlite':
+            # sqlite3 connections can be interrupted from another thread
+            connection.connection.dbapi_connection.interrupt()
+            return
+
+        if dialect not in CANCEL_STATEMENTS or backend_id is None:
+            return
+        # the cancel has to go through a different connection than the busy one
+        with governor['engine'].connect() as cancel_connection:
+            cancel_connection.execute(text(CANCEL_STATEMENTS[dialect].format(backend_id=int(backend_id))))
+            cancel_connection.commit()
+    except Exception as e:
+        print(f"    > Could not cancel the query on the server: {e}")
+
+
+def read_sql(governor, sql_query, chunksize=None, handle_chunk=None):
+    """
+    Runs one report query through the governor and returns a DataFrame.
+    Waits while the server is busy, waits for a free query slot, and cancels the
+    query on the server if it runs longer than DB_STATEMENT_TIMEOUT_SECONDS.
+    With handle_chunk, the rows are read chunksize at a time and each chunk is passed to
+    handle_chunk while the query runs (nothing is returned) - see SB_Memory_Budget.py.
+    The chunked read uses a server side cursor (stream_results), otherwise the driver
+    would still fetch the whole result into memory before the first chunk.
+    """
+    settings = governor['settings']
+    wait_for_server_load(governor)
+
+    def run_query(connection):
+        if handle_chunk is None:
+            return pd.read_sql(sql_query, con=connection)
+        streaming_connection = connection.execution_options(stream_results=True)
+        for chunk in pd.read_sql(sql_query, con=streaming_connection, chunksize=chunksize):
+            handle_chunk(chunk)
+        return None
+
+    with governor['query_slots']:
+        with governor['engine'].connect() as connection:
+            timeout_seconds = settings['statement_timeout_seconds']
+            if timeout_seconds <= 0:
+                return run_query(connection)
+
+            backend_id = get_backend_id(connection, governor['dialect'])
+            timed_out = threading.Event()
+
+            def on_timeout():
+                timed_out.set()
+                cancel_running_query(governor, connection, backend_id)
+
+            timer = threading.Timer(timeout_seconds, on_timeout)
+            timer.daemon = True
+            timer.start()
+            try:
+                return run_query(connection)
+            except Exception:
+                if timed_out.is_set():
+                    raise TimeoutError(f"query cancelled after {timeout_seconds:g} seconds (DB_STATEMENT_TIMEOUT_SECONDS)")
+                raise
+            finally:
+                timer.cancel()
@@ -0,0 +1,117 @@
+import re
+
+import pandas as pd
+
+import SB_Shared_Facts
+
+
+# -----------------------------------------------------------------
+# Per-day partial aggregates
+# -----------------------------------------------------------------
+# The customer and product sheets are sums / counts / min / max over the orders of a
+# date window. Those can be computed per delivery day once ("partials") and any window
+# is then just the partials of its days, merged:
+#   count  -> sum of the daily counts
+#   sum    -> sum of the daily sums
+#   avg    -> sum of the daily sums / sum of the daily non-NULL counts
+#   min/max date -> min/max of the days
+# So reading a long span once serves every window inside it (see SB_Weekly_Backfill.py),
+# and the DB work is proportional to the span, not to the number of windows.
+# The sheets are computed from the partials by the same functions that compute them from the
+# shared facts (SB_Shared_Facts.derive_*), so every sheet has one implementation.
+
+# one row per (customer, store, name/phone as written on the order, delivery day, status), no other
+# filter, so the customer sheets apply their own (SB_Shared_Facts.filter_report_orders)
+CUSTOMER_DAY_PARTIALS_SQL = """
+select
+    o.customer_id,
+    o.store_id,
+    s.id as store_row_id,
+    s.name as store_name,
+    o.first_name,
+    o.last_name,
+    o.phone,
+    o.delivery_date,
+    o.status,
+    count(o.id) as order_count,
+    sum(o.sum) as sum_total,
+    count(o.sum) as sum_count
+from orders o
+         left join store s on s.id = o.store_id
+where o.delivery_date BETWEEN '{PARTIAL_START_DATE}' and '{PARTIAL_END_DATE}'
+group by o.customer_id, o.store_id, s.id, s.name, o.first_name, o.last_name, o.phone, o.delivery_date, o.status
+"""
+
+# one row per (product, delivery day, delivery window, status, store), no other filter,
+# so both the weekly products sheet and the daily sales report can be rolled up from it
+PRODUCT_DAY_PARTIALS_SQL = """
+select
+    p.id as product_id,
+    p.name as product_name,
+    p.name_heb as product_name_heb,
+    p.price as product_price,
+    p.low_cost_price as product_low_cost_price,
+    p.product_list,
+    p.category_id,
+    c1.id as category_row_id,
+    c1.name as category_name,
+    o.delivery_date,
+    o.delivery_window,
+    o.status,
+    o.store_id,
+    count(*) as line_count,
+    min(op.unit_price) as order_price,
+    sum(op.unit_price) as unit_price_sum,
+    count(op.unit_price) as unit_price_count,
+    sum(op.quantity_needed) as quantity_needed,
+    sum(op.quantity) as quantity,
+    sum(op.quantity_delivered) as quantity_delivered,
+    sum(op.quantity_replaceable) as quantity_replaceable,
+    sum(op.quantity_needed * op.unit_price) as needed_value,
+    sum(op.quantity * op.unit_price) as billed_value,
+    sum(op.quantity_delivered * op.unit_price) as delivered_value,
+    sum(op.quantity_replaceable * op.unit_price) as replaceable_value
+from order_product op
+         join orders o on o.id = op.order_id
+         join products p on p.id = op.product_id
+         left join categories c1 on c1.id = p.category_id
+where o.delivery_date BETWEEN '{PARTIAL_START_DATE}' and '{PARTIAL_END_DATE}'
+group by p.id, p.name, p.name_heb, p.price, p.low_cost_price, p.product_list, p.category_id, c1.id, c1.name,
+         o.delivery_date, o.delivery_window, o.status, o.store_id
+"""
+
+PARTIAL_QUERIES = {
+    'customer_days': CUSTOMER_DAY_PARTIALS_SQL,
+    'product_days': PRODUCT_DAY_PARTIALS_SQL,
+}
+
+# the column the row level queries get, so their rows can be split into windows afterwards
+ROW_DAY_COLUMN = 'partial_delivery_day'
+
+
+def format_partial_query(partial_name, start_date, end_date):
+    """The partial's SQL for one span of days."""
+    return PARTIAL_QUERIES[partial_name].format_map(
+        {'PARTIAL_START_DATE': start_date, 'PARTIAL_END_DATE': end_date})
+
+
+def add_row_day_column(sql_query):
+    """
+    Adds "o.delivery_date as partial_delivery_day" to a row level report query (one row per
+    order / order line, single SELECT on orders o), so one run over a long span can be split by day.
+    """
+    if len(re.findall(r'\bselect\b', sql_query, flags=re.IGNORECASE)) != 1:
+        raise ValueError("only a query with a single SELECT can be split by day")
+    return re.sub(r'\bselect\b', f"select o.delivery_date as {ROW_DAY_COLUMN},", sql_query,
+                  count=1, flags=re.IGNORECASE)
+
+
+def rows_in_window(rows_df, start_date, end_date):
+    """The rows of one window from a row level result read over a longer span (without the day column)."""
+    days = pd.to_datetime(rows_df[ROW_DAY_COLUMN]).dt.strftime('%Y-%m-%d')
+    return rows_df[(days >= start_date) & (days <= end_date)].drop(columns=[ROW_DAY_COLUMN]).reset_index(drop=True)
+
+
+def prepare_partials(partial_df):
+    """Adds the 'delivery_day' text column the windows are compared on (same as the shared facts)."""
+    return SB_Shared_Facts.prepare_facts(partial_df)
@@ -1,12 +1,28 @@
+import SB_Profiler
+# with --profile the imports and .env loading below are measured too (see SB_Profiler.py)
+if SB_Profiler.enable_if_requested():
+    SB_Profiler.begin_stage('imports')
+
 import pandas as pd
-from sqlalchemy import create_engine
 from datetime import datetime, timedelta
 import os
 import sys
+import argparse
 from dotenv import load_dotenv 
 
+import SB_DB_Governor
+import SB_Daily_Partials
+import SB_Excel_Writer
+import SB_Preview
+import SB_Product_Day_Store
+import SB_Report_Spec
+import SB_Run_Store
+import SB_Shared_Facts
+import SB_Warmup
+
 
 # Load variables from .env file into environment
+SB_Profiler.begin_stage('config: load_dotenv')
 load_dotenv()
 
 # -----------------------------------------------------------------
@@ -24,32 +40,9 @@ DB_CONFIG = {
 # -----------------------------------------------------------------
 # STAGE 2: Query Warehouse
 # -----------------------------------------------------------------
-ALL_QUERIES = {
-    "daily_sales_report": """
-Select
-    p.id as `מזהה מוצר`,
-    p.name as `שם מוצר`,
-    p.name_heb as `תיאור מוצר`,
-    SUM(op.quantity_needed) AS  `הכמות הנדרשת`,
-    SUM(op.quantity) AS Total_Supplied,
-    p.price AS `מחיר ליחידה`,
-    SUM(p.price * op.quantity) AS `עלות כוללת`,
-    p.product_list AS `רשימת מוצרים`
-
-from products p
-    Join order_product op on op.product_id = p.id
-    Join orders o on o.id = op.order_id
-Where 
-    
-    (o.delivery_date = '{DELIVERY_DATE}' AND o.delivery_window = 1) 
-    OR 
-    (o.delivery_date = '{DAY_TOMORROW}' AND o.delivery_window = 0)
-    
-    And o.status IN (0,3,7)
-GROUP BY
-    p.id, p.name, p.name_heb, p.price, p.product_list;
-"""
-}
+# the query is in SB_Daily_Sales_Report_spec.toml (see SB_Report_Spec.py)
+REPORT_SPEC = SB_Report_Spec.load_spec(SB_Report_Spec.get_spec_filename('SB_Daily_Sales_Report'))
+ALL_QUERIES = SB_Report_Spec.get_queries(REPORT_SPEC)
 
 
 # -----------------------------------------------------------------
@@ -68,6 +61,13 @@ def get_date_range_list():
         print("No input provided. Exiting.")
         sys.exit()
 
+    return parse_date_range_list(user_input)
+
+def parse_date_range_list(user_input):
+    """
+    Turns a date or range in the same formats (e.g. '111125-131125') into a list of
+    'YYYY-MM-DD' strings. Also used by SB_Report_Runner.py for its --daily option.
+    """
     # Split the input by '-' to check if it's a range ; each date will be a part
     # User-Defined Name: 'parts' (holds the start and end parts)
     parts = user_input.split('-')
@@ -104,93 +104,211 @@ def get_date_range_list():
         
     return date_list
 
+def get_date_vars(current_date_str):
+    """Returns the query variables for one date (the date itself and the day after it)."""
+    # Logic: Calculate Tomorrow
+    curr_obj = datetime.strptime(current_date_str, '%Y-%m-%d')
+    next_obj = curr_obj + timedelta(days=1)
+    next_day_str = next_obj.strftime('%Y-%m-%d')
+
+    return {
+        'DELIVERY_DATE': current_date_str,
+        'DAY_TOMORROW': next_day_str
+    }
+
+def write_date_sheet(workbook, sheet_title, df, tab_color=None):
+    """Writes one date's results as its own right-to-left tab (a 'No Data' tab if the day was empty)."""
+    # Check if empty
+    if df.empty:
+        print(f"   > {sheet_title}: No data found for this date.")
+        # Create a dummy DF so we still have a tab
+        df = pd.DataFrame({'Status': ['No Data']})
+    else:
+        print(f"   > {sheet_title}: Found {len(df)} records.")
+
+    # right_to_left=True turns on the RIGHT-TO-LEFT (RTL) sheet view for the Hebrew columns
+    with SB_Profiler.profile_stage(f"write: {sheet_title}"):
+        SB_Excel_Writer.write_sheet(workbook, sheet_title, df, right_to_left=True, tab_color=tab_color)
+
+def parse_args():
+    """Reads the optional command line flags (the dates are still asked for interactively)."""
+    parser = argparse.ArgumentParser(description="Shookbook daily sales report")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="run all dates as concurrent asyncio tasks (needs an async DB driver, e.g. aiomysql)")
+    parser.add_argument('--profile', action='store_true',
+                        help="measure time/CPU/memory of every stage and save a <report>_profile.txt/.prof next to the report")
+    parser.add_argument('--queue', action='store_true',
+                        help="send the request to the report queue (SB_Report_Queue.py serve) instead of running it here")
+    parser.add_argument('--preview', nargs='?', type=int, const=0, metavar='N',
+                        help="quick preview on 1 in N of the dates (3 dates spread over them when not given), "
+                             "with extrapolated totals - see SB_Preview.py")
+    parser.add_argument('--excel-workers', type=int, metavar='N',
+                        help="serialize the sheets in N worker processes and build the .xlsx at the end "
+                             "(see SB_Parallel_Excel_Writer.py) [SB_EXCEL_WORKERS, 0 = in this process]")
+    args = parser.parse_args()
+
+    # the queue runs the full report with its own settings: a flag it wouldn't apply is an error, never silently dropped
+    if args.queue:
+        local_flags = [flag for flag, is_set in [
+            ('--async', args.use_async), ('--profile', args.profile), ('--preview', args.preview is not None),
+            ('--excel-workers', args.excel_workers is not None),
+        ] if is_set]
+        if local_flags:
+            parser.error(f"--queue asks the report queue for the full report, it can't be combined with {', '.join(local_flags)}")
+    return args
+
 def main():
     print("--- Starting automated report script ---")
+    SB_Profiler.end_stage()
+    args = parse_args()
+
+    # the engine and the first connections are prepared on a background thread while the
+    # dates are typed (see SB_Warmup.py); --queue doesn't connect here, --async has its own engine
+    warmup = None
+    if not args.queue and not args.use_async:
+        warmup = SB_Warmup.start_warmup(DB_CONFIG)
 
     # 1. Get list of dates
     # User-Defined Name: dates_to_process (List of strings)
-    dates_to_process = get_date_range_list()
+    with SB_Profiler.profile_stage('user input'):
+        dates_to_process = get_date_range_list()
     
     # Create a dynamic filename based on start and end dates
     # User-Defined Name: start_str, end_str
     start_str = dates_to_process[0]
     end_str = dates_to_process[-1]
     output_filename = f"Sales_Report_Range_{start_str}_to_{end_str}.xlsx"
+
+    # with --preview only a sample of the dates is run, each of them complete (see SB_Preview.py)
+    tab_color = None
+    if args.preview is not None:
+        all_dates = dates_to_process
+        dates_to_process = SB_Preview.get_sample_days(all_dates, args.preview)
+        tab_color = SB_Preview.PREVIEW_TAB_COLOR
+        output_filename = SB_Preview.get_preview_filename(output_filename)
+        print(f"PREVIEW: {len(dates_to_process)} of {len(all_dates)} dates ({', '.join(dates_to_process)}).")
+
+    # with --queue the report is produced by the report queue (SB_Report_Queue.py), which runs
+    # identical requests only once, and the file is sent back here
+    # (parse_args already refused the flags the queue doesn't apply)
+    if args.queue:
+        import SB_Report_Queue
+        SB_Report_Queue.print_reply(SB_Report_Queue.submit_request({'report': 'daily', 'dates': dates_to_process}))
+        return
     
     # 2. Database Connection (Same as before)
-    missing_config = [key for key, value in DB_CONFIG.items() if not value]
+    missing_config = SB_DB_Governor.get_missing_config(DB_CONFIG)
     if missing_config:
         print(f"Missing connection info: {', '.join(missing_config)}")
         return
 
-    connection_string = (
-        f"{DB_CONFIG['driver']}://"
-        f"{DB_CONFIG['username']}:{DB_CONFIG['password']}"
-        f"@{DB_CONFIG['host']}:{DB_CONFIG['port']}"
-        f"/{DB_CONFIG['database']}"
-    )
-    
-    try:
-        engine = create_engine(connection_string)
-        print("Database connection successful!")
-    except Exception as e:
-        print(f"Database connection error: {e}")
-        return
+    # The governor creates the engine (optionally on the read replica) and protects the DB:
+    # max concurrent queries, statement timeouts, back-off when the server is busy
+    # (with --async the async engine is created by SB_Async_Runner when the queries start)
+    if not args.use_async:
+        try:
+            with SB_Profiler.profile_stage('connect'):
+                governor = SB_Warmup.get_governor(warmup, DB_CONFIG)
+            print("Database connection successful!")
+        except Exception as e:
+            print(f"Database connection error: {e}")
+            return
 
     print(f"\nPreparing to export {len(dates_to_process)} days to: {output_filename}")
 
-    # 3. Open the Excel Writer ONCE (Context Manager)
-    # We keep the file open while we loop through the dates
+    # 3. Open the workbook ONCE
+    # We keep it open while we loop through the dates (rows are streamed to disk as we go)
+    workbook_saved = False
+    date_results = {}
     try:
-        with pd.ExcelWriter(output_filename, engine='openpyxl') as writer:
-            
+        workbook = SB_Excel_Writer.open_workbook(args.excel_workers)
+
+        if args.use_async:
+            # All dates run at the same time as asyncio tasks, each sheet is written when its query finishes
+            # (imported here so the async drivers are only needed when --async is used)
+            import SB_Async_Runner
+
+            report_queries = ALL_QUERIES
+
+            formatted_queries = {}
+            for current_date_str in dates_to_process:
+                try:
+                    DATE_VARS = get_date_vars(current_date_str)
+                except ValueError as e:
+                    print(f"Date error: {e}")
+                    continue
+                # We assume only one query type exists in ALL_QUERIES for now
+                for query_name, sql_template in report_queries.items():
+                    formatted_queries[current_date_str] = sql_template.format_map(DATE_VARS)
+
+            def write_finished_date(sheet_title, df):
+                # a failed query already printed its error - like the normal mode, it gets no tab
+                if list(df.columns) != ['Error']:
+                    date_results[sheet_title] = df
+                    write_date_sheet(workbook, sheet_title, df, tab_color)
+
+            SB_Async_Runner.run_report_queries_blocking(DB_CONFIG, formatted_queries, on_result=write_finished_date)
+
+            # tabs stay in date order, whichever query finished first
+            SB_Excel_Writer.order_sheets(workbook, [date for date in formatted_queries if date in SB_Excel_Writer.get_sheet_names(workbook)])
+        
+        else:
+            # The product x day partials of every day the dates need (each date D uses D and D+1) are
+            # read ONCE and kept in the partials store (SB_Product_Day_Store.py), which the weekly and
+            # monthly product sheets are rolled up from. Days already stored (and final) aren't read again.
+            # (a preview reads the partials of its sampled dates straight from the DB and doesn't store them)
+            try:
+                with SB_Profiler.profile_stage('fetch: product partials'):
+                    if args.preview is not None:
+                        sample_days = sorted({day for current_date_str in dates_to_process
+                                              for day in (current_date_str, get_date_vars(current_date_str)['DAY_TOMORROW'])})
+                        product_days = SB_Daily_Partials.prepare_partials(SB_DB_Governor.read_sql(
+                            governor, SB_Preview.make_preview_query(
+                                SB_Daily_Partials.format_partial_query('product_days', start_str, get_date_vars(end_str)['DAY_TOMORROW']),
+                                sample_days, governor['dialect'], row_limit=None)))
+                    else:
+                        product_days = SB_Product_Day_Store.load_product_days(
+                            governor, start_str, get_date_vars(end_str)['DAY_TOMORROW'])
+            except Exception as e:
+                print(f"   > Query failed: {e}")
+                product_days = None
+
             # --- MAIN LOOP: Iterate over each date ---
             for current_date_str in dates_to_process:
                 print(f"\n--- Processing Date: {current_date_str} ---")
-                
+                if product_days is None:
+                    continue
+            
                 # A. Logic: Calculate Tomorrow
+                # B. Update Variables for Query
                 try:
-                    curr_obj = datetime.strptime(current_date_str, '%Y-%m-%d')
-                    next_obj = curr_obj + timedelta(days=1)
-                    next_day_str = next_obj.strftime('%Y-%m-%d')
+                    DATE_VARS = get_date_vars(current_date_str)
                 except ValueError as e:
                     print(f"Date error: {e}")
                     continue
 
-                # B. Update Variables for Query
-                DATE_VARS = {
-                    'DELIVERY_DATE': current_date_str,
-                    'DAY_TOMORROW': next_day_str
-                }
+                # C. Same rows as the daily_sales_report query, summed from the partials
+                try:
+                    df = SB_Shared_Facts.derive_daily_sales_report(product_days, DATE_VARS)
 
-                # C. Run Query
-                # We assume only one query type exists in ALL_QUERIES for now
-                for query_name, sql_template in ALL_QUERIES.items():
-                    formatted_query = sql_template.format_map(DATE_VARS)
-                    
-                    try:
-                        df = pd.read_sql(formatted_query, con=engine)
-                        
-                        # Check if empty
-                        if df.empty:
-                            print("   > No data found for this date.")
-                            # Create a dummy DF so we still have a tab
-                            df = pd.DataFrame({'Status': ['No Data']})
-                        else:
-                            print(f"   > Found {len(df)} records.")
-
-                        # D. Write to Excel Sheet
-                        # We name the sheet after the DATE (e.g., "2025-11-11")
-                        sheet_title = current_date_str 
-                        df.to_excel(writer, sheet_name=sheet_title, index=False)
-                        
-                        # --- NEW: RIGHT-TO-LEFT (RTL) CONFIGURATION ---
-                        # Library/Framework Code: Accessing the worksheet object from openpyxl
-                        worksheet = writer.sheets[sheet_title]
-                        worksheet.sheet_view.rightToLeft = True
-
-                    except Exception as e:
-                        print(f"   > Query failed: {e}")
+                    # D. Write to Excel Sheet
+                    # We name the sheet after the DATE (e.g., "2025-11-11")
+                    date_results[current_date_str] = df
+                    write_date_sheet(workbook, current_date_str, df, tab_color)
+
+                except Exception as e:
+                    print(f"   > Query failed: {e}")
+
+        # with --preview the "PREVIEW" sheet (sampled dates + extrapolated totals) goes first
+        if args.preview is not None:
+            SB_Excel_Writer.write_sheet(workbook, SB_Preview.PREVIEW_SHEET_NAME,
+                                        SB_Preview.make_preview_sheet(date_results, dates_to_process, len(all_dates), row_limit=None),
+                                        tab_color=tab_color)
+            SB_Excel_Writer.order_sheets(workbook, [SB_Preview.PREVIEW_SHEET_NAME])
+
+        with SB_Profiler.profile_stage('save workbook'):
+            SB_Excel_Writer.save_workbook(workbook, output_filename)
+        workbook_saved = True
 
         print("\n--- Script completed successfully! ---")
         print(f"File saved: {output_filename}")
@@ -198,6 +316,15 @@ def main():
     except Exception as e:
         print(f"CRITICAL FILE ERROR: {e}")
 
+    # the dates' results are also kept as Arrow files for re-export (SB_Run_Store.py)
+    # (only when the workbook was saved - a kept run is trusted to have its workbook)
+    if args.preview is None and workbook_saved:
+        SB_Run_Store.keep_run(output_filename, date_results, 'daily')
+
+    # With --profile: the per-stage summary and the cProfile dump
+    if args.profile:
+        SB_Profiler.write_profile_report(os.path.splitext(output_filename)[0])
+
 
 # Running the main function
 if __name__ == "__main__":
@@ -0,0 +1,193 @@
+import pandas as pd
+
+import SB_Memory_Budget
+
+
+# -----------------------------------------------------------------
+# Derived sheets
+# -----------------------------------------------------------------
+# Extra sheets computed in pandas from a query result that is already in the
+# report (no extra DB query). Each derived sheet is written right after the sheet
+# it is computed from. To add one: write a function that takes the source sheet's
+# DataFrame and returns the new one, and register it in DERIVED_SHEETS below.
+
+# the separators we've seen in the coupons / discount_promotions text columns
+# ("A,B", "A, B", "A;B", "A|B", and JSON style lists like '["A","B"]')
+CODE_SEPARATORS = r'\s*[,;|]\s*'
+CODE_DECORATIONS = r'[\[\]{}"\']'
+
+
+def explode_codes(orders_df, codes_column):
+    """
+    One row per (order, code) from a text column holding several codes per order.
+    Vectorized (str.split + explode), so it stays fast on hundreds of thousands of orders.
+    """
+    codes = (
+        orders_df[codes_column]
+        .astype('string')
+        .str.replace(CODE_DECORATIONS, '', regex=True)
+        .str.split(CODE_SEPARATORS, regex=True)
+    )
+    order_codes = orders_df[['id', 'customer_id', 'sum', 'discount_sum']].assign(code=codes).explode('code')
+    # the codes are kept as stored ('Summer' and 'SUMMER' stay two codes), only the spaces around them go
+    order_codes['code'] = order_codes['code'].str.strip()
+    order_codes = order_codes[order_codes['code'].notna() & (order_codes['code'] != '')]
+    # the same code twice on one order counts once
+    return order_codes.drop_duplicates(['id', 'code'])
+
+
+def summarize_codes(order_codes, code_type, total_orders):
+    """Orders, customers, discount and revenue per code."""
+    summary_df = order_codes.groupby('code', sort=False).agg(
+        orders=('id', 'nunique'),
+        customers=('customer_id', 'nunique'),
+        discount_total=('discount_sum', 'sum'),
+        revenue=('sum', 'sum'),
+    ).reset_index()
+    summary_df.insert(0, 'type', code_type)
+    summary_df['avg order'] = summary_df['revenue'] / summary_df['orders']
+    summary_df['% of orders'] = (summary_df['orders'] / total_orders * 100).round(2) if total_orders else 0
+    return summary_df.sort_values(['orders', 'code'], ascending=[False, True], kind='stable')
+
+
+def derive_coupon_breakdown(coupons_df):
+    """
+    "coupons breakdown": one row per coupon code and per promotion, from "weekly with coupons".
+    An order with two codes counts in both rows (its discount and sum included in each).
+    """
+    total_orders = coupons_df['id'].nunique()
+    breakdown_df = pd.concat([
+        summarize_codes(explode_codes(coupons_df, 'coupons'), 'coupon', total_orders),
+        summarize_codes(explode_codes(coupons_df, 'discount_promotions'), 'promotion', total_orders),
+    ], ignore_index=True)
+    return breakdown_df.rename(columns={'discount_total': 'discount total'})[[
+        'type', 'code', 'orders', 'customers', 'discount total', 'revenue', 'avg order', '% of orders',
+    ]]
+
+
+def derive_packing_by_employee(packing_df):
+    """
+    "packing by employee": packing productivity per worker, from the "packing" sheet.
+    "packing" already sums the order lines per order in the DB (line -> order), so here
+    the orders are summed per worker (order -> worker) - no second scan of order_product,
+    and every order's sum is counted once (the old SUM(DISTINCT o.sum) dropped orders with equal sums).
+    The delivery date is the packing day (orders are packed for their delivery).
+    """
+    orders_df = packing_df.assign(
+        delivery_day=pd.to_datetime(packing_df['delivery_date']).dt.strftime('%Y-%m-%d'))
+    worker_df = orders_df.groupby(['packing_worker_id', 'first_name', 'last_name'], dropna=False, sort=False).agg(
+        orders=('id', 'nunique'),
+        units=('total_order_quantity', 'sum'),
+        type_1_units=('type_1_quantity', 'sum'),
+        order_value=('order sum', 'sum'),
+        working_days=('delivery_day', 'nunique'),
+    ).reset_index()
+
+    working_days = worker_df['working_days'].where(worker_df['working_days'] > 0)
+    worker_df['orders per day'] = (worker_df['orders'] / working_days).round(2)
+    worker_df['units per day'] = (worker_df['units'] / working_days).round(2)
+    worker_df['units per order'] = (worker_df['units'] / worker_df['orders']).round(2)
+    worker_df = worker_df.sort_values(['orders', 'units'], ascending=False, kind='stable')
+
+    return worker_df.rename(columns={
+        'type_1_units': 'type 1 units',
+        'order_value': 'order value',
+        'working_days': 'working days',
+    })[[
+        'packing_worker_id', 'first_name', 'last_name', 'orders', 'units', 'type 1 units', 'order value',
+        'working days', 'orders per day', 'units per day', 'units per order',
+    ]].reset_index(drop=True)
+
+
+# -----------------------------------------------------------------
+# Zones cube
+# -----------------------------------------------------------------
+# "zones cube" returns orders per (store, zone, delivery day), the finest grain any zone
+# sheet needs. Every zone sheet is a local rollup of it, so a new breakdown
+# (e.g. zone x day) costs no extra query. The cube is small (stores x zones x days),
+# so the rollup takes milliseconds.
+
+def rollup_zones_cube(cube_df, group_columns, excluded_stores=()):
+    """Sums the cube's orders / order sums up to group_columns (like SQL GROUP BY on the original rows)."""
+    cube_df = cube_df[~cube_df['store_id'].isin(list(excluded_stores))]
+    return cube_df.groupby(group_columns, dropna=False, sort=True).agg(
+        orders=('orders', 'sum'),
+        order_sum=('order_sum', lambda values: values.sum(min_count=1)),
+    ).reset_index()
+
+
+def derive_zones_by_store(cube_df):
+    """Same as the old "weekly by zones" query: per store and zone."""
+    zones_df = rollup_zones_cube(cube_df, ['store_id', 'name', 'description'])
+    return zones_df.rename(columns={'orders': 'count(o.id)', 'order_sum': 'sum(o.sum)'})
+
+
+def derive_zones_by_description(cube_df):
+    """
+    Same as the old "weekly_zones_by_desc" query: per zone, the {zones_by_desc_excluded_stores} of the
+    weekly spec (store 84) left out, most orders first.
+    (its store_id / name columns were not grouped in the SQL, so they show one of the zone's stores)
+    """
+    # imported here: SB_Report_Spec imports this module
+    import SB_Report_Spec
+    excluded_stores = SB_Report_Spec.get_filter_values('SB_Weekly_Report', 'zones_by_desc_excluded_stores')
+    zones_df = rollup_zones_cube(cube_df, ['description'], excluded_stores=excluded_stores)
+    zone_stores = cube_df[~cube_df['store_id'].isin(excluded_stores)].groupby(
+        'description', sort=False)[['store_id', 'name']].first()
+    zones_df = zones_df.join(zone_stores, on='description')
+    zones_df = zones_df.sort_values('orders', ascending=False, kind='stable').reset_index(drop=True)
+    return zones_df.rename(columns={'orders': 'count(o.id)', 'order_sum': 'sum(o.sum)'})[[
+        'store_id', 'name', 'count(o.id)', 'description', 'sum(o.sum)',
+    ]]
+
+
+def derive_zones_by_day(cube_df):
+    """"zones by day": orders and order sum per zone per delivery day."""
+    cube_df = cube_df.assign(
+        delivery_day=pd.to_datetime(cube_df['delivery_date']).dt.strftime('%Y-%m-%d'))
+    zones_df = rollup_zones_cube(cube_df, ['description', 'delivery_day'])
+    return zones_df.rename(columns={'delivery_day': 'delivery day', 'order_sum': 'order sum'})
+
+
+# derived sheet name -> (the sheet it is computed from, the function that computes it)
+DERIVED_SHEETS = {
+    'packing by employee': ('packing', derive_packing_by_employee),
+    'coupons breakdown': ('weekly with coupons', derive_coupon_breakdown),
+    'weekly by zones': ('zones cube', derive_zones_by_store),
+    'weekly_zones_by_desc': ('zones cube', derive_zones_by_description),
+    'zones by day': ('zones cube', derive_zones_by_day),
+}
+
+# query results that are only there to compute derived sheets - not written to the report themselves
+SOURCE_ONLY_SHEETS = {'zones cube'}
+
+
+def derive_sheets_for(source_sheet_name, source_df):
+    """Computes the derived sheets of one source sheet; returns {derived sheet name: DataFrame}."""
+    derived = {}
+    for derived_sheet_name, (wanted_source, derive_sheet) in DERIVED_SHEETS.items():
+        if wanted_source != source_sheet_name:
+            continue
+        # the source query failed - its 'Error' table is already in the report
+        if SB_Memory_Budget.result_columns(source_df) == ['Error']:
+            continue
+        # a source that was spilled to disk (memory budget) is read back to compute from
+        source_df = SB_Memory_Budget.load_result(source_df)
+        try:
+            derived[derived_sheet_name] = derive_sheet(source_df)
+            print(f"    > Derived '{derived_sheet_name}' ({len(derived[derived_sheet_name])} rows).")
+        except Exception as e:
+            print(f"    > !!! FAILED !!! Derived sheet '{derived_sheet_name}' could not be computed: {e}")
+            derived[derived_sheet_name] = pd.DataFrame({'Error': [str(e)]})
+    return derived
+
+
+def add_derived_sheets(queries_results_to_export):
+    """Returns the results with every derived sheet placed right after the sheet it comes from."""
+    with_derived = {}
+    for sheet_name, results_table_df in queries_results_to_export.items():
+        # a failed source-only query still shows its 'Error' table
+        if sheet_name not in SOURCE_ONLY_SHEETS or SB_Memory_Budget.result_columns(results_table_df) == ['Error']:
+            with_derived[sheet_name] = results_table_df
+        with_derived.update(derive_sheets_for(sheet_name, results_table_df))
+    return with_derived
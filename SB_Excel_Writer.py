@@ -0,0 +1,380 @@
+import os
+import re
+
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+
+import SB_Sheet_Format
+
+
+# -----------------------------------------------------------------
+# Streaming Excel writer
+# -----------------------------------------------------------------
+# pandas' to_excel builds the whole sheet in memory and fails outright when a
+# result has more rows than Excel allows. This writer uses openpyxl's
+# write-only mode (rows go straight to a temp file) and writes in chunks.
+# When a sheet is full it rolls over into a continuation sheet:
+#   "packing", "packing (2)", "packing (3)" ...
+# Optionally, a sheet that had to be split also gets a companion Parquet file
+# with the full, unsplit result.
+#
+# With SB_EXCEL_WORKERS=N in .env (or --excel-workers N) the sheets are serialized
+# in N worker processes instead and the .xlsx is put together at the end
+# (see SB_Parallel_Excel_Writer.py); the functions below work the same on both.
+#
+# Every sheet also gets its column widths, a frozen header, an autofilter and number
+# formats while it's streamed (worked out once per result, see SB_Sheet_Format.py).
+# openpyxl can only set a number format cell by cell (a column style doesn't apply to the
+# cells written in it), which adds about a quarter to the write time. So here, a result of
+# more than SB_NUMBER_FORMAT_MAX_ROWS rows (a streamed one: when its size isn't given) is
+# written without number formats - widths, frozen header and filter are kept. SB_EXCEL_WORKERS writes every sheet
+# with its number formats, at almost no cost.
+
+# Excel's hard limits: 1,048,576 rows per sheet (the header takes one) and 31 characters per sheet name
+EXCEL_MAX_ROWS = 1048576
+EXCEL_MAX_SHEET_NAME_LENGTH = 31
+
+# how many rows we convert and write at a time (keeps memory flat on big sheets)
+WRITE_CHUNK_ROWS = 50000
+
+# results up to this many rows get their number formats on the openpyxl path (see above)
+NUMBER_FORMAT_MAX_ROWS = 50000
+
+
+def get_excel_workers():
+    """SB_EXCEL_WORKERS from .env (0 = write the sheets here, with openpyxl)."""
+    return int(os.getenv('SB_EXCEL_WORKERS', '0') or 0)
+
+
+def get_number_format_max_rows():
+    """SB_NUMBER_FORMAT_MAX_ROWS from .env (the openpyxl path's limit for number formats)."""
+    return int(os.getenv('SB_NUMBER_FORMAT_MAX_ROWS') or NUMBER_FORMAT_MAX_ROWS)
+
+
+def is_parallel(workbook):
+    # a parallel workbook is a plain dict (SB_Parallel_Excel_Writer.open_workbook)
+    return isinstance(workbook, dict)
+
+
+def open_workbook(workers=None):
+    """
+    Creates an empty write-only workbook (rows are streamed to disk, not kept in memory).
+    With workers > 0 (default: SB_EXCEL_WORKERS) the sheets are serialized in worker processes.
+    """
+    workers = get_excel_workers() if workers is None else workers
+    if workers > 0:
+        # imported here so the worker pool is only set up when it's used
+        import SB_Parallel_Excel_Writer
+        return SB_Parallel_Excel_Writer.open_workbook(workers)
+    return Workbook(write_only=True)
+
+
+def get_sheet_names(workbook):
+    """The workbook's sheet names, in order."""
+    if is_parallel(workbook):
+        return [sheet_entry['title'] for sheet_entry in workbook['sheets']]
+    return workbook.sheetnames
+
+
+def save_workbook(workbook, output_filename):
+    """Saves the workbook; an .xlsx with no sheets is invalid, so an empty one gets a placeholder sheet."""
+    if is_parallel(workbook):
+        import SB_Parallel_Excel_Writer
+        return SB_Parallel_Excel_Writer.save_workbook(workbook, output_filename)
+    if not workbook.worksheets:
+        workbook.create_sheet('No Data').append(['Status'])
+    workbook.save(output_filename)
+
+
+def order_sheets(workbook, sheet_titles):
+    """
+    Puts the sheets in the given order (sheets not in the list keep their place at the end).
+    Used when sheets were written in the order their queries finished.
+    """
+    if is_parallel(workbook):
+        import SB_Parallel_Excel_Writer
+        return SB_Parallel_Excel_Writer.order_sheets(workbook, sheet_titles)
+    for target_position, sheet_title in enumerate(sheet_titles):
+        current_position = workbook.index(workbook[sheet_title])
+        workbook.move_sheet(sheet_title, target_position - current_position)
+
+
+def make_sheet_name(workbook, sheet_name, part_number=1):
+    """
+    Returns a sheet name that fits Excel's 31 characters and is not already taken.
+    Part 1 keeps the original name, parts 2+ get a " (N)" suffix, e.g. "packing (2)".
+    """
+    suffix = '' if part_number == 1 else f" ({part_number})"
+    candidate = sheet_name[:EXCEL_MAX_SHEET_NAME_LENGTH - len(suffix)] + suffix
+
+    # two long names can be cut to the same 31 characters - keep adding a counter until it's unique
+    taken_names = {name.lower() for name in get_sheet_names(workbook)}
+    counter = 1
+    while candidate.lower() in taken_names:
+        counter += 1
+        extra = f"~{counter}"
+        candidate = sheet_name[:EXCEL_MAX_SHEET_NAME_LENGTH - len(suffix) - len(extra)] + extra + suffix
+    return candidate
+
+
+def make_folder_name(sheet_name):
+    """Turns a sheet name into a folder name that is safe on Windows and Linux."""
+    return re.sub(r'[^\w\- ]', '_', sheet_name).strip() or 'sheet'
+
+
+def make_unique_columns(columns):
+    """
+    Parquet (and pyarrow) do not allow duplicate column names, but some of our queries return
+    them (e.g. the four "total for q" columns in "weekly products").
+    Returns the names with a ".1", ".2"... suffix on repeats.
+    """
+    seen = {}
+    unique_columns = []
+    for column in columns:
+        column = str(column)
+        if column in seen:
+            seen[column] += 1
+            unique_columns.append(f"{column}.{seen[column]}")
+        else:
+            seen[column] = 0
+            unique_columns.append(column)
+    return unique_columns
+
+
+def iter_chunks(results, chunk_rows=WRITE_CHUNK_ROWS):
+    """
+    Yields DataFrame chunks of at most chunk_rows rows.
+    'results' can be a single DataFrame or any iterable of DataFrames
+    (e.g. pd.read_sql(..., chunksize=N)).
+    """
+    if isinstance(results, pd.DataFrame):
+        results = [results]
+    for chunk in results:
+        if len(chunk) <= chunk_rows:
+            yield chunk
+            continue
+        for start_row in range(0, len(chunk), chunk_rows):
+            yield chunk.iloc[start_row:start_row + chunk_rows]
+
+
+def to_excel_rows(chunk):
+    """Converts a DataFrame chunk into plain row tuples openpyxl can write (NaN/NaT become empty cells)."""
+    chunk = chunk.astype(object).where(chunk.notna(), None)
+    return chunk.itertuples(index=False, name=None)
+
+
+def start_sheet(workbook, sheet_name, part_number, header, right_to_left, tab_color=None, sheet_format=None):
+    """Creates one (continuation) sheet and writes its header row."""
+    worksheet = workbook.create_sheet(make_sheet_name(workbook, sheet_name, part_number))
+    if right_to_left:
+        worksheet.sheet_view.rightToLeft = True
+    # (write-only sheets take their properties before the first row only)
+    if tab_color:
+        worksheet.sheet_properties.tabColor = tab_color
+    if sheet_format is not None:
+        for position, width in enumerate(sheet_format['widths'], start=1):
+            worksheet.column_dimensions[get_column_letter(position)].width = width
+        if sheet_format['freeze_header']:
+            worksheet.freeze_panes = 'A2'
+    worksheet.append(header)
+    return worksheet
+
+
+def finish_sheet(worksheet, sheet_format, rows, columns):
+    """The autofilter over the header and the rows written (the filter is written when the workbook is saved)."""
+    if sheet_format is not None and sheet_format['autofilter'] and columns:
+        worksheet.auto_filter.ref = f"A1:{get_column_letter(columns)}{rows + 1}"
+
+
+def make_format_cells(worksheet, sheet_format):
+    """
+    {column position: a cell with the column's number format}. The values of those columns are
+    written through these cells (one per column, reused for every row - openpyxl writes each row
+    as soon as it's appended), so the format isn't set again on every cell.
+    """
+    if sheet_format is None:
+        return {}
+    format_cells = {}
+    for position, number_format in enumerate(sheet_format['number_formats']):
+        if number_format is not None:
+            format_cells[position] = WriteOnlyCell(worksheet)
+            format_cells[position].number_format = number_format
+    return format_cells
+
+
+def without_number_formats(sheet_format):
+    """The sheet's format with no number formats (the widths, frozen header and filter stay)."""
+    if sheet_format is None:
+        return None
+    return dict(sheet_format, number_formats=[None] * len(sheet_format['number_formats']))
+
+
+def apply_format_cells(row, format_cells):
+    """The row with its formatted columns' values in their format cells (empty cells stay None)."""
+    row = list(row)
+    for position, format_cell in format_cells.items():
+        if row[position] is not None:
+            format_cell.value = row[position]
+            row[position] = format_cell
+    return row
+
+
+def write_sheet(workbook, sheet_name, results, right_to_left=False, companion_folder=None, tab_color=None, rows=None):
+    """
+    Streams a result (DataFrame or iterable of DataFrames) into the workbook.
+    Rolls over into "<name> (2)", "<name> (3)"... whenever a sheet reaches Excel's row limit.
+    If companion_folder is given and the result had to be split, the full result is
+    also saved as "<companion_folder>/<first sheet name>.parquet".
+    tab_color (e.g. 'FFC000') colors the sheet's tab.
+    rows is the row count of an iterable result, when it's known (it decides the number formats here).
+    Returns the list of sheet names that were written.
+    """
+    if is_parallel(workbook):
+        import SB_Parallel_Excel_Writer
+        return SB_Parallel_Excel_Writer.write_sheet(workbook, sheet_name, results, right_to_left, companion_folder, tab_color)
+
+    rows_per_sheet = EXCEL_MAX_ROWS - 1  # one row goes to the header
+    written_sheets = []
+    worksheet = None
+    header = None
+    sheet_format = None
+    format_cells = {}
+    rows_in_sheet = 0
+
+    companion = None
+
+    try:
+        for chunk in iter_chunks(results):
+            if worksheet is None:
+                header = [str(column) for column in chunk.columns]
+                # (a streamed result is formatted by its first chunk, as a partial view)
+                if isinstance(results, pd.DataFrame):
+                    sheet_format = SB_Sheet_Format.make_sheet_format(results, header)
+                else:
+                    sheet_format = SB_Sheet_Format.make_sheet_format(chunk, header, partial=True)
+                # number formats cost a styled cell each here - only small results get them
+                result_rows = len(results) if isinstance(results, pd.DataFrame) else rows
+                if result_rows is None or result_rows > get_number_format_max_rows():
+                    sheet_format = without_number_formats(sheet_format)
+                worksheet = start_sheet(workbook, sheet_name, 1, header, right_to_left, tab_color, sheet_format)
+                format_cells = make_format_cells(worksheet, sheet_format)
+                written_sheets.append(worksheet.title)
+
+            if companion_folder is not None:
+                if companion is None:
+                    companion = open_companion_file(companion_folder, written_sheets[0], chunk)
+                write_companion_chunk(companion, chunk)
+
+            for row in to_excel_rows(chunk):
+                if rows_in_sheet == rows_per_sheet:
+                    finish_sheet(worksheet, sheet_format, rows_in_sheet, len(header))
+                    worksheet = start_sheet(workbook, sheet_name, len(written_sheets) + 1, header, right_to_left, tab_color, sheet_format)
+                    format_cells = make_format_cells(worksheet, sheet_format)
+                    written_sheets.append(worksheet.title)
+                    rows_in_sheet = 0
+                if format_cells:
+                    row = apply_format_cells(row, format_cells)
+                worksheet.append(row)
+                rows_in_sheet += 1
+    finally:
+        if companion is not None:
+            # the companion is only useful when the sheet really had to be split
+            close_companion_file(companion, keep=len(written_sheets) > 1)
+
+    # an empty result (e.g. an empty iterator) still gets its sheet
+    if worksheet is None:
+        header = [str(column) for column in results.columns] if isinstance(results, pd.DataFrame) else []
+        sheet_format = SB_Sheet_Format.make_sheet_format(results, header) if header else None
+        worksheet = start_sheet(workbook, sheet_name, 1, header, right_to_left, tab_color, sheet_format)
+        written_sheets.append(worksheet.title)
+    finish_sheet(worksheet, sheet_format, rows_in_sheet, len(header))
+
+    return written_sheets
+
+
+def open_companion_file(companion_folder, sheet_name, first_chunk):
+    """Opens a streaming Parquet writer for the full result of one sheet: {'filename', 'writer'}."""
+    # imported here so pyarrow is only needed when companion files are requested
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(companion_folder, exist_ok=True)
+    companion_filename = os.path.join(companion_folder, f"{make_folder_name(sheet_name)}.parquet")
+    schema = pa.Table.from_pandas(make_parquet_safe(first_chunk), preserve_index=False).schema
+    return {'filename': companion_filename, 'writer': pq.ParquetWriter(companion_filename, schema, compression='zstd')}
+
+
+def write_companion_chunk(companion, chunk):
+    """
+    Appends one chunk to the companion Parquet file. A chunk whose types drifted from the file's
+    (a column that was all NULL or int so far is float / text now) widens the file first.
+    """
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(make_parquet_safe(chunk), preserve_index=False)
+    schema = companion['writer'].schema
+    if not table.schema.equals(schema):
+        try:
+            table = table.cast(schema)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            widen_companion_file(companion, get_common_schema([schema, table.schema]))
+            table = table.cast(companion['writer'].schema)
+    companion['writer'].write_table(table)
+
+
+def widen_companion_file(companion, schema):
+    """Rewrites the rows written so far in a wider schema and goes on writing in it (rare - types seldom drift)."""
+    import pyarrow.parquet as pq
+
+    companion['writer'].close()
+    written_filename = f"{companion['filename']}.tmp"
+    os.replace(companion['filename'], written_filename)
+    companion['writer'] = pq.ParquetWriter(companion['filename'], schema, compression='zstd')
+    written_file = pq.ParquetFile(written_filename)
+    try:
+        for row_group in range(written_file.num_row_groups):
+            companion['writer'].write_table(written_file.read_row_group(row_group).cast(schema))
+    finally:
+        written_file.close()
+        os.remove(written_filename)
+
+
+def close_companion_file(companion, keep=True):
+    """Closes the companion Parquet file (and deletes it when it isn't kept)."""
+    companion['writer'].close()
+    if not keep:
+        os.remove(companion['filename'])
+
+
+def get_common_schema(schemas):
+    """
+    The Arrow schema all the chunks' schemas fit in (NULL -> any type, int -> float...).
+    A column whose types can't be merged (e.g. int in one chunk, text in another) becomes text.
+    """
+    import pyarrow as pa
+
+    try:
+        return pa.unify_schemas(schemas, promote_options='permissive')
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+    fields = {}
+    for schema in schemas:
+        for field in schema:
+            if field.name not in fields:
+                fields[field.name] = field
+                continue
+            try:
+                fields[field.name] = pa.unify_schemas(
+                    [pa.schema([fields[field.name]]), pa.schema([field])], promote_options='permissive').field(0)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                fields[field.name] = pa.field(field.name, pa.string())
+    return pa.schema(list(fields.values()), metadata=schemas[0].metadata)
+
+
+def make_parquet_safe(chunk):
+    """Parquet needs unique column names - repeats get a ".1", ".2"... suffix."""
+    chunk = chunk.copy(deep=False)
+    chunk.columns = make_unique_columns(chunk.columns)
+    return chunk
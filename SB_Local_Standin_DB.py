@@ -0,0 +1,135 @@
+import argparse
+import os
+import random
+import sqlite3
+from datetime import date, timedelta
+
+
+# -----------------------------------------------------------------
+# Local stand-in database
+# -----------------------------------------------------------------
+# Builds a SQLite file with the tables and columns the report queries read
+# (orders, order_product, products, store, workers, cities, city_groups, categories),
+# filled with random but realistic looking data for one year.
+# Used to run the reports (and SB_Stress_Test.py) without touching the production DB:
+#
+#     py SB_Local_Standin_DB.py standin.db --orders 20000
+#
+# and in .env (or the environment):
+#     DB_DRIVER=sqlite
+#     DB_NAME=standin.db
+
+SCHEMA_SQL = """
+drop table if exists orders;
+drop table if exists order_product;
+drop table if exists products;
+drop table if exists store;
+drop table if exists workers;
+drop table if exists cities;
+drop table if exists city_groups;
+drop table if exists categories;
+
+create table store(id integer primary key, name text);
+create table workers(id integer primary key, first_name text, last_name text);
+create table city_groups(id integer primary key, description text);
+create table cities(id integer primary key, name text, city_group_id integer);
+create table categories(id integer primary key, name text);
+create table products(
+    id integer primary key, name text, name_heb text, name_weight text, category_id integer,
+    price real, low_cost_price real, packing_action integer, product_list text);
+create table orders(
+    id integer primary key, wp_id integer, customer_id integer, store_id integer,
+    delivery_date text, delivery_window integer, status integer, clearing_status integer,
+    dhl_package_number text, is_deleted integer, sum real, discount_sum real,
+    discount_promotions text, coupons text, created_date text, first_name text, last_name text,
+    phone text, city text, packing_worker_id integer, dispatcher_worker_id integer);
+create table order_product(
+    id integer primary key, order_id integer, product_id integer, quantity_needed real,
+    quantity real, quantity_delivered real, quantity_replaceable real, unit_price real);
+
+-- the indexes the production tables have on the columns the reports filter / join on
+create index orders_delivery_date on orders(delivery_date);
+create index orders_customer_id on orders(customer_id);
+create index order_product_order_id on order_product(order_id);
+"""
+
+# stores 84 / 85 are the ones the reports leave out, 82 is the one "packing" leaves out
+STORE_IDS = [1, 2, 3, 82, 84, 85]
+ORDER_STATUSES = [0, 1, 3, 4, 7, 11]
+COUPONS = ['', 'WELCOME10', 'WELCOME10,FREESHIP', 'SUMMER', None]
+PROMOTIONS = ['', 'promo1', 'promo1,promo2']
+
+
+def build_standin_db(db_filename, order_count=20000, year=2025, seed=1):
+    """Creates (or replaces) the stand-in database file; returns the number of order lines written."""
+    rng = random.Random(seed)
+    customer_count = order_count // 4 + 1
+    first_day = date(year, 1, 1)
+    days_in_year = (date(year + 1, 1, 1) - first_day).days
+
+    connection = sqlite3.connect(db_filename)
+    try:
+        cursor = connection.cursor()
+        cursor.executescript(SCHEMA_SQL)
+
+        cursor.executemany("insert into store values (?, ?)",
+                           [(store_id, f"store {store_id}") for store_id in STORE_IDS])
+        cursor.executemany("insert into workers values (?, ?, ?)",
+                           [(worker_id, f"worker{worker_id}", f"last{worker_id}") for worker_id in range(1, 11)])
+        # one group without a description, like the real "no zone" group
+        cursor.executemany("insert into city_groups values (?, ?)",
+                           [(group_id, f"zone {group_id}" if group_id < 5 else '') for group_id in range(1, 6)])
+        cursor.executemany("insert into cities values (?, ?, ?)",
+                           [(city_id, f"city{city_id}", rng.randint(1, 5)) for city_id in range(1, 21)])
+        cursor.executemany("insert into categories values (?, ?)",
+                           [(category_id, f"cat{category_id}") for category_id in range(1, 6)])
+        cursor.executemany("insert into products values (?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+            (product_id, f"prod{product_id}", f"מוצר {product_id}", '1kg', rng.randint(1, 5),
+             rng.randint(5, 50), rng.randint(3, 40), rng.randint(0, 2), 'list')
+            for product_id in range(1, 101)
+        ])
+
+        orders = []
+        order_lines = []
+        for order_id in range(1, order_count + 1):
+            delivery_date = (first_day + timedelta(days=rng.randint(0, days_in_year - 1))).isoformat()
+            order_sum = 0
+            for _ in range(rng.randint(1, 8)):
+                quantity = rng.randint(1, 5)
+                unit_price = rng.randint(5, 50)
+                order_sum += quantity * unit_price
+                order_lines.append((len(order_lines) + 1, order_id, rng.randint(1, 100),
+                                    quantity, quantity - rng.randint(0, 1), quantity, 0, unit_price))
+            orders.append((
+                order_id, order_id + 1000, rng.randint(1, customer_count), rng.choice(STORE_IDS),
+                delivery_date, rng.randint(0, 1), rng.choice(ORDER_STATUSES), 0, '', 0, order_sum,
+                rng.choice([0, 5, 10]), rng.choice(PROMOTIONS), rng.choice(COUPONS), delivery_date,
+                'fn', 'ln', '050', f"city{rng.randint(1, 20)}", rng.randint(1, 10), rng.randint(1, 10),
+            ))
+
+        cursor.executemany(f"insert into orders values ({', '.join(['?'] * 21)})", orders)
+        cursor.executemany("insert into order_product values (?, ?, ?, ?, ?, ?, ?, ?)", order_lines)
+        connection.commit()
+    finally:
+        connection.close()
+
+    return len(order_lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a local SQLite stand-in for the reports database")
+    parser.add_argument('db_filename', help="SQLite file to create (replaced if it exists)")
+    parser.add_argument('--orders', type=int, default=20000, help="number of orders to generate [20000]")
+    parser.add_argument('--year', type=int, default=2025, help="delivery dates are spread over this year [2025]")
+    parser.add_argument('--seed', type=int, default=1, help="random seed, same seed = same data [1]")
+    args = parser.parse_args()
+
+    print(f"Building stand-in database: {args.db_filename} ({args.orders} orders in {args.year})...")
+    line_count = build_standin_db(args.db_filename, args.orders, args.year, args.seed)
+    print(f"    > Done! {args.orders} orders, {line_count} order lines.")
+    print(f"    > Use it with: DB_DRIVER=sqlite  DB_NAME={os.path.abspath(args.db_filename)}")
+
+
+# Running the main function
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import json
+import os
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+import SB_Excel_Writer
+import SB_Memory_Budget
+from SB_Excel_Writer import make_folder_name, make_unique_columns
+
+
+# -----------------------------------------------------------------
+# Master (year-to-date) workbook
+# -----------------------------------------------------------------
+# A weekly run only appends its own results to a "sidecar" folder that sits
+# next to the master workbook:
+#
+#   Shookbook_master_2025.xlsx
+#   Shookbook_master_2025_data/
+#       manifest.json
+#       packing/2025-11-02_to_2025-11-09.parquet
+#       weekly products/2025-11-02_to_2025-11-09.parquet
+#       ...
+#
+# Every (sheet, week) is one small Parquet file, so appending a week costs the
+# same in week 1 and in week 52.
+#
+# The master .xlsx is REBUILD-ONLY: a weekly run never touches it. An .xlsx is one zip
+# file, so adding a week to it (rows or a dated sheet) means reading and writing the whole
+# year again - exactly the cost that grows every week. It's rebuilt from the sidecar when
+# someone asks for it (--rebuild-master), and that needs no DB access.
+#
+# Only the week's own sheets (the queries and the sheets derived from them) are master data.
+# The "... vs last week", approximate and preview sheets describe a single run, so the
+# caller leaves them out.
+#
+# A sheet whose columns change (e.g. a query gets a new column) can't be stacked under its
+# old header, so from that week on it's kept as a new version of the sheet, "<name> v2",
+# with its own header (and its own sheet in the rebuilt workbook).
+
+MANIFEST_FILENAME = 'manifest.json'
+WEEK_START_COLUMN = 'week start'
+WEEK_END_COLUMN = 'week end'
+
+
+def get_sidecar_folder(master_filename):
+    """Returns the sidecar folder of a master workbook ('<name>_data' next to the .xlsx)."""
+    base_name, _ = os.path.splitext(master_filename)
+    return f"{base_name}_data"
+
+
+def load_manifest(sidecar_folder):
+    """Loads the sidecar manifest (sheet (version) name -> report sheet, folder, column names and stored weeks)."""
+    manifest_path = os.path.join(sidecar_folder, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {'sheets': {}}
+    with open(manifest_path, encoding='utf-8') as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(sidecar_folder, manifest):
+    """Writes the manifest atomically so an interrupted run never leaves it half written."""
+    manifest_path = os.path.join(sidecar_folder, MANIFEST_FILENAME)
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, ensure_ascii=False, indent=2)
+    os.replace(temp_path, manifest_path)
+
+
+def append_week_to_master(master_filename, queries_results_to_export, start_date, end_date):
+    """
+    Appends one week of results to the sidecar of the master workbook (the .xlsx itself is only
+    written by rebuild_master_workbook). Only the new week's files are written; running the same
+    week again replaces it.
+    Sheets that failed (an 'Error' DataFrame) are skipped.
+    Returns the list of sheet names that were appended.
+    """
+    sidecar_folder = get_sidecar_folder(master_filename)
+    os.makedirs(sidecar_folder, exist_ok=True)
+    manifest = load_manifest(sidecar_folder)
+    week_key = f"{start_date}_to_{end_date}"
+
+    appended_sheets = []
+    for sheet_name, results_table_df in queries_results_to_export.items():
+        # a result spilled to disk (SB_Memory_Budget.py) is read back one sheet at a time
+        results_table_df = SB_Memory_Budget.load_result(results_table_df)
+        if list(results_table_df.columns) == ['Error']:
+            print(f"  > Skipping '{sheet_name}' (query failed, nothing to append).")
+            continue
+
+        columns = [str(column) for column in results_table_df.columns]
+        entry_name, sheet_entry = get_sheet_entry(manifest, sheet_name, columns)
+        # running a week again with other columns moves it to the new version
+        remove_week_from_other_versions(sidecar_folder, manifest, sheet_name, entry_name, week_key)
+        sheet_folder = os.path.join(sidecar_folder, sheet_entry['folder'])
+        os.makedirs(sheet_folder, exist_ok=True)
+
+        # the week columns go first so every row in the master says which week it belongs to
+        week_df = results_table_df.copy()
+        week_df.columns = make_unique_columns(week_df.columns)
+        week_df.insert(0, WEEK_END_COLUMN, end_date)
+        week_df.insert(0, WEEK_START_COLUMN, start_date)
+        week_df.to_parquet(os.path.join(sheet_folder, f"{week_key}.parquet"), index=False)
+
+        if week_key not in sheet_entry['weeks']:
+            sheet_entry['weeks'].append(week_key)
+            sheet_entry['weeks'].sort()
+        appended_sheets.append(sheet_name)
+
+    save_manifest(sidecar_folder, manifest)
+    return appended_sheets
+
+
+def get_sheet_versions(manifest, sheet_name):
+    """{entry name: entry} of every version of one report sheet ('packing', 'packing v2'...)."""
+    return {entry_name: sheet_entry for entry_name, sheet_entry in manifest['sheets'].items()
+            if sheet_entry.get('sheet', entry_name) == sheet_name}
+
+
+def get_sheet_entry(manifest, sheet_name, columns):
+    """
+    Returns (entry name, entry) of the version of the sheet with exactly these columns.
+    A sheet seen for the first time is entered under its own name; when its columns changed
+    since, a new version "<name> v2", "<name> v3"... is started.
+    """
+    versions = get_sheet_versions(manifest, sheet_name)
+    for entry_name, sheet_entry in versions.items():
+        if sheet_entry['columns'] == columns:
+            return entry_name, sheet_entry
+
+    entry_name = sheet_name if not versions else f"{sheet_name} v{len(versions) + 1}"
+    if versions:
+        print(f"  > The columns of '{sheet_name}' changed - keeping it as '{entry_name}' from this week on.")
+    sheet_entry = manifest['sheets'][entry_name] = {
+        'sheet': sheet_name,
+        'folder': make_folder_name(entry_name),
+        'columns': columns,
+        'weeks': [],
+    }
+    return entry_name, sheet_entry
+
+
+def remove_week_from_other_versions(sidecar_folder, manifest, sheet_name, entry_name, week_key):
+    """Drops a week from the sheet's other versions (when it's run again with other columns)."""
+    for other_entry_name, sheet_entry in get_sheet_versions(manifest, sheet_name).items():
+        if other_entry_name != entry_name and week_key in sheet_entry['weeks']:
+            sheet_entry['weeks'].remove(week_key)
+            week_path = os.path.join(sidecar_folder, sheet_entry['folder'], f"{week_key}.parquet")
+            if os.path.exists(week_path):
+                os.remove(week_path)
+
+
+def read_sheet_weeks(sidecar_folder, sheet_entry):
+    """Yields (week_key, DataFrame) for every stored week of one sheet, oldest first."""
+    for week_key in sheet_entry['weeks']:
+        week_path = os.path.join(sidecar_folder, sheet_entry['folder'], f"{week_key}.parquet")
+        yield week_key, pd.read_parquet(week_path)
+
+
+def count_sheet_rows(sidecar_folder, sheet_entry):
+    """The rows of all the stored weeks of one sheet (from the Parquet footers, nothing else is read)."""
+    return sum(pq.ParquetFile(os.path.join(sidecar_folder, sheet_entry['folder'], f"{week_key}.parquet")).metadata.num_rows
+               for week_key in sheet_entry['weeks'])
+
+
+def restore_original_columns(week_df, sheet_entry):
+    """
+    Puts back the original (possibly duplicated) column names for the Excel header.
+    A stored week with other columns than its sheet's header is an error - it's never stacked under it.
+    """
+    original_columns = [WEEK_START_COLUMN, WEEK_END_COLUMN] + sheet_entry['columns']
+    if list(week_df.columns) != make_unique_columns(original_columns):
+        raise ValueError(f"a stored week of '{sheet_entry['folder']}' has other columns than the sheet: "
+                         f"{list(week_df.columns)} instead of {make_unique_columns(original_columns)}")
+    week_df.columns = original_columns
+    return week_df
+
+
+def get_dated_sheet_name(week_key, sheet_name):
+    """Sheet name for the 'sheets' layout, e.g. '2025-11-02 packing' (Excel allows 31 characters)."""
+    return f"{week_key.split('_to_')[0]} {sheet_name}"[:31]
+
+
+def rebuild_master_workbook(master_filename, layout='rows'):
+    """
+    Rebuilds the master .xlsx from its sidecar (no DB access).
+    layout='rows'   -> one sheet per report sheet, all weeks stacked (newest rows at the bottom)
+    layout='sheets' -> one dated sheet per report sheet per week
+    """
+    sidecar_folder = get_sidecar_folder(master_filename)
+    manifest = load_manifest(sidecar_folder)
+    if not manifest['sheets']:
+        print(f"Nothing to rebuild: no data found in '{sidecar_folder}'.")
+        return False
+
+    # weeks are streamed one at a time, and a sheet that outgrows Excel's row limit rolls over to "<name> (2)"
+    workbook = SB_Excel_Writer.open_workbook()
+    for sheet_name, sheet_entry in manifest['sheets'].items():
+        weeks = read_sheet_weeks(sidecar_folder, sheet_entry)
+        if layout == 'sheets':
+            for week_key, week_df in weeks:
+                week_df = restore_original_columns(week_df, sheet_entry)
+                SB_Excel_Writer.write_sheet(workbook, get_dated_sheet_name(week_key, sheet_name), week_df)
+        elif sheet_entry['weeks']:
+            week_dfs = (restore_original_columns(week_df, sheet_entry) for _, week_df in weeks)
+            SB_Excel_Writer.write_sheet(workbook, sheet_name, week_dfs, rows=count_sheet_rows(sidecar_folder, sheet_entry))
+    SB_Excel_Writer.save_workbook(workbook, master_filename)
+
+    print(f"Master workbook rebuilt: {master_filename}")
+    return True
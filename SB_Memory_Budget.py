@@ -0,0 +1,194 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import SB_DB_Governor
+import SB_Excel_Writer
+
+
+# -----------------------------------------------------------------
+# Memory budget with spill to disk
+# -----------------------------------------------------------------
+# On a small machine a yearly report can run out of RAM holding every query result
+# until the workbook is written. With a budget (--memory-budget MB or SB_MEMORY_BUDGET_MB
+# in .env) the queries are read in chunks and every result is counted by its size
+# in memory; when keeping the next chunk would go over the budget, that result goes to
+# a compressed Parquet file on disk instead (the chunks read so far too, and every
+# chunk after them). At write time a spilled result is streamed back chunk by chunk,
+# so it's never whole in memory again (except to compute a derived sheet from it).
+#
+# A spilled result is a dict instead of a DataFrame:
+#   {'spill_folder': ..., 'parts': [file, ...], 'columns': [...], 'rows': N}
+# load_result / iter_result / result_columns work on both.
+#
+# No budget (the default) = everything stays in memory, exactly as before.
+
+# rows per chunk read from the DB (and per spilled Parquet part)
+READ_CHUNK_ROWS = SB_Excel_Writer.WRITE_CHUNK_ROWS
+
+
+def create_budget(budget_mb=None):
+    """The run's budget; budget_mb (or SB_MEMORY_BUDGET_MB) 0 / empty means no budget. Returns None then."""
+    if budget_mb is None:
+        budget_mb = float(os.getenv('SB_MEMORY_BUDGET_MB') or 0)
+    if not budget_mb or budget_mb <= 0:
+        return None
+    return make_budget(int(budget_mb * 1024 * 1024))
+
+
+def create_spill_budget():
+    """A budget of 0 bytes: a result read with it goes straight to disk, chunk by chunk (SB_Query_Planner.py's 'stream')."""
+    return make_budget(0)
+
+
+def make_budget(limit_bytes):
+    return {
+        'limit_bytes': limit_bytes,
+        'used_bytes': 0,
+        'lock': threading.Lock(),
+        # created when the first result spills
+        'spill_root': None,
+        'spilled_results': 0,
+    }
+
+
+def get_size(chunk):
+    """How much memory a DataFrame holds (text columns counted by their real size)."""
+    return int(chunk.memory_usage(index=True, deep=True).sum())
+
+
+def is_spilled(result):
+    return isinstance(result, dict)
+
+
+def result_columns(result):
+    """The column names of a DataFrame or a spilled result."""
+    return list(result['columns']) if is_spilled(result) else list(result.columns)
+
+
+def result_rows(result):
+    return result['rows'] if is_spilled(result) else len(result)
+
+
+def iter_result(result):
+    """A DataFrame as is, a spilled result as one DataFrame per part (SB_Excel_Writer.write_sheet takes both)."""
+    if not is_spilled(result):
+        return result
+    return (restore_columns(pq.read_table(part_filename).to_pandas(), result['columns'])
+            for part_filename in result['parts'])
+
+
+def load_result(result):
+    """The whole result as one DataFrame (reads a spilled result back from disk)."""
+    if not is_spilled(result):
+        return result
+    return pd.concat(list(iter_result(result)), ignore_index=True)
+
+
+def restore_columns(part_df, columns):
+    """Parquet needed unique names ("total for q.1"...); the sheet gets the query's own names back."""
+    part_df.columns = columns
+    return part_df
+
+
+# -----------------------------------------------------------------
+# Collecting one result within the budget
+# -----------------------------------------------------------------
+
+def start_result(budget, result_name):
+    return {'budget': budget, 'name': result_name, 'chunks': [], 'bytes': 0, 'spilled': None, 'columns': None, 'rows': 0}
+
+
+def spill_part(collector, chunk):
+    """Writes one chunk as the next Parquet part of the collector's spilled result."""
+    spilled = collector['spilled']
+    part_filename = os.path.join(spilled['spill_folder'], f"part_{len(spilled['parts']):05d}.parquet")
+    pq.write_table(pa.Table.from_pandas(SB_Excel_Writer.make_parquet_safe(chunk), preserve_index=False),
+                   part_filename, compression='zstd')
+    spilled['parts'].append(part_filename)
+
+
+def start_spilling(collector):
+    """Moves the chunks held so far to disk; every later chunk of this result goes straight there."""
+    budget = collector['budget']
+    with budget['lock']:
+        if budget['spill_root'] is None:
+            budget['spill_root'] = tempfile.mkdtemp(prefix='sb_spill_')
+        budget['spilled_results'] += 1
+        spill_folder = os.path.join(budget['spill_root'], f"{budget['spilled_results']:03d}_"
+                                    f"{SB_Excel_Writer.make_folder_name(collector['name'])}")
+        budget['used_bytes'] -= collector['bytes']
+    os.makedirs(spill_folder)
+    collector['spilled'] = {'spill_folder': spill_folder, 'parts': []}
+    if budget['limit_bytes']:
+        print(f"    > Memory budget reached: '{collector['name']}' continues on disk.")
+    for chunk in collector['chunks']:
+        spill_part(collector, chunk)
+    collector['chunks'] = []
+    collector['bytes'] = 0
+
+
+def add_chunk(collector, chunk):
+    """Keeps a chunk in memory while the budget allows it, otherwise spills the result to disk."""
+    if collector['columns'] is None:
+        collector['columns'] = [str(column) for column in chunk.columns]
+    collector['rows'] += len(chunk)
+    if collector['spilled'] is not None:
+        spill_part(collector, chunk)
+        return
+
+    budget = collector['budget']
+    chunk_size = get_size(chunk)
+    with budget['lock']:
+        fits = budget['used_bytes'] + chunk_size <= budget['limit_bytes']
+        if fits:
+            budget['used_bytes'] += chunk_size
+    if fits:
+        collector['chunks'].append(chunk)
+        collector['bytes'] += chunk_size
+        return
+    start_spilling(collector)
+    spill_part(collector, chunk)
+
+
+def finish_result(collector, empty_df=None):
+    """The collected result: a DataFrame when it stayed in memory, a spilled-result dict otherwise."""
+    if collector['spilled'] is not None:
+        return dict(collector['spilled'], columns=collector['columns'], rows=collector['rows'])
+    if not collector['chunks']:
+        return empty_df if empty_df is not None else pd.DataFrame()
+    return pd.concat(collector['chunks'], ignore_index=True) if len(collector['chunks']) > 1 else collector['chunks'][0]
+
+
+def read_sql_within_budget(governor, budget, result_name, sql_query):
+    """
+    SB_DB_Governor.read_sql, read in chunks and kept within the budget (no budget = a plain read_sql).
+    The chunks are streamed from the server (stream_results), so only about one chunk is in
+    memory before it is kept or spilled.
+    """
+    if budget is None:
+        return SB_DB_Governor.read_sql(governor, sql_query)
+    collector = start_result(budget, result_name)
+    empty_chunks = []
+
+    def handle_chunk(chunk):
+        if chunk.empty:
+            # an empty result still needs its columns
+            empty_chunks.append(chunk)
+            return
+        add_chunk(collector, chunk)
+
+    SB_DB_Governor.read_sql(governor, sql_query, chunksize=READ_CHUNK_ROWS, handle_chunk=handle_chunk)
+    return finish_result(collector, empty_chunks[0] if empty_chunks else None)
+
+
+def cleanup_budget(budget):
+    """Deletes the spilled files (after the workbook is saved)."""
+    if budget is not None and budget['spill_root'] is not None:
+        shutil.rmtree(budget['spill_root'], ignore_errors=True)
+        budget['spill_root'] = None
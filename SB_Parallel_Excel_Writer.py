@@ -0,0 +1,486 @@
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+from xml.sax.saxutils import escape, quoteattr
+
+import numpy as np
+import pandas as pd
+from openpyxl.utils import get_column_letter
+
+import SB_Excel_Writer
+import SB_Sheet_Format
+
+
+# -----------------------------------------------------------------
+# Parallel Excel writer (one worker process per sheet)
+# -----------------------------------------------------------------
+# Turning rows into worksheet XML is pure Python CPU work, so a big workbook written
+# by openpyxl takes the sum of all its sheets on ONE core. With SB_EXCEL_WORKERS=N
+# (or --excel-workers N) SB_Excel_Writer.open_workbook() returns a parallel workbook instead:
+#   - every sheet written with write_sheet() is sent to a pool of N worker processes,
+#     which write the sheet's XML (sheet view, right-to-left, tab color, rows) to a temp file
+#   - the script doesn't wait: the next query runs / the next sheet is sent meanwhile
+#   - save_workbook() waits for the workers and zips the sheets, the styles and the
+#     workbook parts into the .xlsx in the parent
+# So a workbook takes about as long as its biggest sheet. A big sheet that rolls over
+# into "<name> (2)"... is split first, and its parts are written in parallel too.
+# A result that isn't a DataFrame (e.g. a spilled result streamed back from disk) is
+# written here in the parent, part by part, so it's still never whole in memory.
+#
+# The workers are started when the workbook is opened (before the queries run), so
+# their start-up (a new Python + pandas) is paid while the DB works.
+#
+# Strings are written inline (no shared strings table), dates / times get the same
+# number formats openpyxl gives them. The sheet formatting (SB_Sheet_Format.py) is worked out
+# here in the parent, once per result, and the workers write it with the rows: the column widths,
+# the frozen header, the autofilter, and the columns' number formats (as styles in styles.xml).
+
+
+# the spreadsheet XML namespaces
+MAIN_NAMESPACE = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+RELATIONSHIPS_NAMESPACE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PACKAGE_RELATIONSHIPS_NAMESPACE = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+# Excel stores dates as days since 1899-12-30
+EXCEL_EPOCH = datetime(1899, 12, 30)
+
+# cellXfs in styles.xml: 0 = general, then the date / time formats (same as openpyxl),
+# then one per number format the sheets use (from FIRST_FORMAT_STYLE / FIRST_FORMAT_ID on)
+STYLE_DATETIME = 1
+STYLE_DATE = 2
+STYLE_TIME = 3
+STYLE_DURATION = 4
+FIRST_FORMAT_STYLE = 5
+FIRST_FORMAT_ID = 167
+
+# characters XML 1.0 can't hold (openpyxl refuses them, here they are dropped)
+ILLEGAL_XML_CHARACTERS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+STYLES_XML = f'''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="{MAIN_NAMESPACE}">
+<numFmts count="{{format_count}}"><numFmt numFmtId="164" formatCode="yyyy-mm-dd h:mm:ss"/><numFmt numFmtId="165" formatCode="yyyy-mm-dd"/><numFmt numFmtId="166" formatCode="[hh]:mm:ss"/>{{number_formats}}</numFmts>
+<fonts count="1"><font><sz val="11"/><name val="Calibri"/><family val="2"/><scheme val="minor"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="{{style_count}}">
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>
+<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="21" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="166" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+{{format_styles}}</cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>'''
+
+
+# -----------------------------------------------------------------
+# Worksheet XML (runs in the worker processes)
+# -----------------------------------------------------------------
+
+def make_string_cell(cell_ref, value):
+    text = escape(ILLEGAL_XML_CHARACTERS.sub('', value))
+    return f'<c r="{cell_ref}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def get_number_text(number):
+    """A float as Excel text, with openpyxl's 16 significant digits (3.0 -> 3)."""
+    return '%.16g' % number
+
+
+def make_number_cell(cell_ref, number_text, style=0):
+    style_attribute = f' s="{style}"' if style else ''
+    return f'<c r="{cell_ref}"{style_attribute}><v>{number_text}</v></c>'
+
+
+def get_excel_serial(value):
+    """A date / datetime / time / timedelta as Excel's number of days, and its style."""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return (value - EXCEL_EPOCH) / timedelta(days=1), STYLE_DATETIME
+    if isinstance(value, date):
+        return (value - EXCEL_EPOCH.date()).days, STYLE_DATE
+    if isinstance(value, time):
+        return (value.hour * 3600 + value.minute * 60 + value.second + value.microsecond / 1e6) / 86400, STYLE_TIME
+    return value / timedelta(days=1), STYLE_DURATION
+
+
+def make_cell(cell_ref, value, style=0):
+    """One cell of any type (used for text / mixed columns); None is an empty cell. style is the column's number format."""
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return make_string_cell(cell_ref, value)
+    if isinstance(value, (bool, np.bool_)):
+        return f'<c r="{cell_ref}" t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, np.integer)):
+        return make_number_cell(cell_ref, int(value), style)
+    if isinstance(value, (float, np.floating, Decimal)):
+        # NaN / inf have no Excel number
+        return make_number_cell(cell_ref, get_number_text(float(value)), style) if math.isfinite(value) else ''
+    if isinstance(value, (datetime, date, time, timedelta)):
+        serial, type_style = get_excel_serial(value)
+        return make_number_cell(cell_ref, get_number_text(serial), style or type_style)
+    if isinstance(value, bytes):
+        return make_string_cell(cell_ref, value.decode('utf-8', errors='replace'))
+    return make_string_cell(cell_ref, str(value))
+
+
+def make_column_cells(column_values, column_letter, row_numbers, style=0):
+    """The cells of one column of a chunk, with a fast path per column type (style: the column's number format, 0 = none)."""
+    missing = column_values.isna().to_numpy()
+    kind = column_values.dtype.kind
+    if kind in 'iu':
+        texts = column_values.astype(str).tolist()
+        return [make_number_cell(f"{column_letter}{row_number}", text, style)
+                for row_number, text in zip(row_numbers, texts)]
+    if kind == 'f':
+        numbers = column_values.tolist()
+        return ['' if is_missing or not math.isfinite(number) else make_number_cell(f"{column_letter}{row_number}", get_number_text(number), style)
+                for row_number, number, is_missing in zip(row_numbers, numbers, missing)]
+    if kind == 'b':
+        flags = column_values.astype(int).tolist()
+        return [f'<c r="{column_letter}{row_number}" t="b"><v>{flag}</v></c>' for row_number, flag in zip(row_numbers, flags)]
+    if kind == 'M':
+        if getattr(column_values.dtype, 'tz', None) is not None:
+            column_values = column_values.dt.tz_convert('UTC').dt.tz_localize(None)
+        serials = ((column_values - pd.Timestamp(EXCEL_EPOCH)) / pd.Timedelta(days=1)).tolist()
+        return ['' if is_missing else make_number_cell(f"{column_letter}{row_number}", get_number_text(serial), style or STYLE_DATETIME)
+                for row_number, serial, is_missing in zip(row_numbers, serials, missing)]
+    if kind == 'm':
+        serials = (column_values / pd.Timedelta(days=1)).tolist()
+        return ['' if is_missing else make_number_cell(f"{column_letter}{row_number}", get_number_text(serial), STYLE_DURATION)
+                for row_number, serial, is_missing in zip(row_numbers, serials, missing)]
+    values = column_values.astype(object).tolist()
+    return ['' if is_missing else make_cell(f"{column_letter}{row_number}", value, style)
+            for row_number, value, is_missing in zip(row_numbers, values, missing)]
+
+
+def write_rows(xml_file, chunk, first_row_number, column_letters, column_styles=None):
+    """Writes a DataFrame chunk as <row> elements (columns by position - names can repeat)."""
+    row_numbers = range(first_row_number, first_row_number + len(chunk))
+    column_styles = column_styles or [0] * chunk.shape[1]
+    columns_cells = [make_column_cells(chunk.iloc[:, position], column_letters[position], row_numbers, column_styles[position])
+                     for position in range(chunk.shape[1])]
+    xml_file.write(''.join(
+        f'<row r="{row_number}">{"".join(row_cells)}</row>'
+        for row_number, row_cells in zip(row_numbers, zip(*columns_cells))
+    ))
+
+
+def start_sheet_xml(xml_file, header, right_to_left=False, tab_color=None, sheet_format=None):
+    """The worksheet's start (properties, sheet view with the frozen header, column widths) and its header row."""
+    xml_file.write(f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                   f'<worksheet xmlns="{MAIN_NAMESPACE}" xmlns:r="{RELATIONSHIPS_NAMESPACE}">')
+    if tab_color:
+        xml_file.write(f'<sheetPr><tabColor rgb="00{tab_color}"/></sheetPr>')
+    right_to_left_attribute = ' rightToLeft="1"' if right_to_left else ''
+    frozen_header = ''
+    if sheet_format is not None and sheet_format['freeze_header']:
+        frozen_header = ('<pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/>'
+                         '<selection pane="bottomLeft" activeCell="A2" sqref="A2"/>')
+    xml_file.write(f'<sheetViews><sheetView{right_to_left_attribute} workbookViewId="0">{frozen_header}</sheetView></sheetViews>'
+                   f'<sheetFormatPr defaultRowHeight="15"/>')
+    if sheet_format is not None and sheet_format['widths']:
+        xml_file.write('<cols>' + ''.join(
+            f'<col min="{position}" max="{position}" width="{width}" customWidth="1"/>'
+            for position, width in enumerate(sheet_format['widths'], start=1)) + '</cols>')
+    xml_file.write('<sheetData>')
+    if header:
+        header_cells = ''.join(make_string_cell(f"{get_column_letter(position + 1)}1", column)
+                               for position, column in enumerate(header))
+        xml_file.write(f'<row r="1">{header_cells}</row>')
+
+
+def finish_sheet_xml(xml_file, sheet_format=None, rows=0, columns=0):
+    """The worksheet's end, with the autofilter over the header and the rows."""
+    xml_file.write('</sheetData>')
+    if sheet_format is not None and sheet_format['autofilter'] and columns:
+        xml_file.write(f'<autoFilter ref="A1:{get_column_letter(columns)}{rows + 1}"/>')
+    xml_file.write('</worksheet>')
+
+
+def open_sheet_xml(xml_filename):
+    return open(xml_filename, 'w', encoding='utf-8', newline='')
+
+
+def serialize_sheet_part(xml_filename, part_df, header, right_to_left=False, tab_color=None,
+                         sheet_format=None, column_styles=None):
+    """Worker process: writes one (part of a) sheet's XML file; returns its row count."""
+    column_letters = [get_column_letter(position + 1) for position in range(len(header))]
+    with open_sheet_xml(xml_filename) as xml_file:
+        start_sheet_xml(xml_file, header, right_to_left, tab_color, sheet_format)
+        row_number = 2
+        for chunk in SB_Excel_Writer.iter_chunks(part_df):
+            write_rows(xml_file, chunk, row_number, column_letters, column_styles)
+            row_number += len(chunk)
+        finish_sheet_xml(xml_file, sheet_format, len(part_df), len(header))
+    return len(part_df)
+
+
+def warm_up_worker():
+    """Nothing - submitted once per worker when the workbook opens, so the processes start early."""
+    return os.getpid()
+
+
+# -----------------------------------------------------------------
+# The parallel workbook (parent process)
+# -----------------------------------------------------------------
+
+def open_workbook(workers):
+    """A parallel workbook: a dict with the worker pool, a temp folder and its sheets in order."""
+    # 'spawn' on every OS: the report processes have DB / worker threads running, which a fork would copy
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    for _ in range(workers):
+        executor.submit(warm_up_worker)
+    return {
+        'executor': executor,
+        'temp_folder': tempfile.mkdtemp(prefix='sb_xlsx_'),
+        # {'title', 'xml_filename', 'future'} per sheet, in workbook order
+        'sheets': [],
+        # the number formats the sheets use, in the order their styles were added
+        'number_formats': [],
+    }
+
+
+def get_column_styles(workbook, sheet_format):
+    """The style of every column's number format (0 = none), adding the formats not used before."""
+    if sheet_format is None:
+        return None
+    column_styles = []
+    for number_format in sheet_format['number_formats']:
+        if number_format is None:
+            column_styles.append(0)
+        elif number_format == SB_Sheet_Format.DATE_FORMAT:
+            column_styles.append(STYLE_DATE)
+        else:
+            if number_format not in workbook['number_formats']:
+                workbook['number_formats'].append(number_format)
+            column_styles.append(FIRST_FORMAT_STYLE + workbook['number_formats'].index(number_format))
+    return column_styles
+
+
+def make_styles_xml(number_formats):
+    """styles.xml with the fixed date / time styles and one style per number format."""
+    return STYLES_XML.format(
+        format_count=3 + len(number_formats),
+        number_formats=''.join(f'<numFmt numFmtId="{FIRST_FORMAT_ID + index}" formatCode={quoteattr(number_format)}/>'
+                               for index, number_format in enumerate(number_formats)),
+        style_count=FIRST_FORMAT_STYLE + len(number_formats),
+        format_styles=''.join(f'<xf numFmtId="{FIRST_FORMAT_ID + index}" fontId="0" fillId="0" borderId="0" xfId="0" '
+                              f'applyNumberFormat="1"/>\n' for index in range(len(number_formats))),
+    )
+
+
+def add_sheet_entry(workbook, sheet_name, part_number):
+    """Reserves the next sheet (its unique title and its temp XML file)."""
+    sheet_entry = {
+        'title': SB_Excel_Writer.make_sheet_name(workbook, sheet_name, part_number),
+        'xml_filename': os.path.join(workbook['temp_folder'], f"sheet{len(workbook['sheets']) + 1}.xml"),
+        'future': None,
+    }
+    workbook['sheets'].append(sheet_entry)
+    return sheet_entry
+
+
+def write_sheet(workbook, sheet_name, results, right_to_left=False, companion_folder=None, tab_color=None):
+    """SB_Excel_Writer.write_sheet for a parallel workbook: a DataFrame's parts are sent to the workers."""
+    if not isinstance(results, pd.DataFrame):
+        return write_sheet_here(workbook, sheet_name, results, right_to_left, companion_folder, tab_color)
+
+    rows_per_sheet = SB_Excel_Writer.EXCEL_MAX_ROWS - 1  # one row goes to the header
+    header = [str(column) for column in results.columns]
+    # (one format for all the parts, from the whole result)
+    sheet_format = SB_Sheet_Format.make_sheet_format(results, header)
+    column_styles = get_column_styles(workbook, sheet_format)
+    part_count = max(1, math.ceil(len(results) / rows_per_sheet))
+    written_sheets = []
+    for part_index in range(part_count):
+        sheet_entry = add_sheet_entry(workbook, sheet_name, part_index + 1)
+        part_df = results.iloc[part_index * rows_per_sheet:(part_index + 1) * rows_per_sheet]
+        sheet_entry['future'] = workbook['executor'].submit(
+            serialize_sheet_part, sheet_entry['xml_filename'], part_df, header, right_to_left, tab_color,
+            sheet_format, column_styles)
+        written_sheets.append(sheet_entry['title'])
+
+    # the companion is only useful when the sheet really had to be split
+    if companion_folder is not None and part_count > 1:
+        companion = SB_Excel_Writer.open_companion_file(companion_folder, written_sheets[0], results.head(0))
+        try:
+            for chunk in SB_Excel_Writer.iter_chunks(results):
+                SB_Excel_Writer.write_companion_chunk(companion, chunk)
+        finally:
+            SB_Excel_Writer.close_companion_file(companion)
+    return written_sheets
+
+
+def write_sheet_here(workbook, sheet_name, results, right_to_left=False, companion_folder=None, tab_color=None):
+    """Streams an iterable of DataFrames into sheet XML in this process (rolling over like SB_Excel_Writer)."""
+    rows_per_sheet = SB_Excel_Writer.EXCEL_MAX_ROWS - 1
+    written_sheets = []
+    xml_file = None
+    header = None
+    column_letters = None
+    sheet_format = None
+    column_styles = None
+    rows_in_sheet = 0
+    companion = None
+
+    try:
+        for chunk in SB_Excel_Writer.iter_chunks(results):
+            if header is None:
+                header = [str(column) for column in chunk.columns]
+                column_letters = [get_column_letter(position + 1) for position in range(len(header))]
+                # (formatted by its first chunk as a partial view, like SB_Excel_Writer does)
+                sheet_format = SB_Sheet_Format.make_sheet_format(chunk, header, partial=True)
+                column_styles = get_column_styles(workbook, sheet_format)
+            if companion_folder is not None:
+                if companion is None:
+                    companion = SB_Excel_Writer.open_companion_file(
+                        companion_folder, SB_Excel_Writer.make_sheet_name(workbook, sheet_name), chunk)
+                SB_Excel_Writer.write_companion_chunk(companion, chunk)
+
+            while len(chunk):
+                if xml_file is None or rows_in_sheet == rows_per_sheet:
+                    if xml_file is not None:
+                        finish_sheet_xml(xml_file, sheet_format, rows_in_sheet, len(header))
+                        xml_file.close()
+                    sheet_entry = add_sheet_entry(workbook, sheet_name, len(written_sheets) + 1)
+                    written_sheets.append(sheet_entry['title'])
+                    xml_file = open_sheet_xml(sheet_entry['xml_filename'])
+                    start_sheet_xml(xml_file, header, right_to_left, tab_color, sheet_format)
+                    rows_in_sheet = 0
+                part_rows = chunk.iloc[:rows_per_sheet - rows_in_sheet]
+                write_rows(xml_file, part_rows, rows_in_sheet + 2, column_letters, column_styles)
+                rows_in_sheet += len(part_rows)
+                chunk = chunk.iloc[len(part_rows):]
+
+        # an empty result still gets its sheet
+        if xml_file is None:
+            sheet_entry = add_sheet_entry(workbook, sheet_name, 1)
+            written_sheets.append(sheet_entry['title'])
+            xml_file = open_sheet_xml(sheet_entry['xml_filename'])
+            start_sheet_xml(xml_file, header or [], right_to_left, tab_color, sheet_format)
+        finish_sheet_xml(xml_file, sheet_format, rows_in_sheet, len(header or []))
+    finally:
+        if xml_file is not None:
+            xml_file.close()
+        if companion is not None:
+            SB_Excel_Writer.close_companion_file(companion, keep=len(written_sheets) > 1)
+    return written_sheets
+
+
+def order_sheets(workbook, sheet_titles):
+    """SB_Excel_Writer.order_sheets for a parallel workbook (the sheets not listed stay at the end)."""
+    positions = {sheet_title: position for position, sheet_title in enumerate(sheet_titles)}
+    workbook['sheets'].sort(key=lambda sheet_entry: positions.get(sheet_entry['title'], len(sheet_titles)))
+
+
+def write_error_sheet(sheet_entry, error):
+    """A sheet whose worker failed gets an 'Error' table, like a failed query (the rest of the file is saved)."""
+    print(f"  > !!! FAILED !!! writing sheet '{sheet_entry['title']}': {error}")
+    with open_sheet_xml(sheet_entry['xml_filename']) as xml_file:
+        start_sheet_xml(xml_file, ['Error'])
+        write_rows(xml_file, pd.DataFrame({'Error': [str(error)]}), 2, ['A'])
+        finish_sheet_xml(xml_file)
+
+
+def make_package_parts(sheet_titles, number_formats=()):
+    """The .xlsx parts around the sheets: {path in the zip: XML}."""
+    sheet_numbers = range(1, len(sheet_titles) + 1)
+    sheet_overrides = ''.join(
+        f'<Override PartName="/xl/worksheets/sheet{sheet_number}.xml" '
+        f'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        for sheet_number in sheet_numbers)
+    sheet_elements = ''.join(
+        f'<sheet name={quoteattr(sheet_title)} sheetId="{sheet_number}" r:id="rId{sheet_number}"/>'
+        for sheet_number, sheet_title in zip(sheet_numbers, sheet_titles))
+    sheet_relationships = ''.join(
+        f'<Relationship Id="rId{sheet_number}" Type="{RELATIONSHIPS_NAMESPACE}/worksheet" '
+        f'Target="worksheets/sheet{sheet_number}.xml"/>'
+        for sheet_number in sheet_numbers)
+    xml_declaration = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    created_at = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return {
+        '[Content_Types].xml': (
+            f'{xml_declaration}<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            '<Override PartName="/docProps/core.xml" ContentType="application/vnd.openxmlformats-package.core-properties+xml"/>'
+            '<Override PartName="/docProps/app.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.extended-properties+xml"/>'
+            f'{sheet_overrides}</Types>'),
+        '_rels/.rels': (
+            f'{xml_declaration}<Relationships xmlns="{PACKAGE_RELATIONSHIPS_NAMESPACE}">'
+            f'<Relationship Id="rId1" Type="{RELATIONSHIPS_NAMESPACE}/officeDocument" Target="xl/workbook.xml"/>'
+            '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/package/2006/relationships/metadata/core-properties" '
+            'Target="docProps/core.xml"/>'
+            f'<Relationship Id="rId3" Type="{RELATIONSHIPS_NAMESPACE}/extended-properties" Target="docProps/app.xml"/>'
+            '</Relationships>'),
+        'docProps/core.xml': (
+            f'{xml_declaration}<cp:coreProperties '
+            'xmlns:cp="http://schemas.openxmlformats.org/package/2006/metadata/core-properties" '
+            'xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:dcterms="http://purl.org/dc/terms/" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+            '<dc:creator>Shookbook reports</dc:creator>'
+            f'<dcterms:created xsi:type="dcterms:W3CDTF">{created_at}</dcterms:created>'
+            '</cp:coreProperties>'),
+        'docProps/app.xml': (
+            f'{xml_declaration}<Properties xmlns="http://schemas.openxmlformats.org/officeDocument/2006/extended-properties">'
+            '<Application>Microsoft Excel</Application></Properties>'),
+        'xl/workbook.xml': (
+            f'{xml_declaration}<workbook xmlns="{MAIN_NAMESPACE}" xmlns:r="{RELATIONSHIPS_NAMESPACE}">'
+            f'<bookViews><workbookView activeTab="0"/></bookViews><sheets>{sheet_elements}</sheets></workbook>'),
+        'xl/_rels/workbook.xml.rels': (
+            f'{xml_declaration}<Relationships xmlns="{PACKAGE_RELATIONSHIPS_NAMESPACE}">{sheet_relationships}'
+            f'<Relationship Id="rId{len(sheet_titles) + 1}" Type="{RELATIONSHIPS_NAMESPACE}/styles" Target="styles.xml"/>'
+            '</Relationships>'),
+        'xl/styles.xml': make_styles_xml(number_formats),
+    }
+
+
+def save_workbook(workbook, output_filename):
+    """Waits for the workers and zips the .xlsx (an empty workbook gets a placeholder sheet, like openpyxl's)."""
+    try:
+        for sheet_entry in workbook['sheets']:
+            if sheet_entry['future'] is None:
+                continue
+            try:
+                sheet_entry['future'].result()
+            except Exception as e:
+                write_error_sheet(sheet_entry, e)
+
+        if not workbook['sheets']:
+            sheet_entry = add_sheet_entry(workbook, 'No Data', 1)
+            with open_sheet_xml(sheet_entry['xml_filename']) as xml_file:
+                start_sheet_xml(xml_file, ['Status'])
+                finish_sheet_xml(xml_file)
+
+        package_parts = make_package_parts([sheet_entry['title'] for sheet_entry in workbook['sheets']],
+                                           workbook['number_formats'])
+        with zipfile.ZipFile(output_filename, 'w', compression=zipfile.ZIP_DEFLATED) as xlsx_file:
+            for part_name, part_xml in package_parts.items():
+                xlsx_file.writestr(part_name, part_xml)
+            # (streamed from the temp files, a sheet is never whole in memory)
+            for sheet_number, sheet_entry in enumerate(workbook['sheets'], start=1):
+                xlsx_file.write(sheet_entry['xml_filename'], f"xl/worksheets/sheet{sheet_number}.xml")
+    finally:
+        close_workbook(workbook)
+
+
+def close_workbook(workbook):
+    """Stops the workers and deletes the temp sheets."""
+    workbook['executor'].shutdown(wait=True, cancel_futures=True)
+    shutil.rmtree(workbook['temp_folder'], ignore_errors=True)
@@ -0,0 +1,179 @@
+import math
+import re
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import SB_Derived_Sheets
+
+
+# -----------------------------------------------------------------
+# Preview mode (--preview)
+# -----------------------------------------------------------------
+# Runs the report on a sample of its delivery days, to check the shape of a report
+# in seconds before starting a long (e.g. yearly) run:
+#   - the weekly queries get "o.delivery_date >= 'D' and o.delivery_date < 'D+1' or ..." for the
+#     sampled days in their WHERE. delivery_date is indexed (every report query already reads
+#     its window through it), so the DB reads only the orders of those days - a yearly preview
+#     reads as many orders as a weekly one. (A filter on a computed value, like mod(customer_id, N),
+#     can't use an index: the DB would still read and aggregate the whole window.)
+#   - the daily report writes only the sampled dates (each of them complete)
+#   - the result rows are capped (LIMIT) on the dialects that have it
+#   - the file is named PREVIEW_..., its tabs are orange, and a "PREVIEW" sheet first in the
+#     file lists the sampled days and the totals extrapolated to the whole window
+#     (sample total x window days / sampled days). A sheet that hit the row limit shows only
+#     its sample total, marked, never multiplied.
+# The sampled days are spread evenly over the window. In the customer sheets a customer is
+# seen on the sampled days only (first / last order, number of orders).
+# A preview never writes to the master workbook or the product partials store.
+#
+#     py SB_Weekly_Report.py --preview
+#     py SB_Weekly_Report.py --preview 30      (1 in 30 days)
+
+# days sampled when no rate is given (at most the window's own days)
+PREVIEW_SAMPLE_DAYS = 3
+
+# rows per sheet in a preview
+PREVIEW_ROW_LIMIT = 1000
+
+# tab color of the preview sheets (orange)
+PREVIEW_TAB_COLOR = 'FFC000'
+
+PREVIEW_SHEET_NAME = 'PREVIEW'
+
+# the dialects that end a query with "LIMIT n"
+LIMIT_DIALECTS = ('mysql', 'mariadb', 'postgresql', 'sqlite')
+
+# columns that add up over days, so sample total x (window days / sampled days) estimates the full total
+# (averages, prices, ids and dates are not extrapolated)
+EXTRAPOLATED_COLUMNS = {
+    'number of orders', 'count(o.id)', 'sum(o.sum)', 'order sum', 'sum', 'discount_sum',
+    'total_order_quantity_needed', 'total_order_quantity', 'type_1_quantity',
+    'order quantity', 'delivered quantity', 'missing quantity',
+    'order quantity by client', 'total for q', 'order quantity billed', 'order delivered', 'order replaceable',
+    'orders', 'customers', 'units', 'type 1 units', 'order value', 'discount total', 'revenue',
+    'הכמות הנדרשת', 'Total_Supplied', 'עלות כוללת',
+}
+
+# sheets with one row per order / order line: their row count grows with the days too
+# (a customer sheet has one row per customer, and the same customers come back every week)
+ROWS_PER_ORDER_SHEETS = {'packing', 'weekly - missing in orders', 'weekly with coupons'}
+
+# where the WHERE clause ends (the first of these after it, at the query's top level)
+WHERE_END_PATTERN = r'\b(group\s+by|having|order\s+by|limit)\b|;\s*$'
+
+
+def get_days(start_date, end_date):
+    """All days from start_date to end_date (inclusive) as 'YYYY-MM-DD'."""
+    first_day = datetime.strptime(start_date, '%Y-%m-%d')
+    last_day = datetime.strptime(end_date, '%Y-%m-%d')
+    return [(first_day + timedelta(days=offset)).strftime('%Y-%m-%d')
+            for offset in range((last_day - first_day).days + 1)]
+
+
+def get_sample_days(days, requested_rate=None):
+    """
+    The days a preview reads, spread evenly over the given days: 1 in requested_rate of them,
+    or PREVIEW_SAMPLE_DAYS when no rate is given (so the preview costs the same for any window).
+    """
+    if requested_rate:
+        sample_count = math.ceil(len(days) / max(1, int(requested_rate)))
+    else:
+        sample_count = min(PREVIEW_SAMPLE_DAYS, len(days))
+    if sample_count >= len(days):
+        return list(days)
+    # the middle day of each of sample_count equal parts
+    return [days[int((part + 0.5) * len(days) / sample_count)] for part in range(sample_count)]
+
+
+def get_dialect_name(db_config):
+    """'mysql' from 'mysql+pymysql' / 'mysql+aiomysql' etc."""
+    return (db_config.get('driver') or '').split('+')[0]
+
+
+def get_day_filter(sample_days):
+    """The WHERE condition that reads only the sampled days (each a range on the indexed delivery_date)."""
+    day_ranges = []
+    for day in sample_days:
+        next_day = (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+        day_ranges.append(f"(o.delivery_date >= '{day}' and o.delivery_date < '{next_day}')")
+    return f"({' or '.join(day_ranges)})"
+
+
+def make_preview_query(sql_query, sample_days, dialect, row_limit=PREVIEW_ROW_LIMIT):
+    """
+    Rewrites one report query (single SELECT on orders o) to read only the sampled days,
+    and caps its rows when row_limit is given. The query's own WHERE is kept in parentheses,
+    so its AND / OR still mean the same.
+    """
+    if len(re.findall(r'\bselect\b', sql_query, flags=re.IGNORECASE)) != 1 or not re.search(r'\borders\s+o\b', sql_query):
+        raise ValueError("only a query with a single SELECT on 'orders o' can be previewed")
+    sample_filter = get_day_filter(sample_days)
+
+    where_match = re.search(r'\bwhere\b', sql_query, flags=re.IGNORECASE)
+    if where_match:
+        end_match = re.compile(WHERE_END_PATTERN, flags=re.IGNORECASE).search(sql_query, where_match.end())
+        where_end = end_match.start() if end_match else len(sql_query.rstrip())
+        # the filter goes on its own line, so a comment right after WHERE can't hide it
+        preview_query = (f"{sql_query[:where_match.end()]}\n    {sample_filter} and ("
+                         f"{sql_query[where_match.end():where_end].rstrip()}\n) {sql_query[where_end:]}")
+    else:
+        end_match = re.search(WHERE_END_PATTERN, sql_query, flags=re.IGNORECASE)
+        where_start = end_match.start() if end_match else len(sql_query.rstrip())
+        preview_query = f"{sql_query[:where_start]} where {sample_filter}\n{sql_query[where_start:]}"
+
+    if row_limit and dialect in LIMIT_DIALECTS and not re.search(r'\blimit\b', preview_query, flags=re.IGNORECASE):
+        preview_query = f"{preview_query.rstrip().rstrip(';')}\nlimit {int(row_limit)}"
+    return preview_query
+
+
+def make_preview_queries(all_queries, sample_days, dialect, row_limit=PREVIEW_ROW_LIMIT):
+    """make_preview_query for every query template of a report ({name: sql})."""
+    return {query_name: make_preview_query(sql_query, sample_days, dialect, row_limit)
+            for query_name, sql_query in all_queries.items()}
+
+
+def extrapolate_totals(results, sample_days, window_days, row_limit=PREVIEW_ROW_LIMIT):
+    """
+    The "PREVIEW" sheet: per sheet and additive column, the sample total and the estimated
+    full total (x window_days / sampled days). A sheet that hit the row limit is missing rows
+    of the sample itself, so it only shows its sample total, marked, and no estimate.
+    """
+    scale = window_days / len(sample_days)
+    # a derived sheet (SB_Derived_Sheets.py) is only as complete as the sheet it comes from
+    limited_sheets = {sheet_name for sheet_name, results_table_df in results.items()
+                      if row_limit and len(results_table_df) >= row_limit}
+    limited_sheets |= {derived_sheet_name for derived_sheet_name, (source_name, _) in SB_Derived_Sheets.DERIVED_SHEETS.items()
+                       if source_name in limited_sheets}
+
+    total_rows = []
+    for sheet_name, results_table_df in results.items():
+        if list(results_table_df.columns) == ['Error']:
+            continue
+        limit_reached = sheet_name in limited_sheets
+        note = f"row limit reached - total of the first {row_limit} rows only, not extrapolated" if limit_reached else ''
+        if sheet_name in ROWS_PER_ORDER_SHEETS:
+            total_rows.append([sheet_name, 'rows', len(results_table_df),
+                               None if limit_reached else round(len(results_table_df) * scale), note])
+        # by position: some sheets have the same column name more than once ("total for q")
+        for position, column in enumerate(results_table_df.columns):
+            if column not in EXTRAPOLATED_COLUMNS:
+                continue
+            values = pd.to_numeric(results_table_df.iloc[:, position], errors='coerce')
+            sample_total = values.sum()
+            total_rows.append([sheet_name, column, sample_total, None if limit_reached else sample_total * scale, note])
+    return pd.DataFrame(total_rows, columns=['sheet', 'column', 'sample total', 'estimated total', 'note'])
+
+
+def make_preview_sheet(results, sample_days, window_days, row_limit=PREVIEW_ROW_LIMIT):
+    """The "PREVIEW" sheet: what the file is, then the extrapolated totals."""
+    notes_df = pd.DataFrame([
+        [PREVIEW_SHEET_NAME, 'sample', f"{len(sample_days)} of {window_days} days: {', '.join(sample_days)}", '', ''],
+        [PREVIEW_SHEET_NAME, 'row limit', row_limit or 'none', '', 'NOT the real report - run without --preview'],
+    ], columns=['sheet', 'column', 'sample total', 'estimated total', 'note'])
+    return pd.concat([notes_df, extrapolate_totals(results, sample_days, window_days, row_limit)], ignore_index=True)
+
+
+def get_preview_filename(output_filename):
+    """PREVIEW_<the report's file name>, so a preview is never mistaken for the report."""
+    return f"PREVIEW_{output_filename}"
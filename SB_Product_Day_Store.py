@@ -0,0 +1,264 @@
+import argparse
+import os
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import SB_DB_Governor
+import SB_Daily_Partials
+import SB_Excel_Writer
+import SB_Shared_Facts
+
+
+# -----------------------------------------------------------------
+# Product x day partials store
+# -----------------------------------------------------------------
+# A local folder with one small Parquet file per delivery day, holding that day's
+# product partials (SB_Daily_Partials.PRODUCT_DAY_PARTIALS_SQL: quantities needed /
+# billed / delivered / replaceable and their value at unit_price, per product,
+# delivery window, status and store):
+#
+#   product_day_partials/
+#       shop_3f2a9c1b07/                 (one folder per database, SB_DB_Governor.get_db_folder_name)
+#           2025/2025-11-02.parquet
+#           2025/2025-11-03.parquet
+#           ...
+#
+# A day is only ever used for the database it was read from: the stand-in DB, a replica of
+# another DB or a test database each get their own folder, and every file also names its
+# database in its metadata (a file of another DB is read again, never used).
+#
+# The daily sales report fills it as it runs, and the product sheets of any window
+# (a week, a month, a year) are rolled up from it; only days that are missing or
+# not final yet are read from the DB.
+#
+#     py SB_Product_Day_Store.py rollup 2025-01-01 2025-06-30 --by month
+#     py SB_Weekly_Report.py --product-partials
+#
+# Optional .env settings:
+#   SB_PARTIALS_FOLDER          where the store is [product_day_partials next to the scripts]
+#   SB_PARTIALS_SETTLE_DAYS     a stored day is final when it was read this many days after
+#                               its delivery date (orders still change until then) [2]
+#   SB_PARTIALS_FRESH_MINUTES   a day that isn't final yet is still used if it was read in the
+#                               last N minutes (e.g. by the previous date of the same run) [10]
+
+# the time a day was read from the DB and the DB it was read from, kept in each file's Parquet metadata
+READ_AT_KEY = b'read_at'
+DB_IDENTITY_KEY = b'db_identity'
+
+# the columns of SB_Daily_Partials.PRODUCT_DAY_PARTIALS_SQL (for a window without any order)
+PRODUCT_DAY_COLUMNS = [
+    'product_id', 'product_name', 'product_name_heb', 'product_price', 'product_low_cost_price', 'product_list',
+    'category_id', 'category_row_id', 'category_name', 'delivery_date', 'delivery_window', 'status', 'store_id',
+    'line_count', 'order_price', 'unit_price_sum', 'unit_price_count', 'quantity_needed', 'quantity',
+    'quantity_delivered', 'quantity_replaceable', 'needed_value', 'billed_value', 'delivered_value',
+    'replaceable_value',
+]
+
+
+def get_store_settings(db_identity=None):
+    """Reads the store settings from the environment (.env); db_identity is the DB whose days are used."""
+    default_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'product_day_partials')
+    return {
+        'folder': os.getenv('SB_PARTIALS_FOLDER') or default_folder,
+        'settle_days': int(os.getenv('SB_PARTIALS_SETTLE_DAYS') or 2),
+        'fresh_minutes': float(os.getenv('SB_PARTIALS_FRESH_MINUTES') or 10),
+        'db_identity': db_identity,
+    }
+
+
+def get_db_identity(governor):
+    """The DB the governor reads (SB_DB_Governor.get_db_identity), or the scripts' DB_CONFIG's without a governor."""
+    if governor is not None:
+        return governor['db_identity']
+    return SB_DB_Governor.get_db_identity(get_db_config())
+
+
+def get_day_filename(settings, day):
+    """The store file of one delivery day ('YYYY-MM-DD') of the settings' DB."""
+    return os.path.join(settings['folder'], SB_DB_Governor.get_db_folder_name(settings['db_identity']),
+                        day[:4], f"{day}.parquet")
+
+
+def get_days(start_date, end_date):
+    """All days from start_date to end_date (inclusive) as 'YYYY-MM-DD'."""
+    first_day = datetime.strptime(start_date, '%Y-%m-%d')
+    last_day = datetime.strptime(end_date, '%Y-%m-%d')
+    return [(first_day + timedelta(days=offset)).strftime('%Y-%m-%d')
+            for offset in range((last_day - first_day).days + 1)]
+
+
+def get_spans(days):
+    """Groups sorted days into continuous (start, end) spans, so missing days are read in as few queries as possible."""
+    spans = []
+    for day in days:
+        if spans and datetime.strptime(day, '%Y-%m-%d') == datetime.strptime(spans[-1][1], '%Y-%m-%d') + timedelta(days=1):
+            spans[-1] = (spans[-1][0], day)
+        else:
+            spans.append((day, day))
+    return spans
+
+
+def is_day_usable(settings, day, read_at, now):
+    """A stored day can be used when it's final (read settle_days after delivery) or was read moments ago."""
+    settled_at = datetime.strptime(day, '%Y-%m-%d') + timedelta(days=settings['settle_days'])
+    return read_at >= settled_at or now - read_at <= timedelta(minutes=settings['fresh_minutes'])
+
+
+def save_product_days(product_days_df, start_date, end_date, settings=None):
+    """
+    Stores the partials read for start_date..end_date from the settings' DB, one file per day (days
+    without orders get an empty file, so we know they were read). Each file is replaced atomically.
+    """
+    read_at = datetime.now().isoformat(timespec='seconds')
+    days = pd.to_datetime(product_days_df['delivery_date']).dt.strftime('%Y-%m-%d')
+    for day in get_days(start_date, end_date):
+        day_filename = get_day_filename(settings, day)
+        os.makedirs(os.path.dirname(day_filename), exist_ok=True)
+        table = pa.Table.from_pandas(product_days_df[days == day], preserve_index=False)
+        table = table.replace_schema_metadata({
+            **(table.schema.metadata or {}),
+            READ_AT_KEY: read_at.encode(),
+            DB_IDENTITY_KEY: settings['db_identity'].encode(),
+        })
+        temp_filename = f"{day_filename}.{os.getpid()}.tmp"
+        pq.write_table(table, temp_filename, compression='zstd')
+        os.replace(temp_filename, day_filename)
+
+
+def load_stored_days(start_date, end_date, settings):
+    """Returns (the usable stored partials of the settings' DB as one DataFrame, the days that have to be read from the DB)."""
+    now = datetime.now()
+    stored_tables = []
+    days_to_read = []
+    for day in get_days(start_date, end_date):
+        day_filename = get_day_filename(settings, day)
+        try:
+            table = pq.read_table(day_filename)
+            read_at = datetime.fromisoformat(table.schema.metadata[READ_AT_KEY].decode())
+            db_identity = table.schema.metadata[DB_IDENTITY_KEY].decode()
+        except (OSError, KeyError, TypeError, ValueError):
+            # not stored yet, or a file we can't read - read the day again
+            days_to_read.append(day)
+            continue
+        if db_identity == settings['db_identity'] and is_day_usable(settings, day, read_at, now):
+            stored_tables.append(table)
+        else:
+            days_to_read.append(day)
+
+    stored_df = None
+    if stored_tables:
+        stored_df = pa.concat_tables(stored_tables, promote_options='permissive').to_pandas()
+    return stored_df, days_to_read
+
+
+def load_product_days(governor, start_date, end_date):
+    """
+    The product partials of start_date..end_date (with the 'delivery_day' column), from the store
+    where possible; missing / not final days are read from the DB through the governor and stored.
+    governor can be None when everything may already be stored - one is created only if needed.
+    """
+    settings = get_store_settings(get_db_identity(governor))
+    stored_df, days_to_read = load_stored_days(start_date, end_date, settings)
+    partial_dfs = [stored_df] if stored_df is not None else []
+
+    if days_to_read:
+        spans = get_spans(days_to_read)
+        print(f"  > Product partials: {len(days_to_read)} day(s) to read from the DB, "
+              f"{len(get_days(start_date, end_date)) - len(days_to_read)} from the store.")
+        if governor is None:
+            missing_config = SB_DB_Governor.get_missing_config(get_db_config())
+            if missing_config:
+                raise RuntimeError(f"Missing connection info: {', '.join(missing_config)}")
+            governor = SB_DB_Governor.create_governor(get_db_config())
+        for span_start, span_end in spans:
+            span_df = SB_DB_Governor.read_sql(
+                governor, SB_Daily_Partials.format_partial_query('product_days', span_start, span_end))
+            save_product_days(span_df, span_start, span_end, settings)
+            partial_dfs.append(span_df)
+    else:
+        print(f"  > Product partials: all {len(get_days(start_date, end_date))} day(s) from the store.")
+
+    partial_dfs = [partial_df for partial_df in partial_dfs if not partial_df.empty]
+    if not partial_dfs:
+        # a window without any order still needs the columns
+        partial_dfs = [pd.DataFrame(columns=PRODUCT_DAY_COLUMNS)]
+    return SB_Daily_Partials.prepare_partials(pd.concat(partial_dfs, ignore_index=True))
+
+
+def get_db_config():
+    """The report scripts' DB_CONFIG (for a run from the command line, which has no governor yet)."""
+    # imported here: the daily script imports this module
+    import SB_Weekly_Report
+    return SB_Weekly_Report.DB_CONFIG
+
+
+# -----------------------------------------------------------------
+# Weekly / monthly product sheets
+# -----------------------------------------------------------------
+
+def get_rollup_windows(start_date, end_date, by):
+    """Splits start_date..end_date into weeks (from start_date, 7 days each) or calendar months."""
+    windows = []
+    window_start = datetime.strptime(start_date, '%Y-%m-%d')
+    last_day = datetime.strptime(end_date, '%Y-%m-%d')
+    while window_start <= last_day:
+        if by == 'week':
+            window_end = window_start + timedelta(days=6)
+        else:
+            next_month = (window_start.replace(day=1) + timedelta(days=32)).replace(day=1)
+            window_end = next_month - timedelta(days=1)
+        window_end = min(window_end, last_day)
+        windows.append((window_start.strftime('%Y-%m-%d'), window_end.strftime('%Y-%m-%d')))
+        window_start = window_end + timedelta(days=1)
+    return windows
+
+
+def rollup_product_sheets(product_days, start_date, end_date, by='week'):
+    """One "weekly products" style sheet per week / month; returns {sheet name: DataFrame}."""
+    product_sheets = {}
+    for window_start, window_end in get_rollup_windows(start_date, end_date, by):
+        sheet_name = window_start[:7] if by == 'month' else window_start
+        product_sheets[sheet_name] = SB_Shared_Facts.derive_weekly_products(
+            product_days, {'START_DATE': window_start, 'END_DATE': window_end})
+    return product_sheets
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Product sheets rolled up from the product x day partials store")
+    commands = parser.add_subparsers(dest='command', required=True)
+    rollup_parser = commands.add_parser('rollup', help="write a workbook with one product sheet per week / month")
+    rollup_parser.add_argument('start_date', help="YYYY-MM-DD")
+    rollup_parser.add_argument('end_date', help="YYYY-MM-DD")
+    rollup_parser.add_argument('--by', choices=['week', 'month'], default='month', help="one sheet per ... [month]")
+    rollup_parser.add_argument('--output', help="output file [Shookbook_products_by_<week|month>_<start>_to_<end>.xlsx]")
+    return parser.parse_args()
+
+
+def main():
+    # imported here: only the command line needs the .env of the report scripts
+    from dotenv import load_dotenv
+    load_dotenv()
+    args = parse_args()
+
+    print(f"--- Product sheets by {args.by}: {args.start_date} to {args.end_date} ---")
+    try:
+        product_days = load_product_days(None, args.start_date, args.end_date)
+    except Exception as e:
+        print(f"    > !!! FAILED !!! Reading product partials failed: {e}")
+        return
+
+    product_sheets = rollup_product_sheets(product_days, args.start_date, args.end_date, args.by)
+    output_filename = args.output or f"Shookbook_products_by_{args.by}_{args.start_date}_to_{args.end_date}.xlsx"
+    workbook = SB_Excel_Writer.open_workbook()
+    for sheet_name, product_sheet_df in product_sheets.items():
+        SB_Excel_Writer.write_sheet(workbook, sheet_name, product_sheet_df)
+    SB_Excel_Writer.save_workbook(workbook, output_filename)
+    print(f"    > File saved: {output_filename} ({len(product_sheets)} sheets)")
+
+
+# Running the main function
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+# -----------------------------------------------------------------
+# Per-stage profiling (--profile)
+# -----------------------------------------------------------------
+# When a script runs with --profile, every stage of the run (imports, config,
+# connect, each query fetch, each sheet write, workbook save) is measured with:
+#   - wall clock and CPU time
+#   - peak and net memory (tracemalloc)
+#   - a cProfile of the functions called during the stage
+# At the end we write:
+#   <report name>_profile.txt   per-stage summary + the slowest functions
+#   <report name>_profile.prof  all stages' cProfile data, opens in snakeviz / pstats / gprof2dot
+#
+# This module only uses the standard library, so it can be imported before
+# pandas/SQLAlchemy and measure their import time too.
+# (tracemalloc makes the run itself noticeably slower - use --profile to find where
+# the time goes, not to time a normal run.)
+
+PROFILE_ENABLED = False
+
+# one dict per finished stage, in the order they finished
+finished_stages = []
+stages_lock = threading.Lock()
+
+# the stage opened with begin_stage() (used for module level code: imports, config)
+open_module_stage = None
+
+
+def enable_if_requested():
+    """Turns profiling on when '--profile' is on the command line. Call before the heavy imports."""
+    global PROFILE_ENABLED
+    if '--profile' in sys.argv and not PROFILE_ENABLED:
+        PROFILE_ENABLED = True
+        tracemalloc.start()
+    return PROFILE_ENABLED
+
+
+def start_stage(stage_name):
+    """Starts measuring a stage; returns the record that finish_stage() completes (None when profiling is off)."""
+    if not PROFILE_ENABLED:
+        return None
+
+    stage = {
+        'stage': stage_name,
+        'thread': threading.current_thread().name,
+        'start_memory': tracemalloc.get_traced_memory()[0],
+        'start_wall': time.perf_counter(),
+        'start_cpu': time.thread_time(),
+        'profiler': cProfile.Profile(),
+    }
+    tracemalloc.reset_peak()
+    try:
+        stage['profiler'].enable()
+    except ValueError:
+        # only one cProfile can be active at a time on newer Pythons (e.g. queries running in parallel);
+        # the stage still gets its time and memory numbers
+        stage['profiler'] = None
+    return stage
+
+
+def finish_stage(stage):
+    """Stops measuring a stage and keeps its numbers for the report."""
+    if stage is None:
+        return
+    if stage['profiler'] is not None:
+        stage['profiler'].disable()
+
+    current_memory, peak_memory = tracemalloc.get_traced_memory()
+    stage.update({
+        'wall_seconds': time.perf_counter() - stage['start_wall'],
+        'cpu_seconds': time.thread_time() - stage['start_cpu'],
+        'peak_mb': max(peak_memory - stage['start_memory'], 0) / 1024 / 1024,
+        'net_mb': (current_memory - stage['start_memory']) / 1024 / 1024,
+    })
+    with stages_lock:
+        finished_stages.append(stage)
+
+
+@contextmanager
+def profile_stage(stage_name):
+    """Measures the code inside the 'with' block as one stage (does nothing when profiling is off)."""
+    stage = start_stage(stage_name)
+    try:
+        yield
+    finally:
+        finish_stage(stage)
+
+
+def begin_stage(stage_name):
+    """
+    For module level code that can't be wrapped in a 'with' block (imports, load_dotenv):
+    finishes the previous module stage, if any, and starts a new one.
+    """
+    global open_module_stage
+    end_stage()
+    open_module_stage = start_stage(stage_name)
+
+
+def end_stage():
+    """Finishes the stage opened with begin_stage()."""
+    global open_module_stage
+    finish_stage(open_module_stage)
+    open_module_stage = None
+
+
+def write_profile_report(report_name, top_functions=30):
+    """Writes <report_name>_profile.txt and <report_name>_profile.prof; returns their names."""
+    if not PROFILE_ENABLED:
+        return None
+    end_stage()
+
+    summary_filename = f"{report_name}_profile.txt"
+    dump_filename = f"{report_name}_profile.prof"
+
+    # all stages' cProfile data in one dump
+    combined_stats = None
+    for stage in finished_stages:
+        if stage['profiler'] is None:
+            continue
+        try:
+            if combined_stats is None:
+                combined_stats = pstats.Stats(stage['profiler'])
+            else:
+                combined_stats.add(stage['profiler'])
+        except TypeError:
+            # a stage too short to record any call
+            continue
+    if combined_stats is not None:
+        combined_stats.dump_stats(dump_filename)
+
+    lines = [
+        f"Profile of {report_name}",
+        "",
+        f"{'stage':<45} {'wall s':>9} {'cpu s':>9} {'peak MB':>9} {'net MB':>9}",
+        "-" * 85,
+    ]
+    for stage in finished_stages:
+        lines.append(
+            f"{stage['stage'][:45]:<45} {stage['wall_seconds']:>9.3f} {stage['cpu_seconds']:>9.3f} "
+            f"{stage['peak_mb']:>9.1f} {stage['net_mb']:>9.1f}")
+    lines.append("-" * 85)
+    lines.append(
+        f"{'total (stages)':<45} {sum(stage['wall_seconds'] for stage in finished_stages):>9.3f} "
+        f"{sum(stage['cpu_seconds'] for stage in finished_stages):>9.3f}")
+    lines.append("")
+    lines.append("cpu s is the CPU time of the thread that ran the stage; stages that ran in parallel")
+    lines.append("share one memory peak, so their peak MB can include each other's allocations.")
+
+    if combined_stats is not None:
+        functions_output = io.StringIO()
+        combined_stats.stream = functions_output
+        combined_stats.sort_stats('cumulative').print_stats(top_functions)
+        lines.append("")
+        lines.append(f"Top {top_functions} functions by cumulative time (all stages):")
+        lines.append(functions_output.getvalue())
+
+    with open(summary_filename, 'w', encoding='utf-8') as summary_file:
+        summary_file.write("\n".join(lines))
+
+    print("\n".join(lines[:len(finished_stages) + 6]))
+    print(f"Profile saved: {summary_filename}" + (f", {dump_filename}" if combined_stats is not None else ""))
+    return summary_filename, dump_filename
@@ -0,0 +1,421 @@
+import hashlib
+import json
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import SB_DB_Governor
+import SB_Memory_Budget
+import SB_Run_Store
+
+
+# -----------------------------------------------------------------
+# Adaptive query planner
+# -----------------------------------------------------------------
+# A sheet of 5 rows ("weekly_zones_by_desc") and one of a million ("weekly - missing in orders")
+# don't have to run the same way. Before the weekly report's queries run, each one gets a plan:
+#
+#   1. an estimate of how many rows it returns and how long it takes, from
+#        - the DB's own estimate (EXPLAIN, on MySQL / PostgreSQL), corrected by how far off it was before
+#        - the number of orders in the window (one cheap count(*)) x the rows per order of past runs
+#        - the seconds per row of past runs
+#   2. a strategy:
+#        cache    the same query (same SQL, same dates) already ran after its window's data had settled,
+#                 and that result is still in a kept run (SB_Run_Store.py) - it's read from there, no DB
+#        sharded  a slow query whose rows each belong to one day (shardable = true in the spec): the window
+#                 is cut into day ranges that run at the same time (up to DB_MAX_CONCURRENT_QUERIES)
+#        stream   a big result: read in chunks from a server side cursor straight to disk (SB_Memory_Budget.py),
+#                 never whole in memory - not on the client and not in the DB driver either
+#        memory   everything else - one read_sql, as before
+#
+# After the run, every query's strategy, estimate, actual rows and seconds are added to the history
+# file, so the next run's estimates are based on them. Every record says which database it ran on
+# (driver / host / port / name, SB_DB_Governor.get_db_identity), and a run only uses the records -
+# and the cached results - of its own database, so e.g. a run on a stand-in DB is never served to production. A query without history (and without EXPLAIN,
+# e.g. on SQLite) runs in memory, and is planned from its own numbers next time.
+#
+# Optional .env settings (defaults in brackets):
+#   SB_PLANNER                  set to 0 to run every query in memory, as before (or --no-plan)
+#   SB_PLAN_HISTORY             the history file [query_plans.json next to the scripts]
+#   SB_PLAN_HISTORY_RUNS        runs kept in the history per sheet and DB [20]
+#   SB_PLAN_STREAM_ROWS         estimated rows from which a result is streamed to disk [500000]
+#   SB_PLAN_SHARD_SECONDS       estimated seconds from which a shardable query is split by day [60]
+#   SB_PLAN_CACHE_SETTLED_DAYS  days after a window's end its orders no longer change [14]
+
+# the window's size, for the rows-per-order estimate
+WINDOW_ORDERS_SQL = "select count(*) from orders o where o.delivery_date BETWEEN '{START_DATE}' and '{END_DATE}'"
+
+# the DB's own row estimates
+EXPLAIN_PREFIXES = {
+    'mysql': "EXPLAIN ",
+    'postgresql': "EXPLAIN (FORMAT JSON) ",
+}
+
+
+def is_enabled():
+    return (os.getenv('SB_PLANNER') or '1') != '0'
+
+
+def get_settings():
+    """Reads the planner settings from the environment (.env)."""
+    return {
+        'stream_rows': int(os.getenv('SB_PLAN_STREAM_ROWS') or 500000),
+        'shard_seconds': float(os.getenv('SB_PLAN_SHARD_SECONDS') or 60),
+        'cache_settled_days': int(os.getenv('SB_PLAN_CACHE_SETTLED_DAYS') or 14),
+        'history_runs': int(os.getenv('SB_PLAN_HISTORY_RUNS') or 20),
+    }
+
+
+# -----------------------------------------------------------------
+# History file
+# -----------------------------------------------------------------
+
+def get_history_filename():
+    default_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'query_plans.json')
+    return os.getenv('SB_PLAN_HISTORY') or default_filename
+
+
+def load_history():
+    """{sheet name: [one record per run, oldest first]}; a missing or broken file is an empty history."""
+    try:
+        with open(get_history_filename(), encoding='utf-8') as history_file:
+            return json.load(history_file)
+    except FileNotFoundError:
+        return {}
+    except (ValueError, OSError) as e:
+        print(f"    > Could not read the query plan history, starting a new one: {e}")
+        return {}
+
+
+def save_history(history):
+    """Written to a temp file and swapped in, so a run reading it never sees half a file."""
+    history_filename = get_history_filename()
+    temp_filename = f"{history_filename}.{os.getpid()}.tmp"
+    with open(temp_filename, 'w', encoding='utf-8') as history_file:
+        json.dump(history, history_file, ensure_ascii=False, indent=1)
+    os.replace(temp_filename, history_filename)
+
+
+def make_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+# -----------------------------------------------------------------
+# Estimates
+# -----------------------------------------------------------------
+
+def get_window_days(variables):
+    start_day = datetime.strptime(variables['START_DATE'], '%Y-%m-%d')
+    end_day = datetime.strptime(variables['END_DATE'], '%Y-%m-%d')
+    return (end_day - start_day).days + 1
+
+
+def count_window_orders(governor, variables):
+    """Orders in the window (None when the count fails - the estimate then does without it)."""
+    try:
+        return int(SB_DB_Governor.read_sql(governor, WINDOW_ORDERS_SQL.format_map(variables)).iloc[0, 0])
+    except Exception as e:
+        print(f"    > Could not count the window's orders for the plan: {e}")
+        return None
+
+
+def get_explain_rows(governor, formatted_query):
+    """The DB's estimate of the rows a query reads / returns (None where EXPLAIN gives none, e.g. SQLite)."""
+    explain_prefix = EXPLAIN_PREFIXES.get(governor['dialect'])
+    if explain_prefix is None:
+        return None
+    try:
+        explain_df = SB_DB_Governor.read_sql(governor, explain_prefix + formatted_query.strip().rstrip(';'))
+        if governor['dialect'] == 'postgresql':
+            query_plan = explain_df.iloc[0, 0]
+            if isinstance(query_plan, str):
+                query_plan = json.loads(query_plan)
+            return float(query_plan[0]['Plan']['Plan Rows'])
+        # MySQL: one line per table of the join, the join's rows are their rows x filtered %
+        explain_rows = 1.0
+        for _, explain_line in explain_df.iterrows():
+            if pd.notna(explain_line.get('rows')):
+                filtered = explain_line.get('filtered')
+                explain_rows *= float(explain_line['rows']) * (float(filtered) / 100 if pd.notna(filtered) else 1)
+        return explain_rows
+    except Exception as e:
+        print(f"    > No EXPLAIN estimate: {e}")
+        return None
+
+
+def get_median_ratio(records, numerator, denominator):
+    """The median of numerator / denominator over the past runs that have both."""
+    ratios = [record[numerator] / record[denominator] for record in records
+              if record.get(numerator) is not None and record.get(denominator)]
+    return statistics.median(ratios) if ratios else None
+
+
+def estimate_rows(records, explain_rows, window_orders, window_days):
+    """(estimated rows, where the estimate comes from) - (None, 'none') with nothing to go on."""
+    explain_correction = get_median_ratio(records, 'rows', 'explain_rows')
+    if explain_rows is not None and explain_correction is not None:
+        return explain_rows * explain_correction, 'explain x history'
+    rows_per_order = get_median_ratio(records, 'rows', 'window_orders')
+    if window_orders is not None and rows_per_order is not None:
+        return window_orders * rows_per_order, 'orders x history'
+    if explain_rows is not None:
+        return explain_rows, 'explain'
+    rows_per_day = get_median_ratio(records, 'rows', 'window_days')
+    if rows_per_day is not None:
+        return rows_per_day * window_days, 'days x history'
+    return None, 'none'
+
+
+def estimate_seconds(records, rows):
+    """Estimated seconds: the rows x the past runs' seconds per row (from the runs that went to the DB)."""
+    # (a sharded run is counted as its day ranges one after the other, so the next plan compares like with like)
+    db_seconds = [(record['seconds'] * record.get('shards', 1), record['rows'])
+                  for record in records if record['strategy'] != 'cache']
+    if not db_seconds:
+        return None
+    if rows is None:
+        return statistics.median(seconds for seconds, _ in db_seconds)
+    return rows * statistics.median(seconds / max(record_rows, 1) for seconds, record_rows in db_seconds)
+
+
+def find_cached_run(records, db_identity, query_hash, window_end, settings):
+    """A kept run holding this exact query's result on this DB, read after the window settled (None if there is none)."""
+    settled_at = datetime.strptime(window_end, '%Y-%m-%d') + timedelta(days=settings['cache_settled_days'] + 1)
+    for record in reversed(records):
+        if record.get('db') != db_identity or record['query_hash'] != query_hash or not record.get('run'):
+            continue
+        if datetime.fromisoformat(record['at']) < settled_at:
+            continue
+        try:
+            _, manifest = SB_Run_Store.load_manifest(record['run'])
+        except (OSError, ValueError):
+            # the run was pruned
+            continue
+        # a run kept again since under the same name (maybe on another DB) is not this record's run
+        if manifest['created_at'] != record.get('run_created_at'):
+            continue
+        if any(sheet_entry['name'] == record['sheet'] and sheet_entry['rows'] == record['rows']
+               for sheet_entry in manifest['sheets']):
+            return record['run']
+    return None
+
+
+# -----------------------------------------------------------------
+# Planning
+# -----------------------------------------------------------------
+
+def plan_query(governor, spec_sheet, sheet_name, sql_query, variables, records, window_orders, settings):
+    """The plan of one query: its estimates and its strategy (with the reason)."""
+    formatted_query = sql_query.format_map(variables)
+    query_hash = make_hash(formatted_query)
+    window_days = get_window_days(variables)
+    explain_rows = get_explain_rows(governor, formatted_query)
+    rows, estimate_source = estimate_rows(records, explain_rows, window_orders, window_days)
+    seconds = estimate_seconds(records, rows)
+    query_plan = {
+        'sheet': sheet_name,
+        'db': governor['db_identity'],
+        'template_hash': make_hash(sql_query),
+        'query_hash': query_hash,
+        'window_end': variables['END_DATE'],
+        'window_days': window_days,
+        'window_orders': window_orders,
+        'explain_rows': explain_rows,
+        'estimated_rows': None if rows is None else int(rows),
+        'estimate_source': estimate_source,
+        'estimated_seconds': seconds,
+        'shards': 1,
+        'cached_run': None,
+    }
+
+    cached_run = find_cached_run(records, governor['db_identity'], query_hash, variables['END_DATE'], settings)
+    max_shards = min(governor['settings']['max_concurrent_queries'], window_days)
+    if cached_run is not None:
+        query_plan.update(strategy='cache', cached_run=cached_run, reason="same query, settled window")
+    elif rows is not None and rows >= settings['stream_rows']:
+        query_plan.update(strategy='stream', reason=f"over {settings['stream_rows']:,} rows")
+    elif (spec_sheet.get('shardable') and max_shards > 1
+          and seconds is not None and seconds >= settings['shard_seconds']):
+        query_plan.update(strategy='sharded', shards=max_shards, reason=f"over {settings['shard_seconds']:g}s")
+    else:
+        query_plan.update(strategy='memory', reason="no history yet" if rows is None else "small")
+    return query_plan
+
+
+def plan_queries(governor, spec, report_queries, DATE_RANGE, budget=None):
+    """
+    Plans every query of the run ({sheet name: SQL template}). Returns the plan the queries run with
+    (run_planned_query) and that finish_plan() adds to the history.
+    """
+    # imported here: SB_Report_Spec imports the writer modules, the planner only needs the sheet variables
+    import SB_Report_Spec
+
+    settings = get_settings()
+    history = load_history()
+    window_orders_by_window = {}
+    query_plans = {}
+    for sheet_name, sql_query in report_queries.items():
+        variables = SB_Report_Spec.get_sheet_variables(spec, sheet_name, DATE_RANGE)
+        # (only the past runs of this query on this DB - the records of older versions had no 'db', they're left out)
+        records = [record for record in history.get(sheet_name, [])
+                   if record.get('db') == governor['db_identity'] and record['template_hash'] == make_hash(sql_query)]
+        window = (variables['START_DATE'], variables['END_DATE'])
+        # (one count per window - the sheets with their own window_days get theirs)
+        if window not in window_orders_by_window:
+            window_orders_by_window[window] = count_window_orders(governor, variables)
+        query_plans[sheet_name] = plan_query(governor, spec['sheets'].get(sheet_name, {}), sheet_name, sql_query,
+                                             variables, records, window_orders_by_window.get(window), settings)
+    return {
+        'settings': settings,
+        'queries': query_plans,
+        'order_by': {sheet_name: spec['sheets'][sheet_name].get('order_by') for sheet_name in query_plans
+                     if sheet_name in spec['sheets']},
+        # the run's memory budget, if any; 'stream' plans without one get a budget of 0 bytes
+        'budget': budget,
+        'stream_budget': None,
+        'records': [],
+        'lock': threading.Lock(),
+    }
+
+
+def print_plan(plan):
+    print("\nQuery plan (see SB_Query_Planner.py):")
+    for query_plan in plan['queries'].values():
+        rows = '?' if query_plan['estimated_rows'] is None else f"{query_plan['estimated_rows']:,}"
+        seconds = '' if query_plan['estimated_seconds'] is None else f", ~{query_plan['estimated_seconds']:.1f}s"
+        strategy = query_plan['strategy']
+        if strategy == 'sharded':
+            strategy = f"sharded x{query_plan['shards']}"
+        print(f"  {query_plan['sheet'][:30]:<30} {strategy:<11} ~{rows} rows{seconds} "
+              f"({query_plan['estimate_source']}; {query_plan['reason']})")
+
+
+# -----------------------------------------------------------------
+# Running the plans
+# -----------------------------------------------------------------
+
+def split_window(variables, shards):
+    """The window's days cut into 'shards' consecutive day ranges (as START_DATE / END_DATE variables)."""
+    start_day = datetime.strptime(variables['START_DATE'], '%Y-%m-%d')
+    window_days = get_window_days(variables)
+    shard_variables = []
+    first_day = 0
+    for shard_number in range(shards):
+        last_day = (shard_number + 1) * window_days // shards - 1
+        shard_variables.append({
+            **variables,
+            'START_DATE': (start_day + timedelta(days=first_day)).strftime('%Y-%m-%d'),
+            'END_DATE': (start_day + timedelta(days=last_day)).strftime('%Y-%m-%d'),
+        })
+        first_day = last_day + 1
+    return shard_variables
+
+
+def sort_combined(combined_df, order_by):
+    """Sorts the combined day ranges like the query's ORDER BY ("order id desc" -> by "order id", descending)."""
+    if not order_by:
+        return combined_df
+    column, _, direction = order_by.strip().rpartition(' ')
+    if direction.lower() not in ('asc', 'desc'):
+        column, direction = order_by.strip(), 'asc'
+    if column not in combined_df.columns:
+        raise KeyError(f"order_by column '{column}' is not in the results")
+    return combined_df.sort_values(column, ascending=direction.lower() == 'asc', kind='stable', ignore_index=True)
+
+
+def run_sharded(governor, sql_query, variables, shards, order_by):
+    """Runs the query on each day range at the same time (the governor's slots limit how many) and combines them."""
+    shard_variables = split_window(variables, shards)
+    with ThreadPoolExecutor(max_workers=shards) as executor:
+        running_shards = [executor.submit(SB_DB_Governor.read_sql, governor, sql_query.format_map(one_shard))
+                          for one_shard in shard_variables]
+        shard_results = [running_shard.result() for running_shard in running_shards]
+    return sort_combined(pd.concat(shard_results, ignore_index=True), order_by)
+
+
+def read_cached_result(run_name, sheet_name):
+    """The sheet's result from a kept run, as a DataFrame."""
+    table = SB_Run_Store.load_run_tables(run_name, [sheet_name])[sheet_name]
+    if table.num_rows == 0:
+        return pd.DataFrame(columns=table.column_names)
+    return pd.concat(list(SB_Run_Store.iter_table_chunks(table)), ignore_index=True)
+
+
+def get_stream_budget(plan):
+    with plan['lock']:
+        if plan['budget'] is not None:
+            return plan['budget']
+        if plan['stream_budget'] is None:
+            plan['stream_budget'] = SB_Memory_Budget.create_spill_budget()
+        return plan['stream_budget']
+
+
+def run_planned_query(governor, plan, sheet_name, sql_query, variables):
+    """Runs one query the way its plan says, and notes its actual rows and seconds for the history."""
+    query_plan = plan['queries'][sheet_name]
+    strategy = query_plan['strategy']
+    start_time = time.perf_counter()
+
+    if strategy == 'cache':
+        try:
+            print(f"    > Plan: read from the kept run '{query_plan['cached_run']}'")
+            result = read_cached_result(query_plan['cached_run'], sheet_name)
+        except Exception as e:
+            # the run can disappear between planning and reading - the DB still has the answer
+            print(f"    > The kept run could not be read ({e}), running the query")
+            strategy = 'memory'
+    if strategy == 'sharded':
+        print(f"    > Plan: {query_plan['shards']} day ranges at the same time")
+        result = run_sharded(governor, sql_query, variables, query_plan['shards'], plan['order_by'].get(sheet_name))
+    elif strategy == 'stream':
+        print("    > Plan: streamed to disk in chunks")
+        result = SB_Memory_Budget.read_sql_within_budget(
+            governor, get_stream_budget(plan), sheet_name, sql_query.format_map(variables))
+    elif strategy == 'memory':
+        result = SB_Memory_Budget.read_sql_within_budget(governor, plan['budget'], sheet_name, sql_query.format_map(variables))
+
+    record = {
+        'at': datetime.now().isoformat(timespec='seconds'),
+        'sheet': sheet_name,
+        'strategy': strategy,
+        'rows': SB_Memory_Budget.result_rows(result),
+        'seconds': round(time.perf_counter() - start_time, 3),
+        'shards': query_plan['shards'] if strategy == 'sharded' else 1,
+        **{key: query_plan[key] for key in ('db', 'template_hash', 'query_hash', 'window_days', 'window_orders',
+                                            'explain_rows', 'estimated_rows', 'estimated_seconds')},
+    }
+    with plan['lock']:
+        plan['records'].append(record)
+    return result
+
+
+def finish_plan(plan, kept_run_folder=None):
+    """
+    Adds the run's queries to the history (with the kept run, when it was kept - SB_Run_Store.keep_run's
+    folder - so a later run of the same query can be served from it) and deletes the streamed results.
+    """
+    if plan is None:
+        return
+    try:
+        history = load_history()
+        run_name = run_created_at = None
+        if kept_run_folder is not None:
+            run_name = os.path.basename(kept_run_folder)
+            # (the exact run: one kept later under the same name doesn't match it)
+            run_created_at = SB_Run_Store.load_manifest(run_name)[1]['created_at']
+        for record in plan['records']:
+            sheet_records = history.setdefault(record['sheet'], [])
+            sheet_records.append({**record, 'run': run_name, 'run_created_at': run_created_at})
+            # SB_PLAN_HISTORY_RUNS per sheet and per DB (runs on another DB never push this DB's out)
+            db_records = [sheet_record for sheet_record in sheet_records if sheet_record.get('db') == record['db']]
+            for old_record in db_records[:-plan['settings']['history_runs']]:
+                sheet_records.remove(old_record)
+        save_history(history)
+    except Exception as e:
+        print(f"    > Could not save the query plan history: {e}")
+    SB_Memory_Budget.cleanup_budget(plan['stream_budget'])
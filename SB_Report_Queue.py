@@ -0,0 +1,307 @@
+import argparse
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from dotenv import load_dotenv
+
+
+# -----------------------------------------------------------------
+# Report job queue
+# -----------------------------------------------------------------
+# A small local server that sits in front of the report logic:
+#   - identical requests that arrive while the same report is still running
+#     (same report, same START_DATE / END_DATE / CUSTOMER_CUTOFF_DATE, or the same
+#     daily dates) are coalesced: the report runs ONCE and every requester gets a copy of the file
+#   - different requests run side by side on a pool of worker processes (--workers)
+# so the DB does at most one execution per distinct request, however many people ask for it.
+#
+# Start the queue once (on the machine that has the .env):
+#     py SB_Report_Queue.py serve --workers 2
+# Ask for reports through it (the file is sent back and saved in the current folder):
+#     py SB_Report_Queue.py weekly 2025-11-02 2025-11-09 --cutoff 2025-11-02
+#     py SB_Report_Queue.py daily 021125-081125
+#     py SB_Weekly_Report.py --queue        (asks for the dates as usual, then sends them to the queue)
+#     py SB_Report_Queue.py status
+#
+# .env settings:
+#   SB_QUEUE_AUTHKEY   REQUIRED - shared secret between the queue and the requesters. The queue
+#                      runs whatever an authenticated connection sends it (requests are pickled),
+#                      next to the DB credentials, so there is no default: pick a long random one.
+#   SB_QUEUE_ADDRESS   host:port the queue listens on [127.0.0.1:6061]
+#
+# The queue never writes outside its own --output-folder: a finished file is sent back over the
+# connection and the requester saves it in its own folder.
+
+# the finished file is sent back in parts of this size
+DELIVERY_CHUNK_BYTES = 1024 * 1024
+
+# each worker process opens its governed engine once and reuses it for every job
+worker_governor = None
+
+
+def get_queue_address():
+    """Returns (host, port) and the auth key from the environment (the auth key is None when SB_QUEUE_AUTHKEY isn't set)."""
+    host, _, port = (os.getenv('SB_QUEUE_ADDRESS') or '127.0.0.1:6061').rpartition(':')
+    authkey = os.getenv('SB_QUEUE_AUTHKEY')
+    return (host or '127.0.0.1', int(port)), (authkey.encode('utf-8') if authkey else None)
+
+
+def get_job_key(request):
+    """Requests with the same key produce the same file, so they can share one execution."""
+    if request['report'] == 'weekly':
+        return ('weekly', request['start_date'], request['end_date'], request['cutoff_date'])
+    if request['report'] == 'daily':
+        return ('daily',) + tuple(request['dates'])
+    raise ValueError(f"unknown report '{request['report']}' (expected 'weekly' or 'daily')")
+
+
+# -----------------------------------------------------------------
+# Worker side (runs in the worker processes)
+# -----------------------------------------------------------------
+
+def run_report_job(request, job_folder):
+    """Runs one report into job_folder with the unified runner; returns the file name."""
+    global worker_governor
+    # imported here: the requesters (and the report scripts' --queue option) never need pandas/SQLAlchemy for this
+    import SB_DB_Governor
+    import SB_Report_Runner
+
+    if request['report'] == 'weekly':
+        spec = SB_Report_Runner.weekly_report_spec(
+            request['start_date'], request['end_date'], request['cutoff_date'])
+    else:
+        spec = SB_Report_Runner.daily_report_spec(request['dates'])
+    output_filename = os.path.join(job_folder, os.path.basename(spec['output_filename']))
+    spec['output_filename'] = output_filename
+
+    if worker_governor is None:
+        missing_config = SB_DB_Governor.get_missing_config(SB_Report_Runner.SB_Weekly_Report.DB_CONFIG)
+        if missing_config:
+            raise RuntimeError(f"Missing connection info: {', '.join(missing_config)}")
+        worker_governor = SB_DB_Governor.create_governor(SB_Report_Runner.SB_Weekly_Report.DB_CONFIG)
+
+    os.makedirs(job_folder, exist_ok=True)
+    plan = SB_Report_Runner.plan_run([spec])
+    results = SB_Report_Runner.execute_plan(worker_governor, [spec], plan)[0]
+    SB_Report_Runner.write_report(spec, results)
+    if not os.path.exists(output_filename):
+        raise RuntimeError(f"the report file was not written: {output_filename}")
+    return output_filename
+
+
+# -----------------------------------------------------------------
+# Queue server
+# -----------------------------------------------------------------
+
+def handle_request(connection, queue_state):
+    """Serves one requester: joins (or starts) the execution for its request and sends back its copy of the file."""
+    try:
+        request = connection.recv()
+        if request.get('report') == 'status':
+            with queue_state['lock']:
+                connection.send({'ok': True, 'in_flight': [
+                    {'job': ' '.join(job_key), 'requesters': job['requesters']}
+                    for job_key, job in queue_state['in_flight'].items()
+                ]})
+            return
+
+        job_key = get_job_key(request)
+        with queue_state['lock']:
+            job = queue_state['in_flight'].get(job_key)
+            coalesced = job is not None
+            if job is None:
+                queue_state['job_count'] += 1
+                job_folder = os.path.join(queue_state['output_folder'], f"job_{queue_state['job_count']:05d}")
+                job = {
+                    'future': queue_state['pool'].submit(run_report_job, request, job_folder),
+                    'requesters': 0,
+                }
+                queue_state['in_flight'][job_key] = job
+
+                # the job stops being "in flight" when it finishes: a later request runs it again on fresh data
+                def forget_job(_, job_key=job_key, job=job):
+                    with queue_state['lock']:
+                        if queue_state['in_flight'].get(job_key) is job:
+                            del queue_state['in_flight'][job_key]
+                job['future'].add_done_callback(forget_job)
+            job['requesters'] += 1
+
+        print(f"  > {'Joined running' if coalesced else 'Started'} job: {' '.join(job_key)}")
+        try:
+            job_output_filename = job['future'].result()
+        except Exception as e:
+            print(f"    > !!! FAILED !!! Job {' '.join(job_key)} failed: {e}")
+            connection.send({'ok': False, 'error': str(e)})
+            return
+
+        # fan out: every requester gets its own copy, sent over its connection (it saves it itself)
+        connection.send({'ok': True, 'filename': os.path.basename(job_output_filename), 'coalesced': coalesced})
+        send_file(connection, job_output_filename)
+        print(f"    > Delivered: {os.path.basename(job_output_filename)}")
+    except (EOFError, OSError) as e:
+        # the requester went away (Ctrl+C) - the job itself is not affected
+        print(f"    > Could not deliver to the requester: {e}")
+    except Exception as e:
+        print(f"    > !!! FAILED !!! Request failed: {e}")
+        try:
+            connection.send({'ok': False, 'error': str(e)})
+        except Exception:
+            pass
+    finally:
+        connection.close()
+
+
+def send_file(connection, filename):
+    """Sends a file in DELIVERY_CHUNK_BYTES parts, then an empty part to say it's done."""
+    with open(filename, 'rb') as delivered_file:
+        while True:
+            file_part = delivered_file.read(DELIVERY_CHUNK_BYTES)
+            connection.send_bytes(file_part)
+            if not file_part:
+                return
+
+
+def serve(workers, output_folder):
+    """Runs the queue until Ctrl+C (refuses to start without SB_QUEUE_AUTHKEY)."""
+    address, authkey = get_queue_address()
+    if authkey is None:
+        print("ERROR: SB_QUEUE_AUTHKEY is not set in .env - the queue doesn't start without its shared secret.")
+        return False
+    os.makedirs(output_folder, exist_ok=True)
+    queue_state = {
+        'lock': threading.Lock(),
+        'in_flight': {},
+        'job_count': 0,
+        'output_folder': os.path.abspath(output_folder),
+        'pool': ProcessPoolExecutor(max_workers=workers),
+    }
+
+    print(f"--- Report queue listening on {address[0]}:{address[1]} with {workers} worker process(es) ---")
+    listener = Listener(address, authkey=authkey)
+    try:
+        while True:
+            try:
+                connection = listener.accept()
+            except Exception as e:
+                # e.g. a client with the wrong SB_QUEUE_AUTHKEY
+                print(f"  > Rejected a connection: {e}")
+                continue
+            threading.Thread(target=handle_request, args=(connection, queue_state), daemon=True).start()
+    except KeyboardInterrupt:
+        print("\nStopping the report queue...")
+    finally:
+        listener.close()
+        queue_state['pool'].shutdown(wait=False, cancel_futures=True)
+
+
+# -----------------------------------------------------------------
+# Requester side
+# -----------------------------------------------------------------
+
+def receive_file(connection, output_filename):
+    """Saves the file the queue sends (written to a temp file first, so a broken connection leaves no half file)."""
+    temp_filename = f"{output_filename}.{os.getpid()}.part"
+    try:
+        with open(temp_filename, 'wb') as received_file:
+            while True:
+                file_part = connection.recv_bytes()
+                if not file_part:
+                    break
+                received_file.write(file_part)
+        os.replace(temp_filename, output_filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def submit_request(request, output_folder='.'):
+    """Sends a request to the queue and waits for the report (saved in output_folder); returns the queue's reply dict."""
+    address, authkey = get_queue_address()
+    if authkey is None:
+        return {'ok': False, 'error': "SB_QUEUE_AUTHKEY is not set in .env (it must be the same as the queue's)."}
+    try:
+        connection = Client(address, authkey=authkey)
+    except (ConnectionRefusedError, OSError) as e:
+        return {'ok': False, 'error': f"the report queue is not running on {address[0]}:{address[1]} ({e}). "
+                                      f"Start it with: py SB_Report_Queue.py serve"}
+    except AuthenticationError:
+        return {'ok': False, 'error': "the report queue refused the connection: SB_QUEUE_AUTHKEY is not the same as the queue's."}
+    try:
+        connection.send(request)
+        reply = connection.recv()
+        if reply['ok'] and 'filename' in reply:
+            # (only the file's name is taken from the queue, the folder is ours)
+            reply['output_filename'] = os.path.join(os.path.abspath(output_folder), os.path.basename(reply['filename']))
+            receive_file(connection, reply['output_filename'])
+        return reply
+    finally:
+        connection.close()
+
+
+def print_reply(reply):
+    """Prints the queue's answer the same way the report scripts print theirs."""
+    if not reply['ok']:
+        print(f"    > !!! FAILED !!! {reply['error']}")
+        return
+    if 'output_filename' in reply:
+        shared = " (shared with an identical request that was already running)" if reply['coalesced'] else ""
+        print(f"    > File saved: {reply['output_filename']}{shared}")
+        return
+    if not reply['in_flight']:
+        print("No reports running.")
+    for job in reply['in_flight']:
+        print(f"  > {job['job']}: {job['requesters']} requester(s)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local job queue for the Shookbook reports")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', help="run the queue")
+    serve_parser.add_argument('--workers', type=int, default=2, help="worker processes (reports run at once) [2]")
+    serve_parser.add_argument('--output-folder', default='report_queue_output',
+                              help="where the queue keeps the files it produced [report_queue_output]")
+
+    weekly_parser = commands.add_parser('weekly', help="ask for a weekly report")
+    weekly_parser.add_argument('start_date', help="YYYY-MM-DD")
+    weekly_parser.add_argument('end_date', help="YYYY-MM-DD")
+    weekly_parser.add_argument('--cutoff', help="new customers cutoff date [the start date]")
+
+    daily_parser = commands.add_parser('daily', help="ask for a daily sales report")
+    daily_parser.add_argument('date_range', help="same input as the daily script, e.g. 021125-081125")
+
+    commands.add_parser('status', help="show the reports running now")
+    return parser.parse_args()
+
+
+def main():
+    load_dotenv()
+    args = parse_args()
+    if args.command == 'serve':
+        if serve(args.workers, args.output_folder) is False:
+            sys.exit(1)
+        return
+
+    if args.command == 'weekly':
+        request = {'report': 'weekly', 'start_date': args.start_date, 'end_date': args.end_date,
+                   'cutoff_date': args.cutoff or args.start_date}
+    elif args.command == 'daily':
+        # the daily script's date parsing (imported here, it loads pandas)
+        import SB_Daily_Sales_Report
+        request = {'report': 'daily', 'dates': SB_Daily_Sales_Report.parse_date_range_list(args.date_range)}
+    else:
+        request = {'report': 'status'}
+
+    reply = submit_request(request)
+    print_reply(reply)
+    if not reply['ok']:
+        sys.exit(1)
+
+
+# Running the main function
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import SB_DB_Governor
+import SB_Derived_Sheets
+import SB_Daily_Sales_Report
+import SB_Excel_Writer
+import SB_Report_Spec
+import SB_Run_Store
+import SB_Shared_Facts
+import SB_Week_Compare
+import SB_Weekly_Report
+
+
+# -----------------------------------------------------------------
+# Unified report runner
+# -----------------------------------------------------------------
+# Runs the weekly report and the daily sales reports in ONE process:
+#   1. every report is described as a "spec" (its sheets, their SQL, date window and output file)
+#   2. all specs are planned together: sheets that can be computed from a shared fact table
+#      (see SB_Shared_Facts.py) need that table once, over the union of their windows;
+#      every other sheet runs its own SQL, and identical SQL runs only once
+#   3. the plan runs on one governed engine / connection pool
+#   4. each spec writes the same workbook its own script writes today (the weekly one with its
+#      "... vs last week" sheets, SB_Week_Compare.py), and its run is kept (SB_Run_Store.py),
+#      so the next week's comparison and the query planner's cache see it like a script's run
+#
+# Sunday night (weekly report for the last 7 days + a daily report for each of those days):
+#     py SB_Report_Runner.py
+# Specific windows:
+#     py SB_Report_Runner.py --weekly 2025-11-02 2025-11-09 --cutoff 2025-11-02 --daily 021125-081125
+
+
+def weekly_report_spec(start_date, end_date, cutoff_date):
+    """The weekly report (SB_Weekly_Report.py) as a spec."""
+    DATE_RANGE = {
+        'START_DATE': start_date,
+        'END_DATE': end_date,
+        'CUSTOMER_CUTOFF_DATE': cutoff_date,
+    }
+    return {
+        'report': 'weekly',
+        'output_filename': f"Shookbook_weekly_report_{start_date}_to_{end_date}.xlsx",
+        'right_to_left': False,
+        'window': (start_date, end_date),
+        'sheets': [
+            {'sheet_name': sheet_name, 'query_name': sheet_name, 'sql': sql_query,
+             'variables': sheet_variables, 'window': (sheet_variables['START_DATE'], sheet_variables['END_DATE'])}
+            for sheet_name, sql_query in SB_Weekly_Report.ALL_QUERIES.items()
+            # (a sheet with its own window_days in the spec reads a longer window)
+            for sheet_variables in [SB_Report_Spec.get_sheet_variables(SB_Weekly_Report.REPORT_SPEC, sheet_name, DATE_RANGE)]
+        ],
+    }
+
+
+def daily_report_spec(dates_to_process):
+    """The daily sales report (SB_Daily_Sales_Report.py) for a list of dates, one sheet per date."""
+    sheets = []
+    for current_date_str in dates_to_process:
+        DATE_VARS = SB_Daily_Sales_Report.get_date_vars(current_date_str)
+        for query_name, sql_template in SB_Daily_Sales_Report.ALL_QUERIES.items():
+            sheets.append({
+                'sheet_name': current_date_str, 'query_name': query_name, 'sql': sql_template,
+                'variables': DATE_VARS, 'window': (current_date_str, DATE_VARS['DAY_TOMORROW']),
+            })
+    return {
+        'report': 'daily',
+        'output_filename': f"Sales_Report_Range_{dates_to_process[0]}_to_{dates_to_process[-1]}.xlsx",
+        'right_to_left': True,
+        'sheets': sheets,
+    }
+
+
+def merge_windows(windows):
+    """Merges overlapping / back-to-back (start, end) date windows, so each day is read once."""
+    merged = []
+    for start_date, end_date in sorted(windows):
+        if merged:
+            previous_end = datetime.strptime(merged[-1][1], '%Y-%m-%d')
+            if datetime.strptime(start_date, '%Y-%m-%d') <= previous_end + timedelta(days=1):
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end_date))
+                continue
+        merged.append((start_date, end_date))
+    return merged
+
+
+def plan_run(report_specs):
+    """
+    Works out what has to be read from the DB for all the specs together.
+    Returns {'fact_windows': {fact name: [(start, end), ...]}, 'sql_jobs': {formatted SQL: [(spec index, sheet name)]}}
+    """
+    fact_windows = {}
+    sql_jobs = {}
+    for spec_index, spec in enumerate(report_specs):
+        for sheet in spec['sheets']:
+            derivation = SB_Shared_Facts.FACT_DERIVATIONS.get((spec['report'], sheet['query_name']))
+            if derivation is not None:
+                fact_windows.setdefault(derivation[0], []).append(sheet['window'])
+            else:
+                formatted_query = sheet['sql'].format_map(sheet['variables'])
+                sql_jobs.setdefault(formatted_query, []).append((spec_index, sheet['sheet_name']))
+
+    return {
+        'fact_windows': {fact_name: merge_windows(windows) for fact_name, windows in fact_windows.items()},
+        'sql_jobs': sql_jobs,
+    }
+
+
+def print_plan(report_specs, plan):
+    """Shows how many DB reads the plan needs compared to running every sheet on its own."""
+    sheet_count = sum(len(spec['sheets']) for spec in report_specs)
+    fact_reads = sum(len(windows) for windows in plan['fact_windows'].values())
+    print(f"Plan: {sheet_count} sheets from {fact_reads + len(plan['sql_jobs'])} DB reads "
+          f"({fact_reads} shared fact extractions + {len(plan['sql_jobs'])} queries).")
+    for fact_name, windows in plan['fact_windows'].items():
+        for start_date, end_date in windows:
+            print(f"  > shared '{fact_name}': {start_date} to {end_date}")
+
+
+def read_fact_table(governor, fact_name, windows):
+    """Reads one fact table for all its (merged) windows."""
+    fact_dfs = []
+    for start_date, end_date in windows:
+        print(f"  > Reading shared facts '{fact_name}' ({start_date} to {end_date})...")
+        fact_query = SB_Shared_Facts.FACT_QUERIES[fact_name].format_map(
+            {'FACT_START_DATE': start_date, 'FACT_END_DATE': end_date})
+        fact_dfs.append(SB_DB_Governor.read_sql(governor, fact_query))
+    fact_df = SB_Shared_Facts.prepare_facts(pd.concat(fact_dfs, ignore_index=True))
+    print(f"    > Success! '{fact_name}' has {len(fact_df)} rows.")
+    return fact_df
+
+
+def run_sql_job(governor, formatted_query, sheet_names):
+    """Runs one (possibly shared) report query; a failed query returns an 'Error' table."""
+    print(f"  > Running query for: {', '.join(sheet_names)}...")
+    try:
+        results_table_df = SB_DB_Governor.read_sql(governor, formatted_query)
+        print(f"    > Success! Found {len(results_table_df)} records.")
+        return results_table_df
+    except Exception as e:
+        print(f"    > !!! FAILED !!! Query for {', '.join(sheet_names)} failed: {e}")
+        return pd.DataFrame({'Error': [str(e)]})
+
+
+def execute_plan(governor, report_specs, plan):
+    """Runs the plan and returns one {sheet name: DataFrame} per spec."""
+    max_workers = governor['settings']['max_concurrent_queries']
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running_facts = {
+            fact_name: executor.submit(read_fact_table, governor, fact_name, windows)
+            for fact_name, windows in plan['fact_windows'].items()
+        }
+        running_queries = {
+            formatted_query: executor.submit(
+                run_sql_job, governor, formatted_query,
+                [sheet_name for _, sheet_name in sheets])
+            for formatted_query, sheets in plan['sql_jobs'].items()
+        }
+
+    facts = {}
+    for fact_name, running_fact in running_facts.items():
+        try:
+            facts[fact_name] = running_fact.result()
+        except Exception as e:
+            print(f"    > !!! FAILED !!! Reading shared facts '{fact_name}' failed: {e}")
+            facts[fact_name] = e
+
+    query_results = {}
+    for formatted_query, running_query in running_queries.items():
+        for spec_index, sheet_name in plan['sql_jobs'][formatted_query]:
+            query_results[(spec_index, sheet_name)] = running_query.result()
+
+    # every spec gets its sheets back in its own order
+    all_results = []
+    for spec_index, spec in enumerate(report_specs):
+        results = {}
+        for sheet in spec['sheets']:
+            derivation = SB_Shared_Facts.FACT_DERIVATIONS.get((spec['report'], sheet['query_name']))
+            if derivation is None:
+                results[sheet['sheet_name']] = query_results[(spec_index, sheet['sheet_name'])]
+                continue
+            fact_name, derive_sheet = derivation
+            try:
+                if isinstance(facts[fact_name], Exception):
+                    raise facts[fact_name]
+                results[sheet['sheet_name']] = derive_sheet(facts[fact_name], sheet['variables'])
+            except Exception as e:
+                print(f"    > !!! FAILED !!! Sheet '{sheet['sheet_name']}' could not be computed: {e}")
+                results[sheet['sheet_name']] = pd.DataFrame({'Error': [str(e)]})
+        all_results.append(results)
+    return all_results
+
+
+def write_report(spec, results):
+    """Writes one spec's workbook the same way its own script does, and keeps its run."""
+    print(f"\nExporting results to file: {spec['output_filename']} ...")
+    if spec['report'] == 'weekly':
+        # the extra sheets the weekly script adds (SB_Derived_Sheets.py, SB_Week_Compare.py)
+        results = SB_Derived_Sheets.add_derived_sheets(results)
+        try:
+            results.update(SB_Week_Compare.make_comparison_sheets(results, spec['window'][0], spec['window'][1]))
+        except Exception as e:
+            print(f"    > !!! FAILED !!! The comparison sheets could not be computed: {e}")
+    else:
+        # like the daily script: a failed date gets no tab (and isn't kept), an empty one gets a 'No Data' tab
+        results = {sheet_name: results_table_df for sheet_name, results_table_df in results.items()
+                   if list(results_table_df.columns) != ['Error']}
+    try:
+        workbook = SB_Excel_Writer.open_workbook()
+        for sheet_name, results_table_df in results.items():
+            if spec['report'] == 'daily':
+                SB_Daily_Sales_Report.write_date_sheet(workbook, sheet_name, results_table_df)
+            else:
+                SB_Weekly_Report.write_result_sheet(workbook, sheet_name, results_table_df)
+        SB_Excel_Writer.save_workbook(workbook, spec['output_filename'])
+        print(f"    > File saved: {spec['output_filename']}")
+    except Exception as e:
+        print(f"!!! CRITICAL ERROR while saving Excel file: {e}")
+        return
+
+    # (only a run whose workbook was saved is kept)
+    SB_Run_Store.keep_run(spec['output_filename'], results, spec['report'])
+
+
+def parse_args():
+    """Reads the report windows from the command line (defaults: the Sunday night run)."""
+    parser = argparse.ArgumentParser(description="Run the weekly and daily Shookbook reports together")
+    parser.add_argument('--weekly', nargs=2, metavar=('START', 'END'),
+                        help="weekly report window, YYYY-MM-DD YYYY-MM-DD (default: the last 7 days)")
+    parser.add_argument('--cutoff', metavar='DATE',
+                        help="new customers cutoff date for the weekly report (default: the weekly start date)")
+    parser.add_argument('--daily', metavar='RANGE',
+                        help="daily report dates, same input as the daily script, e.g. 021125-081125 "
+                             "(default: each day of the weekly window except its last)")
+    parser.add_argument('--daily-single-file', action='store_true',
+                        help="write all daily dates into one workbook (default: one workbook per day)")
+    parser.add_argument('--no-weekly', action='store_true', help="skip the weekly report")
+    parser.add_argument('--no-daily', action='store_true', help="skip the daily reports")
+    return parser.parse_args()
+
+
+def build_report_specs(args):
+    """Turns the command line into the list of report specs to run."""
+    if args.weekly:
+        start_date, end_date = args.weekly
+    else:
+        # same default as the weekly script: the last 7 days
+        end_date_dt = datetime.now()
+        start_date = (end_date_dt - timedelta(days=7)).strftime('%Y-%m-%d')
+        end_date = end_date_dt.strftime('%Y-%m-%d')
+    cutoff_date = args.cutoff or start_date
+
+    report_specs = []
+    if not args.no_weekly:
+        report_specs.append(weekly_report_spec(start_date, end_date, cutoff_date))
+
+    if not args.no_daily:
+        if args.daily:
+            dates_to_process = SB_Daily_Sales_Report.parse_date_range_list(args.daily)
+        else:
+            first_day = datetime.strptime(start_date, '%Y-%m-%d')
+            last_day = datetime.strptime(end_date, '%Y-%m-%d') - timedelta(days=1)
+            dates_to_process = [(first_day + timedelta(days=offset)).strftime('%Y-%m-%d')
+                                for offset in range((last_day - first_day).days + 1)]
+        if args.daily_single_file:
+            report_specs.append(daily_report_spec(dates_to_process))
+        else:
+            # the same files as running the daily script once per day
+            report_specs.extend(daily_report_spec([current_date_str]) for current_date_str in dates_to_process)
+
+    return report_specs
+
+
+def main():
+    print("--- Starting unified report runner ---")
+    args = parse_args()
+    report_specs = build_report_specs(args)
+    if not report_specs:
+        print("Nothing to run.")
+        return
+
+    missing_config = SB_DB_Governor.get_missing_config(SB_Weekly_Report.DB_CONFIG)
+    if missing_config:
+        print(" ERROR: Not all connection details are defined in/loaded from .env file.")
+        print(f"Missing connection info: {', '.join(missing_config)}")
+        return
+
+    # one engine / connection pool for every report
+    try:
+        governor = SB_DB_Governor.create_governor(SB_Weekly_Report.DB_CONFIG)
+        print("Database connection successful!")
+    except Exception as e:
+        print(f"Database connection error: {e}")
+        return
+
+    plan = plan_run(report_specs)
+    print_plan(report_specs, plan)
+
+    all_results = execute_plan(governor, report_specs, plan)
+    for spec, results in zip(report_specs, all_results):
+        write_report(spec, results)
+
+    print("\n--- Runner completed! ---")
+
+
+# Running the main function
+if __name__ == "__main__":
+    main()
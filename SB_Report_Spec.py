@@ -0,0 +1,194 @@
+import os
+import re
+from datetime import datetime, timedelta
+
+try:
+    import tomllib
+except ModuleNotFoundError:
+    # Python < 3.11: pip install tomli
+    import tomli as tomllib
+
+import SB_Derived_Sheets
+import SB_Excel_Writer
+import SB_Memory_Budget
+
+
+# -----------------------------------------------------------------
+# Report specs (the queries of a report, from a .toml file)
+# -----------------------------------------------------------------
+# The queries of the weekly and the daily report are defined in a spec file next to
+# the script (SB_Weekly_Report_spec.toml, SB_Daily_Sales_Report_spec.toml), not in the code:
+#   - [filters]  the store / status lists every query shares, written once
+#                ({excluded_stores} in the SQL is replaced by its value when the spec is loaded)
+#   - [[sheets]] name, sql, and optionally the sheet's own parameters and window (window_days),
+#                and whether the planner may split it by day (shardable, order_by - see SB_Query_Planner.py)
+# The scripts' ALL_QUERIES is built from the spec, so everything that used it works as before.
+#
+# With --only / --skip only the chosen sheets are written, and only the queries they need
+# run (a derived sheet such as "packing by employee" runs its source query, "packing",
+# without writing it):
+#
+#     py SB_Weekly_Report.py --only packing
+#     py SB_Weekly_Report.py --only "weekly products,zones by day"
+#     py SB_Weekly_Report.py --skip "yearly orders,2nd month orders"
+#
+# Another spec file can be used with SB_WEEKLY_REPORT_SPEC / SB_DAILY_SALES_REPORT_SPEC in .env.
+
+# {lower_case} names in the SQL are the spec's filters / parameters; {UPPER_CASE} ones are the dates
+FILTER_PATTERN = r'\{([a-z][a-z0-9_]*)\}'
+
+# the [filters] of every spec file read by get_report_filters, by file name (read once per run)
+LOADED_FILTERS = {}
+
+
+def get_spec_filename(script_name):
+    """SB_<SCRIPT>_SPEC from .env, or <script>_spec.toml next to the scripts."""
+    default_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{script_name}_spec.toml")
+    return os.getenv(f"{script_name.upper()}_SPEC") or default_filename
+
+
+def resolve_filters(sheet_name, sql_query, values):
+    """Puts the filter / parameter values into the SQL (the date placeholders are left for later)."""
+    def replace_filter(filter_match):
+        filter_name = filter_match.group(1)
+        if filter_name not in values:
+            raise ValueError(f"sheet '{sheet_name}' uses {{{filter_name}}}, which is not in [filters] or its parameters")
+        return str(values[filter_name])
+    return re.sub(FILTER_PATTERN, replace_filter, sql_query)
+
+
+def load_spec(spec_filename):
+    """
+    Reads and checks a spec file. Returns
+    {'report': ..., 'filename': ..., 'filters': {...},
+     'sheets': {name: {'sql': ..., 'window_days': N or None, 'shardable': bool, 'order_by': ... or None}}}
+    with the sheets in the file's order.
+    """
+    with open(spec_filename, 'rb') as spec_file:
+        raw_spec = tomllib.load(spec_file)
+
+    filters = raw_spec.get('filters', {})
+    sheets = {}
+    for sheet in raw_spec.get('sheets', []):
+        if not sheet.get('name') or not sheet.get('sql'):
+            raise ValueError(f"{spec_filename}: every [[sheets]] entry needs a name and sql")
+        if sheet['name'] in sheets:
+            raise ValueError(f"{spec_filename}: sheet '{sheet['name']}' is defined twice")
+        sheets[sheet['name']] = {
+            'sql': resolve_filters(sheet['name'], sheet['sql'], {**filters, **sheet.get('parameters', {})}),
+            'window_days': int(sheet['window_days']) if sheet.get('window_days') else None,
+            # for SB_Query_Planner.py: every row belongs to one day of the window, so the window can be
+            # cut into day ranges that run at the same time (order_by re-sorts the combined rows)
+            'shardable': bool(sheet.get('shardable')),
+            'order_by': sheet.get('order_by'),
+        }
+    if not sheets:
+        raise ValueError(f"{spec_filename}: no [[sheets]] defined")
+    return {'report': raw_spec.get('report'), 'filename': spec_filename, 'filters': filters, 'sheets': sheets}
+
+
+def get_report_filters(script_name):
+    """
+    The [filters] of a report's spec (the same file its script loads), for the paths that compute
+    its sheets in pandas instead of running the SQL (SB_Shared_Facts.py, SB_Derived_Sheets.py, SB_Sketches.py).
+    """
+    spec_filename = get_spec_filename(script_name)
+    if spec_filename not in LOADED_FILTERS:
+        with open(spec_filename, 'rb') as spec_file:
+            LOADED_FILTERS[spec_filename] = tomllib.load(spec_file).get('filters', {})
+    return LOADED_FILTERS[spec_filename]
+
+
+def get_filter_values(script_name, filter_name):
+    """One [filters] list of a report's spec as values: excluded_stores = "84, 85" -> [84, 85]."""
+    filters = get_report_filters(script_name)
+    if filter_name not in filters:
+        raise ValueError(f"{get_spec_filename(script_name)}: [filters] has no {filter_name}")
+    values = []
+    for value in str(filters[filter_name]).split(','):
+        value = value.strip().strip("'\"")
+        if value:
+            values.append(int(value) if re.fullmatch(r'-?\d+', value) else value)
+    return values
+
+
+def get_queries(spec):
+    """{sheet name: SQL template} - the scripts' ALL_QUERIES."""
+    return {sheet_name: sheet['sql'] for sheet_name, sheet in spec['sheets'].items()}
+
+
+def get_sheet_variables(spec, sheet_name, variables):
+    """
+    The date variables of one sheet: the report's, or with window_days the last N days
+    up to END_DATE (START_DATE moved back).
+    """
+    sheet = spec['sheets'].get(sheet_name)
+    if sheet is None or not sheet['window_days'] or 'END_DATE' not in variables:
+        return variables
+    end_day = datetime.strptime(variables['END_DATE'], '%Y-%m-%d')
+    return {**variables, 'START_DATE': (end_day - timedelta(days=sheet['window_days'] - 1)).strftime('%Y-%m-%d')}
+
+
+def has_own_window(spec, sheet_name):
+    return bool(spec['sheets'].get(sheet_name, {}).get('window_days'))
+
+
+# -----------------------------------------------------------------
+# --only / --skip
+# -----------------------------------------------------------------
+
+def parse_sheet_names(text):
+    """'packing, weekly products' -> ['packing', 'weekly products'] (None stays None)."""
+    if text is None:
+        return None
+    return [sheet_name.strip() for sheet_name in text.split(',') if sheet_name.strip()]
+
+
+def get_output_sheets(spec):
+    """The sheets a full run writes, in order: every query sheet (but the source-only ones) and its derived sheets."""
+    output_sheets = []
+    for sheet_name in spec['sheets']:
+        if sheet_name not in SB_Derived_Sheets.SOURCE_ONLY_SHEETS:
+            output_sheets.append(sheet_name)
+        output_sheets += [derived_sheet_name for derived_sheet_name, (source_name, _) in SB_Derived_Sheets.DERIVED_SHEETS.items()
+                          if source_name == sheet_name]
+    return output_sheets
+
+
+def select_sheets(spec, only=None, skip=None):
+    """
+    The queries to run and the sheets to write for --only / --skip (lists of sheet names).
+    Returns (query names in spec order, set of output sheet names); an unknown name raises ValueError.
+    """
+    output_sheets = get_output_sheets(spec)
+    unknown_sheets = [sheet_name for sheet_name in (only or []) + (skip or []) if sheet_name not in output_sheets]
+    if unknown_sheets:
+        raise ValueError(f"unknown sheet(s): {', '.join(unknown_sheets)} (the sheets are: {', '.join(output_sheets)})")
+
+    wanted_sheets = set(only or output_sheets) - set(skip or [])
+    if not wanted_sheets:
+        raise ValueError("no sheets left to run")
+    # a query runs when its own sheet or one of its derived sheets is wanted
+    needed_queries = [
+        sheet_name for sheet_name in spec['sheets']
+        if sheet_name in wanted_sheets or any(
+            source_name == sheet_name and derived_sheet_name in wanted_sheets
+            for derived_sheet_name, (source_name, _) in SB_Derived_Sheets.DERIVED_SHEETS.items())
+    ]
+    return needed_queries, wanted_sheets
+
+
+def keep_output_sheets(results, wanted_sheets):
+    """The wanted sheets of the results; a query that only ran for a derived sheet still shows its 'Error' table."""
+    return {sheet_name: result for sheet_name, result in results.items()
+            if sheet_name in wanted_sheets or SB_Memory_Budget.result_columns(result) == ['Error']}
+
+
+def get_selection_suffix(spec, wanted_sheets):
+    """'' for a full run; otherwise a file name suffix, so a partial report never replaces the full one."""
+    if set(get_output_sheets(spec)) <= set(wanted_sheets):
+        return ''
+    if len(wanted_sheets) <= 3:
+        return '_' + '_'.join(sorted(SB_Excel_Writer.make_folder_name(sheet_name).replace(' ', '-')
+                                     for sheet_name in wanted_sheets))
+    return f"_{len(wanted_sheets)}_sheets"
@@ -0,0 +1,344 @@
+import argparse
+import json
+import os
+import shutil
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+import SB_Excel_Writer
+import SB_Memory_Budget
+
+
+# -----------------------------------------------------------------
+# Run store (Arrow IPC) and re-export
+# -----------------------------------------------------------------
+# Every report run also keeps its results as Arrow IPC files, one per sheet:
+#
+#   report_runs/
+#       Shookbook_weekly_report_2025-11-02_to_2025-11-09/
+#           manifest.json            (report, when, sheets in order, their real column names)
+#           01_newCust-totalOrderWithQuant.arrow
+#           02_packing.arrow
+#           ...
+#
+# The files are uncompressed Arrow, so they are memory-mapped when read (the OS pages
+# the data in, nothing is parsed or copied). A past run can be exported again in
+# another form or as a subset of its sheets without touching the DB:
+#
+#     py SB_Run_Store.py list
+#     py SB_Run_Store.py export Shookbook_weekly_report_2025-11-02_to_2025-11-09 --format csv
+#     py SB_Run_Store.py export Shookbook_weekly_report_2025-11-02_to_2025-11-09 --sheets packing,"weekly products"
+#
+# CSV and Parquet are written by Arrow straight from the mapped files; .xlsx has to go
+# through openpyxl cell by cell, so it is streamed in chunks (memory stays flat).
+#
+# Optional .env settings:
+#   SB_RUN_STORE_FOLDER   where the runs are kept [report_runs next to the scripts]
+#   SB_KEEP_RUNS          how many runs to keep, the oldest are deleted [30]
+#   SB_RUN_STORE          set to 0 to not keep runs at all
+
+EXPORT_FORMATS = ['xlsx', 'csv', 'parquet']
+
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def get_run_store_folder():
+    default_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'report_runs')
+    return os.getenv('SB_RUN_STORE_FOLDER') or default_folder
+
+
+def is_enabled():
+    return (os.getenv('SB_RUN_STORE') or '1') != '0'
+
+
+def get_run_name(output_filename):
+    """A run is named after its report file (running the same report again replaces it)."""
+    return os.path.splitext(os.path.basename(output_filename))[0]
+
+
+# -----------------------------------------------------------------
+# Saving a run
+# -----------------------------------------------------------------
+
+def get_chunk_table(chunk, schema=None):
+    """One chunk as an Arrow table, cast to the file's schema when one is given."""
+    table = pa.Table.from_pandas(SB_Excel_Writer.make_parquet_safe(chunk), preserve_index=False)
+    if schema is not None and not table.schema.equals(schema):
+        table = table.cast(schema)
+    return table
+
+
+def get_unified_schema(result):
+    """
+    The schema every chunk of a result fits in (an all-NULL chunk then a float one -> float,
+    int then float -> float, int then text -> text, see SB_Excel_Writer.get_common_schema).
+    Reads the result once more, so it's only used when the chunks differ.
+    """
+    schemas = [pa.Schema.from_pandas(SB_Excel_Writer.make_parquet_safe(chunk), preserve_index=False)
+               for chunk in SB_Excel_Writer.iter_chunks(SB_Memory_Budget.iter_result(result))]
+    return SB_Excel_Writer.get_common_schema(schemas)
+
+
+def write_chunks(sheet_filename, result, schema=None):
+    """Writes the result's chunks to one Arrow IPC file (in the first chunk's schema unless one is given)."""
+    writer = None
+    rows = 0
+    try:
+        for chunk in SB_Excel_Writer.iter_chunks(SB_Memory_Budget.iter_result(result)):
+            table = get_chunk_table(chunk, schema)
+            if writer is None:
+                schema = table.schema
+                writer = pa.ipc.new_file(sheet_filename, schema)
+            writer.write_table(table)
+            rows += len(chunk)
+        if writer is None:
+            # an empty result keeps its columns
+            empty_df = result if not SB_Memory_Budget.is_spilled(result) else None
+            empty_table = pa.Table.from_pandas(SB_Excel_Writer.make_parquet_safe(empty_df), preserve_index=False)
+            writer = pa.ipc.new_file(sheet_filename, empty_table.schema)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def write_sheet_file(sheet_filename, result):
+    """
+    Writes one result (DataFrame or spilled result) as an Arrow IPC file, chunk by chunk; returns the row count.
+    An IPC file has one schema: when a later chunk doesn't fit the first one's (its types drifted, e.g. a
+    column that was all NULL so far), the file is written again in the schema all the chunks fit in.
+    """
+    try:
+        return write_chunks(sheet_filename, result)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return write_chunks(sheet_filename, result, get_unified_schema(result))
+
+
+def save_run(output_filename, results, report):
+    """
+    Keeps a run's results ({sheet name: DataFrame or spilled result}, in sheet order).
+    The run is written to a temp folder and swapped in whole, so a reader never sees half a run.
+    """
+    run_name = get_run_name(output_filename)
+    store_folder = get_run_store_folder()
+    run_folder = os.path.join(store_folder, run_name)
+    temp_folder = f"{run_folder}.{os.getpid()}.tmp"
+    shutil.rmtree(temp_folder, ignore_errors=True)
+    os.makedirs(temp_folder)
+
+    manifest = {
+        'run': run_name,
+        'report': report,
+        'output_filename': os.path.basename(output_filename),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'sheets': [],
+    }
+    for sheet_number, (sheet_name, result) in enumerate(results.items(), start=1):
+        sheet_file = f"{sheet_number:02d}_{SB_Excel_Writer.make_folder_name(sheet_name)}.arrow"
+        rows = write_sheet_file(os.path.join(temp_folder, sheet_file), result)
+        manifest['sheets'].append({
+            'name': sheet_name,
+            'file': sheet_file,
+            'columns': [str(column) for column in SB_Memory_Budget.result_columns(result)],
+            'rows': rows,
+        })
+    with open(os.path.join(temp_folder, MANIFEST_FILENAME), 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, ensure_ascii=False, indent=2)
+
+    # replace the previous run with the same name
+    if os.path.exists(run_folder):
+        old_folder = f"{run_folder}.{os.getpid()}.old"
+        os.replace(run_folder, old_folder)
+        os.replace(temp_folder, run_folder)
+        shutil.rmtree(old_folder, ignore_errors=True)
+    else:
+        os.replace(temp_folder, run_folder)
+    prune_runs(store_folder)
+    return run_folder
+
+
+def keep_run(output_filename, results, report):
+    """
+    save_run for the report scripts: never fails the report, just says why the run wasn't kept.
+    Returns the run's folder, or None when it wasn't kept.
+    """
+    if not is_enabled():
+        return None
+    try:
+        run_folder = save_run(output_filename, results, report)
+        print(f"    > Run kept for re-export: {run_folder}")
+        return run_folder
+    except Exception as e:
+        print(f"    > Could not keep the run for re-export: {e}")
+        return None
+
+
+def list_runs(store_folder=None):
+    """The kept runs' manifests, newest first."""
+    store_folder = store_folder or get_run_store_folder()
+    manifests = []
+    if not os.path.isdir(store_folder):
+        return manifests
+    for run_name in os.listdir(store_folder):
+        manifest_filename = os.path.join(store_folder, run_name, MANIFEST_FILENAME)
+        if run_name.endswith(('.tmp', '.old')) or not os.path.exists(manifest_filename):
+            continue
+        with open(manifest_filename, encoding='utf-8') as manifest_file:
+            manifests.append(json.load(manifest_file))
+    return sorted(manifests, key=lambda manifest: manifest['created_at'], reverse=True)
+
+
+def prune_runs(store_folder):
+    """Deletes the oldest runs beyond SB_KEEP_RUNS."""
+    keep_runs = int(os.getenv('SB_KEEP_RUNS') or 30)
+    for manifest in list_runs(store_folder)[keep_runs:]:
+        shutil.rmtree(os.path.join(store_folder, manifest['run']), ignore_errors=True)
+
+
+# -----------------------------------------------------------------
+# Reading a run
+# -----------------------------------------------------------------
+
+def load_manifest(run_name):
+    run_folder = os.path.join(get_run_store_folder(), run_name)
+    with open(os.path.join(run_folder, MANIFEST_FILENAME), encoding='utf-8') as manifest_file:
+        return run_folder, json.load(manifest_file)
+
+
+def open_sheet_table(run_folder, sheet_entry):
+    """The sheet as an Arrow table over the memory-mapped file (zero copy), with its real column names."""
+    source = pa.memory_map(os.path.join(run_folder, sheet_entry['file']), 'r')
+    table = pa.ipc.open_file(source).read_all()
+    return table.rename_columns(sheet_entry['columns'])
+
+
+def load_run_tables(run_name, sheet_names=None):
+    """{sheet name: Arrow table} of a kept run (all sheets, or the given ones in the run's order)."""
+    run_folder, manifest = load_manifest(run_name)
+    known_sheets = [sheet_entry['name'] for sheet_entry in manifest['sheets']]
+    unknown_sheets = [sheet_name for sheet_name in (sheet_names or []) if sheet_name not in known_sheets]
+    if unknown_sheets:
+        raise ValueError(f"not in run '{run_name}': {', '.join(unknown_sheets)} (it has: {', '.join(known_sheets)})")
+    return {
+        sheet_entry['name']: open_sheet_table(run_folder, sheet_entry)
+        for sheet_entry in manifest['sheets']
+        if not sheet_names or sheet_entry['name'] in sheet_names
+    }
+
+
+# -----------------------------------------------------------------
+# Re-export
+# -----------------------------------------------------------------
+
+def iter_table_chunks(table):
+    """The table as DataFrames of SB_Excel_Writer.WRITE_CHUNK_ROWS rows (for the streaming Excel writer)."""
+    columns = table.column_names
+    for batch in table.to_batches(max_chunksize=SB_Excel_Writer.WRITE_CHUNK_ROWS):
+        chunk = batch.to_pandas()
+        chunk.columns = columns
+        yield chunk
+
+
+def export_xlsx(tables, output_filename, right_to_left=False):
+    workbook = SB_Excel_Writer.open_workbook()
+    for sheet_name, table in tables.items():
+        # (an empty sheet still gets its header row)
+        if table.num_rows:
+            results = iter_table_chunks(table)
+        else:
+            results = table.to_pandas().set_axis(table.column_names, axis=1)
+        SB_Excel_Writer.write_sheet(workbook, sheet_name, results, right_to_left=right_to_left, rows=table.num_rows)
+    SB_Excel_Writer.save_workbook(workbook, output_filename)
+    return [output_filename]
+
+
+def export_csv(tables, output_folder):
+    """One UTF-8 CSV per sheet (with a BOM, so Excel shows the Hebrew right), written by Arrow."""
+    os.makedirs(output_folder, exist_ok=True)
+    written_files = []
+    for sheet_name, table in tables.items():
+        csv_filename = os.path.join(output_folder, f"{SB_Excel_Writer.make_folder_name(sheet_name)}.csv")
+        with open(csv_filename, 'wb') as csv_file:
+            csv_file.write('\ufeff'.encode('utf-8'))
+            pa_csv.write_csv(table, csv_file)
+        written_files.append(csv_filename)
+    return written_files
+
+
+def export_parquet(tables, output_folder):
+    """One Parquet file per sheet (repeated column names get a ".1" suffix, Parquet needs them unique)."""
+    os.makedirs(output_folder, exist_ok=True)
+    written_files = []
+    for sheet_name, table in tables.items():
+        parquet_filename = os.path.join(output_folder, f"{SB_Excel_Writer.make_folder_name(sheet_name)}.parquet")
+        pq.write_table(table.rename_columns(SB_Excel_Writer.make_unique_columns(table.column_names)),
+                       parquet_filename, compression='zstd')
+        written_files.append(parquet_filename)
+    return written_files
+
+
+def export_run(run_name, export_format='xlsx', sheet_names=None, output=None):
+    """
+    Writes a kept run (or some of its sheets) in another format; returns the files written.
+    The default names end with '_export', so the report the run was kept from (<run>.xlsx) is never
+    overwritten; an --output that is that report's file name is refused too.
+    """
+    _, manifest = load_manifest(run_name)
+    tables = load_run_tables(run_name, sheet_names)
+    suffix = '' if not sheet_names else '_' + '_'.join(SB_Excel_Writer.make_folder_name(name) for name in sheet_names)
+    if export_format == 'xlsx':
+        output_filename = output or f"{run_name}{suffix}_export.xlsx"
+        if os.path.basename(output_filename) == f"{run_name}.xlsx" and os.path.exists(output_filename):
+            raise FileExistsError(f"'{output_filename}' is the original report - give another --output")
+        # the daily report's sheets are right-to-left, like the original file
+        return export_xlsx(tables, output_filename, right_to_left=manifest['report'] == 'daily')
+    if export_format == 'csv':
+        return export_csv(tables, output or f"{run_name}{suffix}_export_csv")
+    return export_parquet(tables, output or f"{run_name}{suffix}_export_parquet")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Re-export kept report runs without touching the DB")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help="show the kept runs")
+    export_parser = commands.add_parser('export', help="export a kept run")
+    export_parser.add_argument('run', help="the run name (see 'list'), e.g. Shookbook_weekly_report_2025-11-02_to_2025-11-09")
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, default='xlsx', help="[xlsx]")
+    export_parser.add_argument('--sheets', help="comma separated sheet names [all sheets]")
+    export_parser.add_argument('--output', help="output file (xlsx) or folder (csv / parquet) [<run>_export.xlsx / <run>_export_csv / ...]")
+    return parser.parse_args()
+
+
+def main():
+    # imported here: only the command line needs the .env of the report scripts
+    from dotenv import load_dotenv
+    load_dotenv()
+    args = parse_args()
+
+    if args.command == 'list':
+        manifests = list_runs()
+        if not manifests:
+            print(f"No runs kept in {get_run_store_folder()}")
+        for manifest in manifests:
+            total_rows = sum(sheet_entry['rows'] for sheet_entry in manifest['sheets'])
+            print(f"  {manifest['run']}  ({manifest['report']}, {manifest['created_at']}, "
+                  f"{len(manifest['sheets'])} sheets, {total_rows} rows)")
+        return
+
+    sheet_names = [sheet_name.strip() for sheet_name in args.sheets.split(',')] if args.sheets else None
+    print(f"--- Exporting run {args.run} as {args.format} ---")
+    try:
+        written_files = export_run(args.run, args.format, sheet_names, args.output)
+    except Exception as e:
+        print(f"    > !!! FAILED !!! Export failed: {e}")
+        return
+    for written_file in written_files:
+        print(f"    > File saved: {written_file}")
+
+
+# Running the main function
+if __name__ == "__main__":
+    main()
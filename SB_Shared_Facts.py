@@ -0,0 +1,348 @@
+import pandas as pd
+
+import SB_Report_Spec
+
+
+# -----------------------------------------------------------------
+# Shared fact extraction
+# -----------------------------------------------------------------
+# Several sheets in the daily and weekly reports read the same rows:
+#   - "daily_sales_report" (every day) and "weekly products" both aggregate order lines by product
+#   - "weekly orders", "2nd month orders", "yearly orders", "yearlyOrders-orderedLastWeek",
+#     "newCust-totalOrderWithQuant" and "weekly with coupons" all read the orders table
+# Instead of one query per sheet (per day), the runner reads each "fact table" once over
+# the union of the date windows that need it, and every sheet is computed from it here,
+# with the same filters, grouping and column names as its SQL in the report scripts.
+#
+# The per-day partials (SB_Daily_Partials.py) are the same facts already summed per day, so the
+# functions below compute the sheets from either: a fact row is a partial of one order / order line
+# (as_customer_days / as_product_days). Every sheet has this one implementation, whether it's
+# computed by the runner, the backfill or --product-partials.
+# The store / status lists come from the [filters] of the report's spec (SB_Report_Spec.get_filter_values),
+# the same values its SQL uses, so a list changed in the .toml changes these sheets too.
+
+# the scripts whose spec files ([filters]) the sheets below follow
+WEEKLY_REPORT = 'SB_Weekly_Report'
+DAILY_REPORT = 'SB_Daily_Sales_Report'
+
+# one row per order line, no status/store filter (each sheet applies its own filters)
+ORDER_LINE_FACTS_SQL = """
+select
+    o.id as order_id,
+    o.delivery_date,
+    o.delivery_window,
+    o.status,
+    o.store_id,
+    op.product_id,
+    op.quantity_needed,
+    op.quantity,
+    op.quantity_delivered,
+    op.quantity_replaceable,
+    op.unit_price,
+    p.name as product_name,
+    p.name_heb as product_name_heb,
+    p.price as product_price,
+    p.low_cost_price as product_low_cost_price,
+    p.product_list,
+    p.category_id,
+    c1.id as category_row_id,
+    c1.name as category_name
+from order_product op
+         join orders o on o.id = op.order_id
+         join products p on p.id = op.product_id
+         left join categories c1 on c1.id = p.category_id
+where o.delivery_date BETWEEN '{FACT_START_DATE}' and '{FACT_END_DATE}'
+"""
+
+# one row per order
+ORDER_FACTS_SQL = """
+select
+    o.id,
+    o.customer_id,
+    o.store_id,
+    s.id as store_row_id,
+    s.name as store_name,
+    o.delivery_date,
+    o.status,
+    o.sum,
+    o.first_name,
+    o.last_name,
+    o.phone,
+    o.created_date,
+    o.discount_sum,
+    o.discount_promotions,
+    o.coupons
+from orders o
+         left join store s on s.id = o.store_id
+where o.delivery_date BETWEEN '{FACT_START_DATE}' and '{FACT_END_DATE}'
+"""
+
+FACT_QUERIES = {
+    'order_lines': ORDER_LINE_FACTS_SQL,
+    'orders': ORDER_FACTS_SQL,
+}
+
+
+def prepare_facts(fact_df):
+    """Adds a 'delivery_day' column ('YYYY-MM-DD' text) so windows compare the same way on every DB driver."""
+    fact_df = fact_df.copy()
+    fact_df['delivery_day'] = pd.to_datetime(fact_df['delivery_date']).dt.strftime('%Y-%m-%d')
+    return fact_df
+
+
+def not_in(series, values):
+    """SQL 'x NOT IN (...)': like pandas ~isin, except that NULL never passes."""
+    return series.notna() & ~series.isin(values)
+
+
+def in_window(fact_df, start_date, end_date):
+    """SQL 'delivery_date BETWEEN start and end'."""
+    return (fact_df['delivery_day'] >= start_date) & (fact_df['delivery_day'] <= end_date)
+
+
+def order_by_count_desc(result_df, count_column):
+    """ORDER BY count DESC (ties keep the grouping order, like the DB usually does)."""
+    return result_df.sort_values(count_column, ascending=False, kind='stable').reset_index(drop=True)
+
+
+def sql_sum(values):
+    """SQL SUM: NULL (not 0) when there is nothing to add up."""
+    return values.sum(min_count=1)
+
+
+def as_product_days(order_lines):
+    """
+    Order line facts in the columns of the product x day partials (each line is its own partial);
+    the partials themselves are returned as they are.
+    """
+    if 'line_count' in order_lines.columns:
+        return order_lines
+    return order_lines.assign(
+        line_count=1,
+        order_price=order_lines['unit_price'],
+        unit_price_sum=order_lines['unit_price'],
+        unit_price_count=order_lines['unit_price'].notna().astype('int64'),
+        needed_value=order_lines['quantity_needed'] * order_lines['unit_price'],
+        billed_value=order_lines['quantity'] * order_lines['unit_price'],
+        delivered_value=order_lines['quantity_delivered'] * order_lines['unit_price'],
+        replaceable_value=order_lines['quantity_replaceable'] * order_lines['unit_price'],
+    )
+
+
+def as_customer_days(orders):
+    """
+    Order facts in the columns of the customer x day partials (each order is its own partial);
+    the partials themselves are returned as they are.
+    """
+    if 'order_count' in orders.columns:
+        return orders
+    return orders.assign(
+        order_count=1,
+        sum_total=orders['sum'],
+        sum_count=orders['sum'].notna().astype('int64'),
+    )
+
+
+# -----------------------------------------------------------------
+# Sheets computed from the order line facts
+# -----------------------------------------------------------------
+
+def derive_daily_sales_report(order_lines, variables):
+    """
+    Same as the daily_sales_report query in SB_Daily_Sales_Report.py.
+    order_lines can also be the product x day partials (SB_Daily_Partials.py): they have the same
+    columns, with the quantities already summed per product / day / window / status / store.
+    """
+    # the SQL's WHERE is: (date = D AND window = 1) OR (date = D+1 AND window = 0 AND status IN ({delivered_statuses}))
+    # (AND binds before OR, so the status filter only applies to the next day's window 0)
+    wanted = (
+        ((order_lines['delivery_day'] == variables['DELIVERY_DATE']) & (order_lines['delivery_window'] == 1))
+        | ((order_lines['delivery_day'] == variables['DAY_TOMORROW']) & (order_lines['delivery_window'] == 0)
+           & order_lines['status'].isin(SB_Report_Spec.get_filter_values(DAILY_REPORT, 'delivered_statuses')))
+    )
+    lines = order_lines[wanted].assign(total_cost=lambda df: df['product_price'] * df['quantity'])
+
+    grouped = lines.groupby(
+        ['product_id', 'product_name', 'product_name_heb', 'product_price', 'product_list'],
+        dropna=False, sort=True)
+    result_df = grouped.agg(
+        needed=('quantity_needed', sql_sum),
+        supplied=('quantity', sql_sum),
+        total_cost=('total_cost', sql_sum),
+    ).reset_index()
+
+    return pd.DataFrame({
+        'מזהה מוצר': result_df['product_id'],
+        'שם מוצר': result_df['product_name'],
+        'תיאור מוצר': result_df['product_name_heb'],
+        'הכמות הנדרשת': result_df['needed'],
+        'Total_Supplied': result_df['supplied'],
+        'מחיר ליחידה': result_df['product_price'],
+        'עלות כוללת': result_df['total_cost'],
+        'רשימת מוצרים': result_df['product_list'],
+    })
+
+
+def derive_weekly_products(order_lines, variables):
+    """
+    Same as the "weekly products" query in SB_Weekly_Report.py.
+    order_lines can also be the product x day partials (SB_Daily_Partials.py).
+    """
+    product_days = as_product_days(order_lines)
+    wanted = (
+        in_window(product_days, variables['START_DATE'], variables['END_DATE'])
+        & not_in(product_days['store_id'], SB_Report_Spec.get_filter_values(WEEKLY_REPORT, 'excluded_stores'))
+        & not_in(product_days['status'], SB_Report_Spec.get_filter_values(WEEKLY_REPORT, 'excluded_statuses'))
+        # INNER JOIN categories
+        & product_days['category_row_id'].notna()
+    )
+    result_df = product_days[wanted].groupby('product_id', sort=True).agg(
+        product_name_heb=('product_name_heb', 'first'),
+        category_id=('category_id', 'first'),
+        category_name=('category_name', 'first'),
+        product_price=('product_price', 'first'),
+        product_low_cost_price=('product_low_cost_price', 'first'),
+        # "order price" isn't grouped in the SQL (the DB shows any line's price); here it's the lowest
+        order_price=('order_price', 'min'),
+        unit_price_sum=('unit_price_sum', sql_sum),
+        unit_price_count=('unit_price_count', 'sum'),
+        needed=('quantity_needed', sql_sum),
+        needed_total=('needed_value', sql_sum),
+        billed=('quantity', sql_sum),
+        billed_total=('billed_value', sql_sum),
+        delivered=('quantity_delivered', sql_sum),
+        delivered_total=('delivered_value', sql_sum),
+        replaceable=('quantity_replaceable', sql_sum),
+        replaceable_total=('replaceable_value', sql_sum),
+    ).reset_index()
+    result_df['average_price'] = (
+        result_df['unit_price_sum'] / result_df['unit_price_count'].where(result_df['unit_price_count'] > 0))
+    result_df = order_by_count_desc(result_df, 'needed')
+
+    # the SQL names four columns "total for q", so the columns are set by position
+    weekly_products_df = result_df[[
+        'product_id', 'product_name_heb', 'category_id', 'category_name', 'product_price',
+        'product_low_cost_price', 'order_price', 'average_price', 'needed', 'needed_total',
+        'billed', 'billed_total', 'delivered', 'delivered_total', 'replaceable', 'replaceable_total',
+    ]]
+    weekly_products_df.columns = [
+        'product id', 'product name', 'category id', 'category name', 'shookbook price',
+        '990 price', 'order price', 'average product price', 'order quantity by client', 'total for q',
+        'order quantity billed', 'total for q', 'order delivered', 'total for q', 'order replaceable', 'total for q',
+    ]
+    return weekly_products_df
+
+
+# -----------------------------------------------------------------
+# Sheets computed from the order facts
+# -----------------------------------------------------------------
+
+def filter_report_orders(orders, variables, statuses_filter='excluded_statuses'):
+    """
+    The WHERE shared by the customer sheets: window, {excluded_stores} out, and the statuses of
+    the statuses_filter list out (cancelled ones, or {new_customer_excluded_statuses}).
+    """
+    wanted = (
+        in_window(orders, variables['START_DATE'], variables['END_DATE'])
+        & not_in(orders['store_id'], SB_Report_Spec.get_filter_values(WEEKLY_REPORT, 'excluded_stores'))
+        & not_in(orders['status'], SB_Report_Spec.get_filter_values(WEEKLY_REPORT, statuses_filter))
+    )
+    return orders[wanted]
+
+
+def derive_customer_orders(orders, variables, last_order_since=None):
+    """
+    Same as "weekly orders" / "2nd month orders" / "yearly orders" in SB_Weekly_Report.py.
+    last_order_since adds the HAVING MAX(delivery_date) >= ... of "yearlyOrders-orderedLastWeek".
+    orders can also be the customer x day partials (SB_Daily_Partials.py).
+    """
+    report_orders = filter_report_orders(as_customer_days(orders), variables)
+    result_df = report_orders.groupby('customer_id', sort=True).agg(
+        first_order=('delivery_date', 'min'),
+        last_order=('delivery_date', 'max'),
+        last_day=('delivery_day', 'max'),
+        sum_total=('sum_total', sql_sum),
+        sum_count=('sum_count', 'sum'),
+        order_count=('order_count', 'sum'),
+        first_name=('first_name', 'first'),
+        last_name=('last_name', 'first'),
+        phone=('phone', 'first'),
+    ).reset_index()
+    result_df['average_sum'] = result_df['sum_total'] / result_df['sum_count'].where(result_df['sum_count'] > 0)
+    if last_order_since is not None:
+        result_df = result_df[result_df['last_day'] >= last_order_since]
+    result_df = order_by_count_desc(result_df, 'order_count')
+
+    return pd.DataFrame({
+        'customer_id': result_df['customer_id'],
+        'first order': result_df['first_order'],
+        'last order': result_df['last_order'],
+        'avg(o.sum)': result_df['average_sum'],
+        'count(o.id)': result_df['order_count'],
+        'first_name': result_df['first_name'],
+        'last_name': result_df['last_name'],
+        'phone': result_df['phone'],
+    })
+
+
+def derive_customer_orders_since_cutoff(orders, variables):
+    """Same as "yearlyOrders-orderedLastWeek" (customers whose last order is on/after the cutoff date)."""
+    return derive_customer_orders(orders, variables, last_order_since=variables['CUSTOMER_CUTOFF_DATE'])
+
+
+def derive_new_customers(orders, variables):
+    """
+    Same as "newCust-totalOrderWithQuant" (customers whose first order is on/after the cutoff date).
+    orders can also be the customer x day partials (SB_Daily_Partials.py).
+    """
+    report_orders = filter_report_orders(as_customer_days(orders), variables, 'new_customer_excluded_statuses')
+    # JOIN store
+    report_orders = report_orders[report_orders['store_row_id'].notna()]
+
+    group_columns = ['customer_id', 'store_id', 'store_name', 'first_name', 'last_name', 'phone']
+    result_df = report_orders.groupby(group_columns, dropna=False, sort=True).agg(
+        first_order=('delivery_date', 'min'),
+        first_day=('delivery_day', 'min'),
+        last_order=('delivery_date', 'max'),
+        sum_total=('sum_total', sql_sum),
+        sum_count=('sum_count', 'sum'),
+        order_count=('order_count', 'sum'),
+    ).reset_index()
+    result_df['avg_sum'] = result_df['sum_total'] / result_df['sum_count'].where(result_df['sum_count'] > 0)
+    result_df = result_df[result_df['first_day'] >= variables['CUSTOMER_CUTOFF_DATE']]
+    result_df = order_by_count_desc(result_df, 'order_count')
+
+    return pd.DataFrame({
+        'customer_id': result_df['customer_id'],
+        'store_id': result_df['store_id'],
+        'name': result_df['store_name'],
+        'first order': result_df['first_order'],
+        'last order': result_df['last_order'],
+        'number of orders': result_df['order_count'],
+        'avg_sum': result_df['avg_sum'],
+        'first_name': result_df['first_name'],
+        'last_name': result_df['last_name'],
+        'phone': result_df['phone'],
+    })
+
+
+def derive_orders_with_coupons(orders, variables):
+    """Same as "weekly with coupons" (one row per order, newest first)."""
+    report_orders = filter_report_orders(orders, variables)
+    report_orders = report_orders.sort_values('id', ascending=False, kind='stable')
+    return report_orders[[
+        'id', 'customer_id', 'created_date', 'sum', 'discount_sum', 'discount_promotions', 'coupons',
+    ]].reset_index(drop=True)
+
+
+# (report, query name) -> (fact table, function that computes the sheet from it)
+FACT_DERIVATIONS = {
+    ('daily', 'daily_sales_report'): ('order_lines', derive_daily_sales_report),
+    ('weekly', 'weekly products'): ('order_lines', derive_weekly_products),
+    ('weekly', 'newCust-totalOrderWithQuant'): ('orders', derive_new_customers),
+    ('weekly', 'weekly orders'): ('orders', derive_customer_orders),
+    ('weekly', '2nd month orders'): ('orders', derive_customer_orders),
+    ('weekly', 'yearly orders'): ('orders', derive_customer_orders),
+    ('weekly', 'yearlyOrders-orderedLastWeek'): ('orders', derive_customer_orders_since_cutoff),
+    ('weekly', 'weekly with coupons'): ('orders', derive_orders_with_coupons),
+}
@@ -0,0 +1,168 @@
+import os
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+
+# -----------------------------------------------------------------
+# Sheet formatting (column widths, frozen header, filter, number formats)
+# -----------------------------------------------------------------
+# Every report sheet comes out ready to read, instead of everyone auto-fitting the columns,
+# adding a filter and freezing the header by hand in every file:
+#   - column widths that fit the header and the values
+#   - the header row frozen, and an autofilter on it
+#   - numbers with thousands separators (2 decimals unless the column is whole numbers),
+#     dates without a time when the column has none
+# Formatting cell by cell after the sheet is written is very slow on big sheets, so the format
+# is worked out ONCE per result, from whole columns at a time (numpy / pandas string methods),
+# and the writers (SB_Excel_Writer.py, SB_Parallel_Excel_Writer.py) apply it as they stream
+# the rows. Text widths are measured on a sample of the rows, numbers on all of them.
+# A streamed result (read in chunks / spilled to disk) is formatted from its first chunk, so nothing
+# that a later chunk could contradict is decided from it: its decimal columns always get 2 decimals
+# (never the whole-number format) and its date columns keep the time.
+#
+# Hebrew: the niqqud / cantillation marks take no width, and the letters are a little wider than
+# Latin ones in Excel's default font, so they are counted as such.
+#
+# SB_SHEET_FORMAT=0 in .env writes the sheets plain, as before.
+
+# Excel column widths are in "characters of the default font"
+MIN_COLUMN_WIDTH = 6
+MAX_COLUMN_WIDTH = 60
+# room for the autofilter's arrow next to the header
+FILTER_BUTTON_WIDTH = 2
+COLUMN_PADDING = 1
+
+# text widths are measured on at most this many rows (spread over the whole result)
+WIDTH_SAMPLE_ROWS = 5000
+# a few very long texts shouldn't make the whole column wide
+TEXT_WIDTH_QUANTILE = 0.95
+
+HEBREW_MARKS = '[\u0591-\u05BD\u05BF\u05C1\u05C2\u05C4\u05C5\u05C7]'
+HEBREW_LETTERS = '[\u05D0-\u05EA]'
+HEBREW_LETTER_EXTRA_WIDTH = 0.1
+
+NUMBER_FORMAT = '#,##0.00'
+WHOLE_NUMBER_FORMAT = '#,##0'
+DATE_FORMAT = 'yyyy-mm-dd'
+
+# the widths of what a format shows
+DATE_WIDTH = len('2025-01-31')
+DATETIME_WIDTH = len('2025-01-31 23:59:59')
+
+
+def is_enabled():
+    return (os.getenv('SB_SHEET_FORMAT') or '1') != '0'
+
+
+def get_sample(column_values):
+    """At most WIDTH_SAMPLE_ROWS rows, evenly spread (so a sorted result is measured top to bottom)."""
+    if len(column_values) <= WIDTH_SAMPLE_ROWS:
+        return column_values
+    return column_values.iloc[::len(column_values) // WIDTH_SAMPLE_ROWS + 1]
+
+
+def get_text_widths(texts):
+    """The widths of a Series of strings, in Excel characters (Hebrew marks count 0, letters a bit more than 1)."""
+    return (texts.str.len()
+            - texts.str.count(HEBREW_MARKS)
+            + texts.str.count(HEBREW_LETTERS) * HEBREW_LETTER_EXTRA_WIDTH)
+
+
+def get_number_widths(numbers, number_format):
+    """The widths of numbers as the format shows them (digits, thousands separators, decimals, sign)."""
+    numbers = numbers[np.isfinite(numbers)]
+    if not len(numbers):
+        return np.zeros(1)
+    int_digits = np.floor(np.log10(np.maximum(np.abs(numbers), 1))) + 1
+    widths = int_digits + (numbers < 0)
+    if number_format in (NUMBER_FORMAT, WHOLE_NUMBER_FORMAT):
+        widths += (int_digits - 1) // 3
+    if number_format == NUMBER_FORMAT:
+        widths += 3
+    elif number_format is None:
+        # General shows the decimals it needs (up to about 10 characters)
+        widths += np.where(numbers % 1 != 0, 4, 0)
+    return widths
+
+
+def get_decimal_numbers(column_values):
+    """
+    An object column of Decimals (MySQL's SUM / AVG results) as floats, or None when it holds anything else.
+    (Converting every Decimal is slow, so it's a sample of them plus the column's smallest and largest,
+    which the width depends on.)
+    """
+    values = column_values.dropna()
+    if not len(values) or not isinstance(values.iloc[0], Decimal):
+        return None
+    sample = get_sample(values)
+    if not all(isinstance(value, Decimal) for value in sample):
+        return None
+    return np.array([float(value) for value in sample] + [float(values.min()), float(values.max())])
+
+
+def get_number_format(numbers):
+    """'#,##0' for whole numbers, '#,##0.00' otherwise."""
+    finite_numbers = numbers[np.isfinite(numbers)]
+    return WHOLE_NUMBER_FORMAT if np.all(finite_numbers % 1 == 0) else NUMBER_FORMAT
+
+
+def get_column_format(column_values, partial=False):
+    """
+    (number format or None for Excel's General, the widest value's width) of one column.
+    partial: the values are only the first chunk of the result.
+    """
+    kind = column_values.dtype.kind
+    if kind == 'f':
+        numbers = column_values.to_numpy(dtype=float)
+        number_format = NUMBER_FORMAT if partial else get_number_format(numbers)
+        return number_format, float(get_number_widths(numbers, number_format).max())
+    if kind in 'iu':
+        # (integer columns are mostly ids - no thousands separators)
+        return None, float(get_number_widths(column_values.to_numpy(dtype=float), None).max())
+    if kind == 'b':
+        return None, len('FALSE')
+    if kind == 'M':
+        if getattr(column_values.dtype, 'tz', None) is not None:
+            column_values = column_values.dt.tz_localize(None)
+        dates = column_values.dropna()
+        if not partial and (dates == dates.dt.normalize()).all():
+            return DATE_FORMAT, DATE_WIDTH
+        # (openpyxl / the parallel writer give datetimes 'yyyy-mm-dd h:mm:ss' already)
+        return None, DATETIME_WIDTH
+    if kind == 'm':
+        return None, len('[hh]:mm:ss') + 2
+
+    decimal_numbers = get_decimal_numbers(column_values)
+    if decimal_numbers is not None:
+        number_format = NUMBER_FORMAT if partial else get_number_format(decimal_numbers)
+        return number_format, float(get_number_widths(decimal_numbers, number_format).max())
+    texts = get_sample(column_values.dropna()).astype(str)
+    if not len(texts):
+        return None, 0
+    return None, float(get_text_widths(texts).quantile(TEXT_WIDTH_QUANTILE))
+
+
+def make_sheet_format(results_df, header, partial=False):
+    """
+    The format of one sheet, from its result (the whole DataFrame, or with partial=True the first chunk
+    of a streamed one): {'widths': [...], 'number_formats': [format or None per column],
+    'freeze_header': True, 'autofilter': True}. None when SB_SHEET_FORMAT=0.
+    """
+    if not is_enabled():
+        return None
+    header_widths = get_text_widths(pd.Series(header, dtype=object).astype(str)) if header else pd.Series([], dtype=float)
+    widths = []
+    number_formats = []
+    for position in range(len(header)):
+        number_format, value_width = get_column_format(results_df.iloc[:, position], partial)
+        number_formats.append(number_format)
+        width = max(header_widths.iloc[position] + FILTER_BUTTON_WIDTH, value_width) + COLUMN_PADDING
+        widths.append(round(min(max(width, MIN_COLUMN_WIDTH), MAX_COLUMN_WIDTH), 1))
+    return {
+        'widths': widths,
+        'number_formats': number_formats,
+        'freeze_header': True,
+        'autofilter': bool(header),
+    }
@@ -0,0 +1,354 @@
+import argparse
+import math
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import SB_DB_Governor
+import SB_Excel_Writer
+import SB_Product_Day_Store
+import SB_Report_Spec
+import SB_Shared_Facts
+
+
+# -----------------------------------------------------------------
+# Daily sketches (approximate long-window metrics)
+# -----------------------------------------------------------------
+# Distinct customers over a year, customers reached per zone and the top products
+# normally need an exact GROUP BY over a year of orders. Here every delivery day gets
+# small, mergeable sketches, kept in a local folder (one .npz file per day):
+#   - HyperLogLog of the customers (all zones, {excluded_stores} out, like "yearly orders")
+#   - HyperLogLog of the customers per zone (city group, like "zones cube")
+#   - count-min table of the quantity ordered per product + that day's top products
+#     (the candidates for the top products list)
+# A window is answered by merging its days' sketches (registers max / tables sum),
+# so a yearly answer reads 365 small files instead of a year of orders, and every
+# answer comes with its error bound. Days not sketched yet (or not final) are read
+# from the DB once, by the two small per-day queries below (not the exact product partials).
+#
+# Like the product partials store, the sketches are kept per database (one folder per DB,
+# SB_DB_Governor.get_db_folder_name, and the DB named in every file): a day sketched from
+# another DB is never used.
+#
+# This is an OPTIONAL approximate mode; the report's exact sheets don't change.
+#     py SB_Sketches.py 2025-01-01 2025-12-31
+#     py SB_Weekly_Report.py --approximate        (adds the two "(approx)" sheets)
+#
+# Optional .env settings:
+#   SB_SKETCHES_FOLDER   where the sketches are [daily_sketches next to the scripts]
+#   (a day is final after SB_PARTIALS_SETTLE_DAYS, like the product partials store)
+# The store / status lists are the [filters] of SB_Weekly_Report_spec.toml, like the exact sheets.
+
+# HyperLogLog precision: 2^p registers, relative standard error 1.04 / sqrt(2^p)
+CUSTOMER_HLL_PRECISION = 14    # 16384 registers, 0.81%
+ZONE_HLL_PRECISION = 12        # 4096 registers per zone, 1.63%
+
+# count-min table: the estimate is never below the true quantity, and with probability
+# 1 - e^-depth it is at most e / width x (all quantity in the window) above it
+COUNT_MIN_DEPTH = 4
+COUNT_MIN_WIDTH = 4096
+
+# each day keeps its top products as candidates for the window's top products
+CANDIDATES_PER_DAY = 300
+TOP_PRODUCTS = 100
+
+# one row per (day, customer, store, zone): everything the customer sketches need
+SKETCH_CUSTOMERS_SQL = """
+select o.delivery_date, o.customer_id, o.store_id, cg.description as zone
+from orders o
+         left join cities c on c.name = o.city
+         left join city_groups cg on cg.id = c.city_group_id
+where o.delivery_date BETWEEN '{SKETCH_START_DATE}' and '{SKETCH_END_DATE}'
+  and o.status NOT IN ({excluded_statuses})
+group by o.delivery_date, o.customer_id, o.store_id, cg.description
+"""
+
+# one row per (day, product): the quantity of the "weekly products" sheet (excluded stores and
+# cancelled statuses out, only products with a category)
+SKETCH_PRODUCTS_SQL = """
+select o.delivery_date, p.id as product_id, p.name_heb as product_name, sum(op.quantity_needed) as quantity
+from order_product op
+         join orders o on o.id = op.order_id
+         join products p on p.id = op.product_id
+         join categories c1 on c1.id = p.category_id
+where o.delivery_date BETWEEN '{SKETCH_START_DATE}' and '{SKETCH_END_DATE}'
+  and o.store_id NOT IN ({excluded_stores})
+  and o.status NOT IN ({excluded_statuses})
+group by o.delivery_date, p.id, p.name_heb
+"""
+
+
+def get_sketches_folder():
+    default_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'daily_sketches')
+    return os.getenv('SB_SKETCHES_FOLDER') or default_folder
+
+
+def get_sketch_filename(settings, day):
+    """The sketch file of one delivery day of the settings' DB (SB_Product_Day_Store.get_store_settings)."""
+    return os.path.join(get_sketches_folder(), SB_DB_Governor.get_db_folder_name(settings['db_identity']),
+                        day[:4], f"{day}.npz")
+
+
+# -----------------------------------------------------------------
+# Hashing, HyperLogLog and count-min (vectorized with numpy)
+# -----------------------------------------------------------------
+
+def hash64(ids, seed=0):
+    """splitmix64 of integer ids (a well mixed 64 bit hash), vectorized."""
+    with np.errstate(over='ignore'):
+        z = np.asarray(ids, dtype=np.int64).astype(np.uint64) + np.uint64((0x9E3779B97F4A7C15 * (seed + 1)) % 2**64)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def new_hll(precision):
+    return np.zeros(2 ** precision, dtype=np.uint8)
+
+
+def hll_add(registers, ids):
+    """Adds ids to a HyperLogLog (the registers are updated in place)."""
+    precision = int(math.log2(len(registers)))
+    hashes = hash64(ids)
+    buckets = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    # rank = position of the first 1 bit in the remaining 64 - p bits (frexp is exact below 2^53)
+    remaining = (hashes & np.uint64(2 ** (64 - precision) - 1)).astype(np.float64)
+    bit_lengths = np.frexp(remaining)[1]
+    ranks = (64 - precision - bit_lengths + 1).astype(np.uint8)
+    np.maximum.at(registers, buckets, ranks)
+
+
+def hll_estimate(registers):
+    """Distinct count estimate (with the small range correction)."""
+    register_count = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / register_count)
+    estimate = alpha * register_count ** 2 / np.sum(np.exp2(-registers.astype(np.float64)))
+    empty_registers = int(np.count_nonzero(registers == 0))
+    if estimate <= 2.5 * register_count and empty_registers:
+        estimate = register_count * math.log(register_count / empty_registers)
+    return estimate
+
+
+def hll_relative_error(registers):
+    """One standard error, relative (about 95% of the answers are within 2 of these)."""
+    return 1.04 / math.sqrt(len(registers))
+
+
+def new_count_min():
+    return np.zeros((COUNT_MIN_DEPTH, COUNT_MIN_WIDTH), dtype=np.float64)
+
+
+def count_min_columns(ids):
+    """The column of every id in each row of the table (one hash per row)."""
+    return [(hash64(ids, seed=row) % np.uint64(COUNT_MIN_WIDTH)).astype(np.int64) for row in range(COUNT_MIN_DEPTH)]
+
+
+def count_min_add(table, ids, quantities):
+    for row, columns in enumerate(count_min_columns(ids)):
+        np.add.at(table[row], columns, quantities)
+
+
+def count_min_estimate(table, ids):
+    return np.min([table[row][columns] for row, columns in enumerate(count_min_columns(ids))], axis=0)
+
+
+# -----------------------------------------------------------------
+# Building, saving and loading the daily sketches
+# -----------------------------------------------------------------
+
+def build_day_sketch(day_customers, day_products):
+    """The sketches of one day, from its customer rows and its product quantities (the two sketch queries)."""
+    excluded_stores = SB_Report_Spec.get_filter_values(SB_Shared_Facts.WEEKLY_REPORT, 'excluded_stores')
+    customers = day_customers[SB_Shared_Facts.not_in(day_customers['store_id'], excluded_stores)]
+    customer_registers = new_hll(CUSTOMER_HLL_PRECISION)
+    hll_add(customer_registers, customers['customer_id'].dropna())
+
+    zoned = day_customers[day_customers['zone'].notna() & (day_customers['zone'] != '')]
+    zone_names = sorted(zoned['zone'].unique())
+    zone_registers = np.zeros((len(zone_names), 2 ** ZONE_HLL_PRECISION), dtype=np.uint8)
+    for zone_number, (_, zone_rows) in enumerate(zoned.groupby('zone', sort=True)):
+        hll_add(zone_registers[zone_number], zone_rows['customer_id'].dropna())
+
+    # already filtered like "weekly products" by SKETCH_PRODUCTS_SQL
+    product_totals = day_products.groupby('product_id', sort=False).agg(
+        quantity=('quantity', 'sum'),
+        product_name=('product_name', 'first'),
+    ).reset_index()
+    product_totals = product_totals[product_totals['quantity'] > 0]
+    count_min_table = new_count_min()
+    count_min_add(count_min_table, product_totals['product_id'], product_totals['quantity'].astype(np.float64))
+    candidates = product_totals.nlargest(CANDIDATES_PER_DAY, 'quantity')
+
+    return {
+        'customers': customer_registers,
+        'zone_names': np.array(zone_names, dtype=str),
+        'zone_registers': zone_registers,
+        'count_min': count_min_table,
+        'total_quantity': np.array(float(product_totals['quantity'].sum())),
+        'candidate_ids': candidates['product_id'].to_numpy(dtype=np.int64),
+        'candidate_names': candidates['product_name'].astype(str).to_numpy(dtype=str),
+    }
+
+
+def save_day_sketch(settings, day, sketch):
+    """One compressed .npz per day, replaced atomically, with the time it was read and the DB it was read from."""
+    sketch_filename = get_sketch_filename(settings, day)
+    os.makedirs(os.path.dirname(sketch_filename), exist_ok=True)
+    temp_filename = f"{sketch_filename}.{os.getpid()}.tmp.npz"
+    np.savez_compressed(temp_filename, read_at=np.array(datetime.now().isoformat(timespec='seconds')),
+                        db_identity=np.array(settings['db_identity']), **sketch)
+    os.replace(temp_filename, sketch_filename)
+
+
+def load_day_sketch(day, settings, now):
+    """The stored sketch of one day of the settings' DB, or None if it's missing, of another DB or not final."""
+    try:
+        with np.load(get_sketch_filename(settings, day)) as stored:
+            sketch = {name: stored[name] for name in stored.files}
+        read_at = datetime.fromisoformat(str(sketch.pop('read_at')))
+        db_identity = str(sketch.pop('db_identity'))
+    except (OSError, KeyError, ValueError):
+        return None
+    if db_identity != settings['db_identity'] or not SB_Product_Day_Store.is_day_usable(settings, day, read_at, now):
+        return None
+    return sketch
+
+
+def read_day_sketches(governor, settings, days):
+    """Reads the given days from the DB (two queries per continuous span) and sketches and stores them."""
+    sketches = {}
+    for span_start, span_end in SB_Product_Day_Store.get_spans(days):
+        span_variables = {**SB_Report_Spec.get_report_filters(SB_Shared_Facts.WEEKLY_REPORT),
+                          'SKETCH_START_DATE': span_start, 'SKETCH_END_DATE': span_end}
+        span_customers = SB_Shared_Facts.prepare_facts(
+            SB_DB_Governor.read_sql(governor, SKETCH_CUSTOMERS_SQL.format_map(span_variables)))
+        span_products = SB_Shared_Facts.prepare_facts(
+            SB_DB_Governor.read_sql(governor, SKETCH_PRODUCTS_SQL.format_map(span_variables)))
+        for day in SB_Product_Day_Store.get_days(span_start, span_end):
+            sketches[day] = build_day_sketch(
+                span_customers[span_customers['delivery_day'] == day],
+                span_products[span_products['delivery_day'] == day])
+            save_day_sketch(settings, day, sketches[day])
+    return sketches
+
+
+def load_sketches(governor, start_date, end_date):
+    """
+    The daily sketches of start_date..end_date: stored ones where possible, the rest read once from the DB.
+    governor can be None - one is created only if some day has to be read.
+    """
+    # the settle / fresh settings of the product partials store, for the DB the sketches are read from
+    settings = SB_Product_Day_Store.get_store_settings(SB_Product_Day_Store.get_db_identity(governor))
+    now = datetime.now()
+    days = SB_Product_Day_Store.get_days(start_date, end_date)
+    sketches = {day: load_day_sketch(day, settings, now) for day in days}
+    days_to_read = [day for day, sketch in sketches.items() if sketch is None]
+    print(f"  > Sketches: {len(days) - len(days_to_read)} day(s) stored, {len(days_to_read)} to read from the DB.")
+    if days_to_read:
+        if governor is None:
+            db_config = SB_Product_Day_Store.get_db_config()
+            missing_config = SB_DB_Governor.get_missing_config(db_config)
+            if missing_config:
+                raise RuntimeError(f"Missing connection info: {', '.join(missing_config)}")
+            governor = SB_DB_Governor.create_governor(db_config)
+        sketches.update(read_day_sketches(governor, settings, days_to_read))
+    return [sketches[day] for day in days]
+
+
+# -----------------------------------------------------------------
+# Merging and the approximate sheets
+# -----------------------------------------------------------------
+
+def merge_sketches(sketches):
+    """One sketch for the whole window (HyperLogLog: register max, count-min: sum, candidates: union)."""
+    merged = {
+        'customers': new_hll(CUSTOMER_HLL_PRECISION),
+        'zones': {},
+        'count_min': new_count_min(),
+        'total_quantity': 0.0,
+        'candidates': {},
+    }
+    for sketch in sketches:
+        np.maximum(merged['customers'], sketch['customers'], out=merged['customers'])
+        for zone_name, zone_registers in zip(sketch['zone_names'], sketch['zone_registers']):
+            zone_name = str(zone_name)
+            if zone_name not in merged['zones']:
+                merged['zones'][zone_name] = new_hll(ZONE_HLL_PRECISION)
+            np.maximum(merged['zones'][zone_name], zone_registers, out=merged['zones'][zone_name])
+        merged['count_min'] += sketch['count_min']
+        merged['total_quantity'] += float(sketch['total_quantity'])
+        merged['candidates'].update(zip(sketch['candidate_ids'].tolist(), sketch['candidate_names'].tolist()))
+    return merged
+
+
+def make_reach_sheet(merged):
+    """"customer reach (approx)": distinct customers overall and per zone, with a 95% range."""
+    reach_rows = [('all zones', merged['customers'])] + sorted(merged['zones'].items())
+    sheet_rows = []
+    for zone_name, registers in reach_rows:
+        estimate = hll_estimate(registers)
+        margin = 2 * hll_relative_error(registers)
+        sheet_rows.append([zone_name, round(estimate), round(estimate * (1 - margin)), round(estimate * (1 + margin)),
+                           f"±{margin * 100:.1f}% (95%)"])
+    return pd.DataFrame(sheet_rows, columns=['zone', 'customers (approx)', 'low', 'high', 'error'])
+
+
+def make_top_products_sheet(merged, top_products=TOP_PRODUCTS):
+    """"top products (approx)": the candidates ranked by their count-min quantity, with the overestimate bound."""
+    if not merged['candidates']:
+        return pd.DataFrame(columns=['product id', 'product name', 'quantity (approx)', 'max overestimate'])
+    candidate_ids = np.array(list(merged['candidates']), dtype=np.int64)
+    estimates = count_min_estimate(merged['count_min'], candidate_ids)
+    top_df = pd.DataFrame({
+        'product id': candidate_ids,
+        'product name': list(merged['candidates'].values()),
+        'quantity (approx)': estimates,
+    }).sort_values(['quantity (approx)', 'product id'], ascending=[False, True], kind='stable').head(top_products)
+    # with probability 1 - e^-depth no estimate is more than this above the true quantity
+    top_df['max overestimate'] = round(math.e / COUNT_MIN_WIDTH * merged['total_quantity'], 1)
+    return top_df.reset_index(drop=True)
+
+
+def make_approximate_sheets(governor, start_date, end_date):
+    """The approximate sheets of a window: {sheet name: DataFrame}."""
+    merged = merge_sketches(load_sketches(governor, start_date, end_date))
+    return {
+        'customer reach (approx)': make_reach_sheet(merged),
+        'top products (approx)': make_top_products_sheet(merged),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Approximate customer reach and top products from the daily sketches")
+    parser.add_argument('start_date', help="YYYY-MM-DD")
+    parser.add_argument('end_date', help="YYYY-MM-DD")
+    parser.add_argument('--output', help="output file [Shookbook_approx_<start>_to_<end>.xlsx]")
+    return parser.parse_args()
+
+
+def main():
+    # imported here: only the command line needs the .env of the report scripts
+    from dotenv import load_dotenv
+    load_dotenv()
+    args = parse_args()
+
+    print(f"--- Approximate metrics: {args.start_date} to {args.end_date} ---")
+    try:
+        approximate_sheets = make_approximate_sheets(None, args.start_date, args.end_date)
+    except Exception as e:
+        print(f"    > !!! FAILED !!! Reading the sketches failed: {e}")
+        return
+
+    output_filename = args.output or f"Shookbook_approx_{args.start_date}_to_{args.end_date}.xlsx"
+    workbook = SB_Excel_Writer.open_workbook()
+    for sheet_name, sheet_df in approximate_sheets.items():
+        SB_Excel_Writer.write_sheet(workbook, sheet_name, sheet_df)
+    SB_Excel_Writer.save_workbook(workbook, output_filename)
+    print(f"    > File saved: {output_filename}")
+
+
+# Running the main function
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+import argparse
+import json
+import os
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import SB_Local_Standin_DB
+
+
+# -----------------------------------------------------------------
+# Concurrency stress test
+# -----------------------------------------------------------------
+# Simulates several people starting reports at the same time (Monday morning):
+# launches N report runs - a mix of SB_Weekly_Report.py and SB_Daily_Sales_Report.py
+# with different date windows - against a local stand-in database
+# (see SB_Local_Standin_DB.py), and reports:
+#   - throughput (reports per minute) and latency percentiles per report type
+#   - peak memory (RSS) per run, and of all runs together when psutil is installed
+#   - DB connections: most opened / in use at the same time, over all runs
+#
+#     py SB_Stress_Test.py --jobs 12 --concurrency 6
+#     py SB_Stress_Test.py --jobs 12 --max-concurrent-queries 4 --script-args=--async
+#
+# Each run is a separate process with its own working folder, exactly like a user
+# starting the script, so the numbers include imports, connecting and writing the Excel file.
+# The stores the scripts keep next to themselves (product partials, sketches, kept runs,
+# the planner's history) are moved into the run's folder too (see get_store_env), so the
+# stand-in data never mixes with - or prunes - the real ones.
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REPORT_SCRIPTS = {
+    'weekly': os.path.join(SCRIPT_FOLDER, 'SB_Weekly_Report.py'),
+    'daily': os.path.join(SCRIPT_FOLDER, 'SB_Daily_Sales_Report.py'),
+}
+
+# how often the memory sampler looks at the running processes (psutil only)
+MEMORY_SAMPLE_SECONDS = 0.2
+
+
+def build_job_list(job_count, weekly_share, year, rng):
+    """Random report runs: (report type, the answers it reads from the keyboard, a short description)."""
+    jobs = []
+    for job_number in range(1, job_count + 1):
+        # the stand-in data covers one year; leave room for the window at the end
+        start_day = date(year, 1, 1) + timedelta(days=rng.randint(0, 330))
+        if rng.random() < weekly_share:
+            end_day = start_day + timedelta(days=rng.choice([7, 7, 7, 14, 30]))
+            # "n" = don't use the last 7 days, then start, end, and an empty cutoff (= start)
+            stdin_text = f"n\n{start_day.isoformat()}\n{end_day.isoformat()}\n\n"
+            report_type = 'weekly'
+        else:
+            end_day = start_day + timedelta(days=rng.randint(0, 6))
+            stdin_text = f"{start_day.strftime('%d%m%y')}-{end_day.strftime('%d%m%y')}\n"
+            report_type = 'daily'
+        jobs.append({
+            'job_number': job_number,
+            'report': report_type,
+            'stdin_text': stdin_text,
+            'window': f"{start_day.isoformat()} to {end_day.isoformat()}",
+        })
+    return jobs
+
+
+def get_store_env(job_folder):
+    """
+    The settings that point every store the scripts write to inside the run's folder.
+    (A new store that defaults to the script folder must be added here.)
+    """
+    return {
+        'SB_CONNECTION_LOG': os.path.join(job_folder, 'connections.log'),
+        # SB_Product_Day_Store.py
+        'SB_PARTIALS_FOLDER': os.path.join(job_folder, 'product_day_partials'),
+        # SB_Sketches.py
+        'SB_SKETCHES_FOLDER': os.path.join(job_folder, 'daily_sketches'),
+        # SB_Run_Store.py (its pruning would otherwise delete real kept runs)
+        'SB_RUN_STORE_FOLDER': os.path.join(job_folder, 'report_runs'),
+        # SB_Query_Planner.py
+        'SB_PLAN_HISTORY': os.path.join(job_folder, 'query_plans.json'),
+    }
+
+
+def run_job(job, job_folder, child_env, script_args):
+    """Runs one report as its own process; returns the job with its timing, exit code and peak RSS."""
+    os.makedirs(job_folder, exist_ok=True)
+    with open(os.path.join(job_folder, 'stdin.txt'), 'w', encoding='utf-8') as stdin_file:
+        stdin_file.write(job['stdin_text'])
+
+    env = dict(child_env, **get_store_env(job_folder))
+    command = [sys.executable, REPORT_SCRIPTS[job['report']]] + script_args
+
+    with open(os.path.join(job_folder, 'stdin.txt'), encoding='utf-8') as stdin_file, \
+            open(os.path.join(job_folder, 'output.txt'), 'w', encoding='utf-8') as output_file:
+        job['started'] = time.time()
+        process = subprocess.Popen(command, cwd=job_folder, env=env,
+                                   stdin=stdin_file, stdout=output_file, stderr=subprocess.STDOUT)
+        job['pid'] = process.pid
+        if hasattr(os, 'wait4'):
+            # Linux / macOS: the OS tells us the peak RSS of the finished process
+            _, wait_status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(wait_status)
+            # ru_maxrss is in KB on Linux and in bytes on macOS
+            job['peak_rss_mb'] = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+        else:
+            process.wait()
+            job['peak_rss_mb'] = None
+        job['finished'] = time.time()
+
+    job['seconds'] = job['finished'] - job['started']
+    job['exit_code'] = process.returncode
+    with open(os.path.join(job_folder, 'output.txt'), encoding='utf-8', errors='replace') as output_file:
+        output = output_file.read()
+    # the scripts print these instead of failing, so a zero exit code isn't enough
+    job['query_errors'] = output.count('!!! FAILED !!!')
+    job['ok'] = (process.returncode == 0 and job['query_errors'] == 0
+                 and 'CRITICAL' not in output and 'connection error' not in output)
+    return job
+
+
+def sample_memory(jobs, stop_sampling, memory_samples):
+    """Every MEMORY_SAMPLE_SECONDS adds up the RSS of all running report processes (needs psutil)."""
+    import psutil
+
+    while not stop_sampling.is_set():
+        total_rss = 0
+        for job in jobs:
+            if 'pid' not in job or 'finished' in job:
+                continue
+            try:
+                process = psutil.Process(job['pid'])
+                total_rss += process.memory_info().rss
+                job['sampled_peak_rss_mb'] = max(job.get('sampled_peak_rss_mb', 0),
+                                                 process.memory_info().rss / 1024 / 1024)
+            except psutil.Error:
+                # the process just finished
+                continue
+        memory_samples.append(total_rss / 1024 / 1024)
+        stop_sampling.wait(MEMORY_SAMPLE_SECONDS)
+
+
+def read_connection_events(jobs, work_folder):
+    """
+    Reads every run's connection log (see SB_DB_Governor.log_connection_usage).
+    Returns time-sorted (time, change in open connections, change in connections in use).
+    """
+    events = []
+    for job in jobs:
+        log_filename = os.path.join(work_folder, f"job_{job['job_number']:03d}", 'connections.log')
+        if not os.path.exists(log_filename):
+            continue
+        open_now = 0
+        in_use_now = 0
+        job['connections_opened'] = 0
+        with open(log_filename, encoding='utf-8') as log_file:
+            for line in log_file:
+                event_time, _, event_name = line.split()
+                change = {'open': (1, 0), 'close': (-1, 0), 'checkout': (0, 1), 'checkin': (0, -1)}[event_name]
+                open_now += change[0]
+                job['connections_opened'] += max(change[0], 0)
+                in_use_now += change[1]
+                events.append((float(event_time), change[0], change[1]))
+        # whatever the process didn't close itself was closed when it exited
+        if open_now or in_use_now:
+            events.append((job['finished'], -open_now, -in_use_now))
+    return sorted(events)
+
+
+def get_peak_connections(events):
+    """Most connections open, and most in use (running a query), at the same moment."""
+    open_now = in_use_now = peak_open = peak_in_use = 0
+    for _, open_change, in_use_change in events:
+        open_now += open_change
+        in_use_now += in_use_change
+        peak_open = max(peak_open, open_now)
+        peak_in_use = max(peak_in_use, in_use_now)
+    return peak_open, peak_in_use
+
+
+def percentile(values, pct):
+    """Linear interpolation percentile (same as numpy's default)."""
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * pct / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(jobs, total_seconds, events, memory_samples, args):
+    """Builds the results dict (also saved with --json-out)."""
+    peak_open, peak_in_use = get_peak_connections(events)
+    summary = {
+        'jobs': len(jobs),
+        'concurrency': args.concurrency,
+        'script_args': args.script_args,
+        'max_concurrent_queries': args.max_concurrent_queries,
+        'total_seconds': total_seconds,
+        'reports_per_minute': len(jobs) / total_seconds * 60 if total_seconds else None,
+        'failed_jobs': sum(1 for job in jobs if not job['ok']),
+        'peak_open_connections': peak_open,
+        'peak_connections_in_use': peak_in_use,
+        'peak_total_rss_mb': max(memory_samples) if memory_samples else None,
+        'by_report': {},
+    }
+    for report_type in ['all'] + sorted(REPORT_SCRIPTS):
+        report_jobs = [job for job in jobs if report_type in ('all', job['report'])]
+        if not report_jobs:
+            continue
+        latencies = [job['seconds'] for job in report_jobs]
+        peak_rss_values = [job.get('peak_rss_mb') or job.get('sampled_peak_rss_mb') for job in report_jobs]
+        peak_rss_values = [value for value in peak_rss_values if value]
+        summary['by_report'][report_type] = {
+            'count': len(report_jobs),
+            'p50_seconds': percentile(latencies, 50),
+            'p90_seconds': percentile(latencies, 90),
+            'p95_seconds': percentile(latencies, 95),
+            'p99_seconds': percentile(latencies, 99),
+            'max_seconds': max(latencies),
+            'max_peak_rss_mb': max(peak_rss_values) if peak_rss_values else None,
+        }
+    summary['job_details'] = [
+        {key: job.get(key) for key in ('job_number', 'report', 'window', 'seconds', 'exit_code',
+                                       'query_errors', 'ok', 'peak_rss_mb', 'connections_opened')}
+        for job in jobs
+    ]
+    return summary
+
+
+def print_summary(summary):
+    """Prints the results table."""
+    def show(value, value_format):
+        return 'n/a' if value is None else format(value, value_format)
+
+    print("\n--- Stress test results ---")
+    print(f"Jobs: {summary['jobs']} (at most {summary['concurrency']} at once), "
+          f"DB_MAX_CONCURRENT_QUERIES={summary['max_concurrent_queries'] or 'from .env'}, "
+          f"script args: '{summary['script_args']}'")
+    print(f"Total time: {summary['total_seconds']:.1f}s  ->  "
+          f"{show(summary['reports_per_minute'], '.1f')} reports per minute")
+    print(f"Failed runs: {summary['failed_jobs']}")
+    print("")
+    print(f"{'report':<8} {'runs':>5} {'p50 s':>8} {'p90 s':>8} {'p95 s':>8} {'p99 s':>8} {'max s':>8} {'peak RSS MB':>12}")
+    for report_type, stats in summary['by_report'].items():
+        print(f"{report_type:<8} {stats['count']:>5} {stats['p50_seconds']:>8.2f} {stats['p90_seconds']:>8.2f} "
+              f"{stats['p95_seconds']:>8.2f} {stats['p99_seconds']:>8.2f} {stats['max_seconds']:>8.2f} "
+              f"{show(stats['max_peak_rss_mb'], '12.1f')}")
+    print("")
+    if summary['peak_total_rss_mb'] is not None:
+        print(f"Peak memory of all runs together: {summary['peak_total_rss_mb']:.1f} MB")
+    else:
+        print("Peak memory of all runs together: n/a (install psutil to measure it)")
+    print(f"DB connections at the same time: {summary['peak_open_connections']} open, "
+          f"{summary['peak_connections_in_use']} running a query")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run many reports at the same time against a local stand-in DB")
+    parser.add_argument('--jobs', type=int, default=8, help="number of report runs [8]")
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help="how many run at the same time [all of them]")
+    parser.add_argument('--weekly-share', type=float, default=0.5,
+                        help="share of weekly reports in the mix, 0-1 [0.5]")
+    parser.add_argument('--db-file', default='stress_standin.db',
+                        help="stand-in SQLite file, built if it doesn't exist [stress_standin.db]")
+    parser.add_argument('--orders', type=int, default=20000,
+                        help="orders in the stand-in DB when it's built [20000]")
+    parser.add_argument('--rebuild-db', action='store_true', help="build the stand-in DB again")
+    parser.add_argument('--max-concurrent-queries', type=int, default=None,
+                        help="DB_MAX_CONCURRENT_QUERIES for every run [from .env]")
+    parser.add_argument('--script-args', default='',
+                        help="extra arguments for every report run, e.g. --script-args=--async")
+    parser.add_argument('--seed', type=int, default=1, help="random seed for the job mix [1]")
+    parser.add_argument('--keep-output', action='store_true',
+                        help="keep every run's folder (Excel file, output, connection log)")
+    parser.add_argument('--json-out', help="also save the results to this JSON file")
+    args = parser.parse_args()
+    args.concurrency = args.concurrency or args.jobs
+    return args
+
+
+def main():
+    print("--- Starting report stress test ---")
+    args = parse_args()
+
+    # 1. The stand-in database
+    year = 2025
+    if args.rebuild_db or not os.path.exists(args.db_file):
+        print(f"Building stand-in database {args.db_file} ({args.orders} orders)...")
+        SB_Local_Standin_DB.build_standin_db(args.db_file, args.orders, year)
+
+    # 2. The runs - every run gets the stand-in DB, whatever is in .env
+    # (load_dotenv doesn't override variables that are already set)
+    child_env = dict(os.environ, DB_DRIVER='sqlite', DB_NAME=os.path.abspath(args.db_file),
+                     PYTHONIOENCODING='utf-8')
+    if args.max_concurrent_queries:
+        child_env['DB_MAX_CONCURRENT_QUERIES'] = str(args.max_concurrent_queries)
+    script_args = shlex.split(args.script_args)
+    jobs = build_job_list(args.jobs, args.weekly_share, year, random.Random(args.seed))
+    work_folder = tempfile.mkdtemp(prefix='sb_stress_')
+
+    # 3. Memory sampling of all runs together (optional - needs psutil)
+    memory_samples = []
+    stop_sampling = threading.Event()
+    sampler = None
+    try:
+        import psutil  # noqa: F401
+        sampler = threading.Thread(target=sample_memory, args=(jobs, stop_sampling, memory_samples), daemon=True)
+        sampler.start()
+    except ImportError:
+        pass
+
+    print(f"Running {len(jobs)} reports, {args.concurrency} at a time (working folder: {work_folder})...")
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        running_jobs = [
+            executor.submit(run_job, job, os.path.join(work_folder, f"job_{job['job_number']:03d}"),
+                            child_env, script_args)
+            for job in jobs
+        ]
+        for running_job in running_jobs:
+            job = running_job.result()
+            status = 'ok' if job['ok'] else f"FAILED (exit code {job['exit_code']}, {job['query_errors']} query errors)"
+            print(f"  > #{job['job_number']} {job['report']} {job['window']}: {job['seconds']:.1f}s {status}")
+    total_seconds = time.time() - started
+
+    stop_sampling.set()
+    if sampler is not None:
+        sampler.join()
+
+    # 4. Results
+    events = read_connection_events(jobs, work_folder)
+    summary = summarize(jobs, total_seconds, events, memory_samples, args)
+    print_summary(summary)
+
+    if args.json_out:
+        with open(args.json_out, 'w', encoding='utf-8') as json_file:
+            json.dump(summary, json_file, indent=2)
+        print(f"Results saved: {args.json_out}")
+
+    if args.keep_output:
+        print(f"Run folders kept in: {work_folder}")
+    else:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+
+# Running the main function
+if __name__ == "__main__":
+    main()
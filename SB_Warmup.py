@@ -0,0 +1,88 @@
+import importlib
+import os
+import threading
+import time
+
+from sqlalchemy import text
+
+import SB_DB_Governor
+
+
+# -----------------------------------------------------------------
+# Connection warm-up while the dates are typed
+# -----------------------------------------------------------------
+# The reports ask for the dates first and only then create the engine, which imports
+# the DB driver, opens the first connections (network, TLS, login) and imports the
+# modules the run needs later - so after pressing Enter the user waits again.
+# start_warmup() does all of that on a background thread as soon as the flags are read,
+# while the prompt is open:
+#   1. imports the modules the run will import later (e.g. SB_Product_Day_Store)
+#   2. creates the governor (engine + DB driver import)
+#   3. opens the pool's connections and runs "select 1" on each (a connectivity check),
+#      then returns them to the pool, so the first queries get a ready connection
+# A wrong .env value (host, password, database...) is printed right away, while the
+# user is still typing; the report itself stops on it after the dates, as before.
+# get_governor() waits for the thread (usually done long before) and returns the governor.
+#
+# SB_WARMUP=0 in .env turns it off (the governor is created after the dates, as before).
+
+CONNECTIVITY_CHECK_SQL = "select 1"
+
+
+def is_warmup_enabled():
+    return (os.getenv('SB_WARMUP') or '1').strip() != '0'
+
+
+def warm_up_pool(governor):
+    """Opens one connection per query slot at once and checks each, then returns them all to the pool."""
+    connections = []
+    try:
+        for _ in range(governor['settings']['max_concurrent_queries']):
+            connection = governor['engine'].connect()
+            connections.append(connection)
+            connection.execute(text(CONNECTIVITY_CHECK_SQL)).fetchall()
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def run_warmup(warmup, db_config, modules):
+    started = time.perf_counter()
+    try:
+        for module_name in modules:
+            importlib.import_module(module_name)
+        governor = SB_DB_Governor.create_governor(db_config)
+        warm_up_pool(governor)
+        warmup['governor'] = governor
+    except Exception as e:
+        warmup['error'] = e
+        # printed now, in the middle of the prompt, so a bad .env is seen before the dates are typed
+        print(f"\n  > !!! FAILED !!! Database check failed: {str(e).splitlines()[0] if str(e) else repr(e)}")
+        print("  > Check the DB_ values in the .env file (the report stops after the dates are entered).")
+    warmup['seconds'] = time.perf_counter() - started
+
+
+def start_warmup(db_config, modules=()):
+    """
+    Starts the warm-up thread and returns its state ({'governor', 'error', ...}),
+    or None when it's turned off or the connection details are missing (main reports that).
+    """
+    if not is_warmup_enabled() or SB_DB_Governor.get_missing_config(db_config):
+        return None
+    warmup = {'governor': None, 'error': None, 'seconds': None}
+    # a daemon thread, so a Ctrl+C at the prompt doesn't wait for a slow connection
+    warmup['thread'] = threading.Thread(target=run_warmup, args=(warmup, db_config, list(modules)),
+                                        name='sb-warmup', daemon=True)
+    warmup['thread'].start()
+    return warmup
+
+
+def get_governor(warmup, db_config):
+    """The warmed-up governor (waits for the thread if it's still connecting); raises the warm-up's error."""
+    if warmup is None:
+        return SB_DB_Governor.create_governor(db_config)
+    warmup['thread'].join()
+    if warmup['error'] is not None:
+        raise warmup['error']
+    print(f"  > Connection ready (warmed up in {warmup['seconds']:.2f}s while the dates were entered)")
+    return warmup['governor']
@@ -0,0 +1,163 @@
+import re
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import SB_Memory_Budget
+import SB_Run_Store
+
+
+# -----------------------------------------------------------------
+# Week-over-week comparison sheets
+# -----------------------------------------------------------------
+# Every weekly run is kept in the run store (SB_Run_Store.py). When the previous week's
+# run is there, the report adds a "... vs last week" sheet for products, zones and
+# packing: the current and the previous results are joined on their keys (one outer
+# merge per sheet, no extra DB query) and every value gets
+#   <value>, <value> last week, <value> change, <value> change %
+# plus a "status" column: 'new' (only this week) / 'gone' (only last week) / empty (both).
+#
+# The previous run is the kept weekly run of a window as long as this one that ends on
+# this window's start day or the day before it (back-to-back weekly runs share their
+# boundary day, e.g. 2025-02-22 to 2025-03-01 and 2025-03-01 to 2025-03-08). With no such
+# run there is no comparison - a week of another length, or one further back, would give
+# misleading changes. A run of the same week (a rerun) is never compared with itself.
+# Every comparison sheet says which window it was compared with ("compared with" column).
+# To add a comparison: register it in COMPARISONS below.
+
+# comparison sheet: (source sheet, key columns, label columns, value columns)
+COMPARISONS = {
+    'products vs last week': (
+        'weekly products', ['product id'], ['product name', 'category name'],
+        ['order quantity by client', 'total for q', 'order quantity billed', 'order delivered', 'order replaceable'],
+    ),
+    'zones vs last week': (
+        'weekly by zones', ['store_id', 'description'], ['name'],
+        ['count(o.id)', 'sum(o.sum)'],
+    ),
+    'packing vs last week': (
+        'packing by employee', ['packing_worker_id'], ['first_name', 'last_name'],
+        ['orders', 'units', 'type 1 units', 'order value', 'orders per day', 'units per day', 'units per order'],
+    ),
+}
+
+# the dates at the end of a weekly run's name (Shookbook_weekly_report_<start>_to_<end>)
+RUN_DATES_PATTERN = r'_(\d{4}-\d{2}-\d{2})_to_(\d{4}-\d{2}-\d{2})$'
+
+
+def get_window_days(start_date, end_date):
+    """Days from start_date to end_date (YYYY-MM-DD)."""
+    return (datetime.strptime(end_date, '%Y-%m-%d') - datetime.strptime(start_date, '%Y-%m-%d')).days
+
+
+def find_previous_run(start_date, end_date):
+    """
+    The kept weekly run of the window right before start_date - as long as this window, ending on
+    start_date or the day before - as (run name, its start date, its end date); None if there is none.
+    """
+    window_days = get_window_days(start_date, end_date)
+    day_before_start = (datetime.strptime(start_date, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+    previous_runs = []
+    for manifest in SB_Run_Store.list_runs():
+        dates_match = re.search(RUN_DATES_PATTERN, manifest['run'])
+        if manifest.get('report') != 'weekly' or not dates_match:
+            continue
+        run_start, run_end = dates_match.group(1), dates_match.group(2)
+        if (run_start, run_end) == (start_date, end_date):
+            # a rerun of this window
+            continue
+        if day_before_start <= run_end <= start_date and get_window_days(run_start, run_end) == window_days:
+            previous_runs.append((run_end, manifest['created_at'], manifest['run'], run_start))
+    if not previous_runs:
+        return None
+    run_end, _, run_name, run_start = max(previous_runs)
+    return run_name, run_start, run_end
+
+
+def table_to_df(table):
+    """A stored sheet as a DataFrame with its real column names (repeated names like "total for q" included)."""
+    if table.num_rows == 0:
+        return pd.DataFrame(columns=table.column_names)
+    return pd.concat(list(SB_Run_Store.iter_table_chunks(table)), ignore_index=True)
+
+
+def prepare_side(results_df, key_columns, label_columns, value_columns):
+    """The key, label and value columns of one week (the first one of a repeated name), values as numbers."""
+    results_df = results_df.loc[:, ~results_df.columns.duplicated()]
+    missing_columns = [column for column in key_columns + label_columns + value_columns if column not in results_df.columns]
+    if missing_columns:
+        raise KeyError(f"missing columns: {', '.join(missing_columns)}")
+    side_df = results_df[key_columns + label_columns + value_columns].copy()
+    side_df[value_columns] = side_df[value_columns].apply(pd.to_numeric, errors='coerce')
+    # a key should be one row per week; if not, its rows are added up
+    return side_df.groupby(key_columns, sort=False, dropna=False).agg(
+        {**{column: 'first' for column in label_columns}, **{column: 'sum' for column in value_columns}}
+    ).reset_index()
+
+
+def align_key_types(current_df, previous_df, key_columns):
+    """Keys read back from the store can come with another dtype (e.g. int64 vs object) - those are compared as text."""
+    for column in key_columns:
+        if current_df[column].dtype != previous_df[column].dtype:
+            current_df[column] = current_df[column].astype('string')
+            previous_df[column] = previous_df[column].astype('string')
+
+
+def compare_weeks(current_df, previous_df, key_columns, label_columns, value_columns):
+    """One row per key of either week, with the change of every value (absolute and %)."""
+    current_df = prepare_side(current_df, key_columns, label_columns, value_columns)
+    previous_df = prepare_side(previous_df, key_columns, label_columns, value_columns)
+    align_key_types(current_df, previous_df, key_columns)
+
+    merged_df = current_df.merge(previous_df, on=key_columns, how='outer', suffixes=('', ' last week'), indicator=True)
+    comparison_df = merged_df[key_columns].copy()
+    # a product that is gone this week still gets its name from last week
+    for column in label_columns:
+        comparison_df[column] = merged_df[column].combine_first(merged_df[f"{column} last week"])
+    comparison_df['status'] = merged_df['_merge'].map({'left_only': 'new', 'right_only': 'gone', 'both': ''}).astype(str)
+
+    for column in value_columns:
+        current_values = merged_df[column].fillna(0)
+        previous_values = merged_df[f"{column} last week"].fillna(0)
+        change = (current_values - previous_values).round(2)
+        comparison_df[column] = current_values
+        comparison_df[f"{column} last week"] = previous_values
+        comparison_df[f"{column} change"] = change
+        # no % change from 0
+        comparison_df[f"{column} change %"] = (change / previous_values.where(previous_values != 0) * 100).round(1)
+
+    # this week's keys first, the gone ones at the end
+    return comparison_df.sort_values('status', key=lambda status: status.eq('gone'), kind='stable').reset_index(drop=True)
+
+
+def make_comparison_sheets(results, start_date, end_date):
+    """
+    {comparison sheet: DataFrame} against the kept weekly run of the previous window; {} when there is none.
+    A comparison that can't be made becomes an 'Error' sheet, the others are still made.
+    """
+    previous_run = find_previous_run(start_date, end_date)
+    if previous_run is None:
+        print("    > No weekly run of the window before this one is kept (report_runs, same length, ending on "
+              f"{start_date} or the day before), so there are no comparison sheets this time.")
+        return {}
+    previous_run_name, previous_start, previous_end = previous_run
+    print(f"    > Comparing with: {previous_run_name}")
+    previous_tables = SB_Run_Store.load_run_tables(previous_run_name)
+
+    comparison_sheets = {}
+    for comparison_sheet_name, (source_name, key_columns, label_columns, value_columns) in COMPARISONS.items():
+        if source_name not in results or source_name not in previous_tables:
+            continue
+        try:
+            current_df = SB_Memory_Budget.load_result(results[source_name])
+            previous_df = table_to_df(previous_tables[source_name])
+            if list(current_df.columns) == ['Error'] or list(previous_df.columns) == ['Error']:
+                raise ValueError(f"'{source_name}' failed in one of the weeks")
+            comparison_df = compare_weeks(current_df, previous_df, key_columns, label_columns, value_columns)
+            comparison_df['compared with'] = f"{previous_start} to {previous_end}"
+            comparison_sheets[comparison_sheet_name] = comparison_df
+            print(f"    > Compared '{source_name}' ({len(comparison_sheets[comparison_sheet_name])} rows).")
+        except Exception as e:
+            print(f"    > !!! FAILED !!! Comparison sheet '{comparison_sheet_name}' could not be computed: {e}")
+            comparison_sheets[comparison_sheet_name] = pd.DataFrame({'Error': [str(e)]})
+    return comparison_sheets
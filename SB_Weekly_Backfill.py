@@ -0,0 +1,246 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import SB_DB_Governor
+import SB_Daily_Partials
+import SB_Product_Day_Store
+import SB_Report_Runner
+import SB_Report_Spec
+import SB_Shared_Facts
+import SB_Weekly_Report
+
+
+# -----------------------------------------------------------------
+# Weekly report backfill
+# -----------------------------------------------------------------
+# Writes the weekly report for many windows in one non-interactive run
+# (e.g. a year of weeks), reading every day of the covered span from the DB ONCE:
+#   - customer sheets  <- per-day customer partials, merged per window
+#   - "weekly products" <- per-day product partials, merged per window (from the partials store,
+#     SB_Product_Day_Store.py: days already stored aren't read again, new ones are stored)
+#     (both merged by the same SB_Shared_Facts.derive_* functions the unified runner uses)
+#   - row level sheets ("packing", "weekly - missing in orders", "weekly with coupons",
+#     "zones cube") <- run once over the whole span, then split into windows by day
+# Each window's workbook is then written like the unified runner writes it (SB_Report_Runner.write_report):
+# derived sheets (SB_Derived_Sheets.py), the "... vs last week" sheets (SB_Week_Compare.py) and
+# the kept run (SB_Run_Store.py). The windows run oldest first, so each one is compared with
+# the window before it.
+# A query not listed below (e.g. a new one added to SB_Weekly_Report_spec.toml), or one with its
+# own window_days in the spec, still runs once per window.
+#
+#     py SB_Weekly_Backfill.py --weeks 2025-01-05 2025-12-28
+#     py SB_Weekly_Backfill.py --windows-file windows.txt
+#
+# windows.txt has one window per line: START END [CUTOFF] (YYYY-MM-DD, cutoff defaults to START).
+
+# weekly sheet -> (partial it is assembled from, function(partial, DATE_RANGE) that assembles it)
+PARTIAL_SHEETS = {
+    'newCust-totalOrderWithQuant': ('customer_days', SB_Shared_Facts.derive_new_customers),
+    'weekly products': ('product_days', SB_Shared_Facts.derive_weekly_products),
+    'weekly orders': ('customer_days', SB_Shared_Facts.derive_customer_orders),
+    '2nd month orders': ('customer_days', SB_Shared_Facts.derive_customer_orders),
+    'yearly orders': ('customer_days', SB_Shared_Facts.derive_customer_orders),
+    'yearlyOrders-orderedLastWeek': ('customer_days', SB_Shared_Facts.derive_customer_orders_since_cutoff),
+}
+
+# weekly sheets with one row per order / order line: read once over the span, split by day
+ROW_LEVEL_SHEETS = ['packing', 'weekly - missing in orders', 'weekly with coupons', 'zones cube']
+
+
+def get_row_level_sheets():
+    """The row level sheets read over the spans (not the ones with their own window in the spec)."""
+    return [sheet_name for sheet_name in ROW_LEVEL_SHEETS
+            if not SB_Report_Spec.has_own_window(SB_Weekly_Report.REPORT_SPEC, sheet_name)]
+
+
+def get_weekly_windows(first_start, last_start, window_days=7):
+    """Consecutive windows of window_days days, starting every window_days days (cutoff = window start)."""
+    windows = []
+    start_day = datetime.strptime(first_start, '%Y-%m-%d')
+    last_day = datetime.strptime(last_start, '%Y-%m-%d')
+    while start_day <= last_day:
+        start_date = start_day.strftime('%Y-%m-%d')
+        end_date = (start_day + timedelta(days=window_days - 1)).strftime('%Y-%m-%d')
+        windows.append((start_date, end_date, start_date))
+        start_day += timedelta(days=window_days)
+    return windows
+
+
+def read_windows_file(windows_filename):
+    """Reads 'START END [CUTOFF]' lines (empty lines and # comments are skipped)."""
+    windows = []
+    with open(windows_filename, encoding='utf-8') as windows_file:
+        for line in windows_file:
+            parts = line.split('#')[0].split()
+            if not parts:
+                continue
+            if len(parts) not in (2, 3):
+                raise ValueError(f"expected 'START END [CUTOFF]', got: {line.strip()}")
+            windows.append((parts[0], parts[1], parts[2] if len(parts) == 3 else parts[0]))
+    return windows
+
+
+def read_span(governor, source_name, sql_query):
+    """Runs one span query; a failed query gives an 'Error' table (the windows that need it show it)."""
+    print(f"  > Reading '{source_name}'...")
+    try:
+        results_df = SB_DB_Governor.read_sql(governor, sql_query)
+        print(f"    > Success! '{source_name}' has {len(results_df)} rows.")
+        return results_df
+    except Exception as e:
+        print(f"    > !!! FAILED !!! Reading '{source_name}' failed: {e}")
+        return pd.DataFrame({'Error': [str(e)]})
+
+
+def read_stored_product_days(governor, start_date, end_date):
+    """The product partials of one span from the partials store; a failure gives an 'Error' table."""
+    print(f"  > Reading 'product_days' {start_date} to {end_date}...")
+    try:
+        return SB_Product_Day_Store.load_product_days(governor, start_date, end_date)
+    except Exception as e:
+        print(f"    > !!! FAILED !!! Reading 'product_days' failed: {e}")
+        return pd.DataFrame({'Error': [str(e)]})
+
+
+def read_spans(governor, spans):
+    """Reads the partials and the row level sheets for every span; returns {source name: DataFrame}."""
+    span_queries = {}
+    # the product partials come from the partials store (below)
+    partial_names = sorted({partial_name for partial_name, _ in PARTIAL_SHEETS.values()} - {'product_days'})
+    for start_date, end_date in spans:
+        span_range = {'START_DATE': start_date, 'END_DATE': end_date, 'CUSTOMER_CUTOFF_DATE': start_date}
+        for partial_name in partial_names:
+            span_queries.setdefault(partial_name, []).append(
+                SB_Daily_Partials.format_partial_query(partial_name, start_date, end_date))
+        for sheet_name in get_row_level_sheets():
+            span_queries.setdefault(sheet_name, []).append(SB_Daily_Partials.add_row_day_column(
+                SB_Weekly_Report.ALL_QUERIES[sheet_name].format_map(span_range)))
+
+    max_workers = governor['settings']['max_concurrent_queries']
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running_reads = {
+            source_name: [executor.submit(read_span, governor, source_name, sql_query) for sql_query in sql_queries]
+            for source_name, sql_queries in span_queries.items()
+        }
+        running_reads['product_days'] = [
+            executor.submit(read_stored_product_days, governor, start_date, end_date) for start_date, end_date in spans]
+
+    sources = {}
+    for source_name, reads in running_reads.items():
+        span_dfs = [running_read.result() for running_read in reads]
+        failed = [span_df for span_df in span_dfs if list(span_df.columns) == ['Error']]
+        if failed:
+            sources[source_name] = failed[0]
+        elif source_name == 'product_days':
+            # already prepared by the store
+            sources[source_name] = pd.concat(span_dfs, ignore_index=True)
+        elif source_name in SB_Daily_Partials.PARTIAL_QUERIES:
+            sources[source_name] = SB_Daily_Partials.prepare_partials(pd.concat(span_dfs, ignore_index=True))
+        else:
+            sources[source_name] = pd.concat(span_dfs, ignore_index=True)
+    return sources
+
+
+def assemble_window(governor, sources, start_date, end_date, cutoff_date):
+    """Builds one window's {sheet name: DataFrame} in the ALL_QUERIES order, from the span sources (no derived sheets yet)."""
+    DATE_RANGE = {'START_DATE': start_date, 'END_DATE': end_date, 'CUSTOMER_CUTOFF_DATE': cutoff_date}
+    queries_results_to_export = {}
+    for sheet_name, sql_query in SB_Weekly_Report.ALL_QUERIES.items():
+        try:
+            if SB_Report_Spec.has_own_window(SB_Weekly_Report.REPORT_SPEC, sheet_name):
+                # a sheet with its own window_days (SB_Weekly_Report_spec.toml) isn't covered by the spans
+                results_table_df = SB_Weekly_Report.run_report_query(
+                    governor, sheet_name, sql_query,
+                    SB_Report_Spec.get_sheet_variables(SB_Weekly_Report.REPORT_SPEC, sheet_name, DATE_RANGE))
+            elif sheet_name in PARTIAL_SHEETS:
+                partial_name, assemble_sheet = PARTIAL_SHEETS[sheet_name]
+                source_df = sources[partial_name]
+                if list(source_df.columns) == ['Error']:
+                    results_table_df = source_df
+                else:
+                    results_table_df = assemble_sheet(source_df, DATE_RANGE)
+            elif sheet_name in ROW_LEVEL_SHEETS:
+                source_df = sources[sheet_name]
+                if list(source_df.columns) == ['Error']:
+                    results_table_df = source_df
+                else:
+                    results_table_df = SB_Daily_Partials.rows_in_window(source_df, start_date, end_date)
+            else:
+                # not covered by the span sources - runs for this window only
+                results_table_df = SB_Weekly_Report.run_report_query(governor, sheet_name, sql_query, DATE_RANGE)
+        except Exception as e:
+            print(f"    > !!! FAILED !!! Sheet '{sheet_name}' could not be assembled: {e}")
+            results_table_df = pd.DataFrame({'Error': [str(e)]})
+        queries_results_to_export[sheet_name] = results_table_df
+    return queries_results_to_export
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write the weekly report for many windows in one run")
+    parser.add_argument('--weeks', nargs=2, metavar=('FIRST_START', 'LAST_START'),
+                        help="one window every --window-days days, from FIRST_START up to LAST_START (YYYY-MM-DD)")
+    parser.add_argument('--window-days', type=int, default=7, help="days in each --weeks window [7]")
+    parser.add_argument('--windows-file', help="file with one 'START END [CUTOFF]' window per line")
+    parser.add_argument('--output-folder', default='backfill_reports',
+                        help="where the workbooks are written [backfill_reports]")
+    args = parser.parse_args()
+    if not args.weeks and not args.windows_file:
+        parser.error("give --weeks or --windows-file")
+    return args
+
+
+def main():
+    print("--- Starting weekly report backfill ---")
+    args = parse_args()
+
+    windows = []
+    if args.weeks:
+        windows.extend(get_weekly_windows(args.weeks[0], args.weeks[1], args.window_days))
+    if args.windows_file:
+        windows.extend(read_windows_file(args.windows_file))
+    if not windows:
+        print("No windows to run.")
+        return
+
+    # every day any window needs, as few continuous spans as possible
+    spans = SB_Report_Runner.merge_windows([(start_date, end_date) for start_date, end_date, _ in windows])
+    covered_days = sum(
+        (datetime.strptime(end_date, '%Y-%m-%d') - datetime.strptime(start_date, '%Y-%m-%d')).days + 1
+        for start_date, end_date in spans)
+    print(f"{len(windows)} windows, covering {covered_days} days in {len(spans)} span(s).")
+
+    missing_config = SB_DB_Governor.get_missing_config(SB_Weekly_Report.DB_CONFIG)
+    if missing_config:
+        print(" ERROR: Not all connection details are defined in/loaded from .env file.")
+        print(f"Missing connection info: {', '.join(missing_config)}")
+        return
+    try:
+        governor = SB_DB_Governor.create_governor(SB_Weekly_Report.DB_CONFIG)
+        print("Database connection successful!")
+    except Exception as e:
+        print(f"Database connection error: {e}")
+        return
+
+    # 1. Read every day once
+    sources = read_spans(governor, spans)
+
+    # 2. Assemble and write each window, oldest first (each one is compared with the one kept before it)
+    os.makedirs(args.output_folder, exist_ok=True)
+    for start_date, end_date, cutoff_date in sorted(windows):
+        print(f"\nWindow {start_date} to {end_date} (cutoff {cutoff_date}):")
+        queries_results_to_export = assemble_window(governor, sources, start_date, end_date, cutoff_date)
+        # the same workbook, comparison sheets and kept run as the weekly report from the unified runner
+        window_spec = SB_Report_Runner.weekly_report_spec(start_date, end_date, cutoff_date)
+        window_spec['output_filename'] = os.path.join(args.output_folder, window_spec['output_filename'])
+        SB_Report_Runner.write_report(window_spec, queries_results_to_export)
+
+    print("\n--- Backfill completed! ---")
+
+
+# Running the main function
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,31 @@
+import SB_Profiler
+# with --profile the imports and .env loading below are measured too (see SB_Profiler.py)
+if SB_Profiler.enable_if_requested():
+    SB_Profiler.begin_stage('imports')
+
 import pandas as pd
-from sqlalchemy import create_engine
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import os
 import sys
+import argparse
 from dotenv import load_dotenv 
 
+import SB_DB_Governor
+import SB_Derived_Sheets
+import SB_Excel_Writer
+import SB_Master_Workbook
+import SB_Memory_Budget
+import SB_Preview
+import SB_Query_Planner
+import SB_Report_Spec
+import SB_Run_Store
+import SB_Warmup
+import SB_Week_Compare
+
 
 
+SB_Profiler.begin_stage('config: load_dotenv')
 load_dotenv()
 
 
@@ -32,254 +51,10 @@ DB_CONFIG = {
 #    """
 #     }
 
-ALL_QUERIES = {
-
-    "newCust-totalOrderWithQuant": """
-select
-    o.customer_id,
-    o.store_id,
-    s.name,
-    MIN(o.delivery_date) as "first order",
-    MAX(o.delivery_date) as "last order",
-    COUNT(o.delivery_date) as "number of orders",
-    avg(o.sum) as avg_sum,
-    o.first_name,
-    o.last_name,
-    o.phone
-from orders o
-         join store s on s.id = o.store_id
-where o.delivery_date BETWEEN '{START_DATE}' and '{END_DATE}'
-  AND o.store_id NOT IN ('84', '85')
-  AND o.status NOT IN(4,11,1)
-group by o.customer_id, o.store_id, s.name, o.first_name, o.last_name, o.phone
-having MIN(o.delivery_date) >= '{CUSTOMER_CUTOFF_DATE}'
-order by count(o.id) desc;
-""",
-
-"packing": """
-select
-    o.id,
-    o.wp_id,
-    o.delivery_date,
-    o.delivery_window,
-    o.status,
-    o.clearing_status,
-    o.dhl_package_number,
-    o.is_deleted,
-    o.sum as "order sum",
--- o.snh as "delivery fee",
-    SUM(op.quantity_needed) "total_order_quantity_needed",
-    SUM(op.quantity) as "total_order_quantity",
-    SUM(CASE WHEN p.packing_action = 1 THEN op.quantity ELSE 0 END) AS type_1_quantity,
-    o.store_id,
-    s.name,
-    o.packing_worker_id,
-    wp.first_name,
-    wp.last_name
-from orders o
-         join order_product op on op.order_id = o.id
-         join store s on s.id = o.store_id
-         join products p on p.id = op.product_id
-         left join workers wp on wp.id = o.packing_worker_id
-         left join workers wd on wd.id = o.dispatcher_worker_id
-where o.delivery_date BETWEEN '{START_DATE}' and '{END_DATE}'
-  and o.status NOT IN (4,11)
-group by o.id,o.delivery_date
-order by o.delivery_date desc;
-""",
-
-"packing by employee": """
-
-select
-    o.packing_worker_id,
-    wp.first_name,
-    wp.last_name,
-    count(DISTINCT o.id),
-    sum(op.quantity),
-    sum(DISTINCT o.sum)
-from orders o
-         join order_product op on op.order_id = o.id
-         left join workers wp on wp.id = o.packing_worker_id
-where o.delivery_date BETWEEN '{START_DATE}' and '{END_DATE}'
-  and o.status NOT IN (4,11)
-group by o.packing_worker_id
-order by count(o.id) desc;
-""",
-
-"weekly - missing in orders": """
-select
-    o.store_id,
-    s.name,
-    o.id as "order id",
-    o.sum as "order sum",
-    op.quantity_needed as "order quantity",
-    op.quantity as "delivered quantity",
-    op.quantity_needed - op.quantity as "missing quantity",
-    op.product_id,
-    p.name,
-    p.name_heb,
-    p.name_weight,
-    o.packing_worker_id,
-    w.first_name,
-    w.last_name
-from orders o
-         join order_product op on op.order_id = o.id
-         join products p on p.id = op.product_id
-         join store s on s.id = o.store_id
-         join workers w on w.id = o.packing_worker_id
-where o.delivery_date BETWEEN '{START_DATE}' and '{END_DATE}'
-  and op.quantity_needed > op.quantity
-  and o.store_id NOT IN (82,84,85)
-  and o.status NOT IN (4,11)
-order by o.id desc;
-""",
-
-"weekly products": """
-#weekly products
-SELECT
-    p.id AS "product id",
-    p.name_heb AS "product name",
-    p.category_id AS "category id",
-    c1.name AS "category name",
-    p.price AS "shookbook price",
-    p.low_cost_price AS "990 price",
-    op.unit_price AS "order price",
-    AVG(op.unit_price) AS "average product price",
-    SUM(op.quantity_needed) AS "order quantity by client",
-    SUM(op.quantity_needed * op.unit_price) AS "total for q",
-    SUM(op.quantity) AS "order quantity billed",
-    SUM(op.quantity * op.unit_price) AS "total for q",
-    SUM(op.quantity_delivered) AS "order delivered",
-    SUM(op.quantity_delivered * op.unit_price) AS "total for q",
-    SUM(op.quantity_replaceable) AS "order replaceable",
-    SUM(op.quantity_replaceable * op.unit_price) AS "total for q"
-FROM order_product op
-         INNER JOIN orders o ON op.order_id = o.id
-         INNER JOIN products p ON op.product_id = p.id
-         INNER JOIN categories c1 ON p.category_id = c1.id
-WHERE o.delivery_date BETWEEN '{START_DATE}' and '{END_DATE}'
-    and o.store_id NOT IN ('84', '85')
-    and o.status NOT IN (4,11)
-GROUP BY p.id, p.name
-ORDER BY SUM(op.quantity_needed) DESC;
-""",
-
-"weekly orders": """
-#weekly orders
-select
-    o.customer_id,
-    MIN(o.delivery_date) as "first order",
-    MAX(o.delivery_date) as "last order",
-    avg(o.sum),
-    count(o.id),
-    o.first_name,
-    o.last_name,
-    o.phone
-from orders o
-where o.delivery_date BETWEEN '{START_DATE}' and '{END_DATE}'
-  and o.store_id NOT IN ('84', '85')
-  and o.status NOT IN (4,11)
-group by o.customer_id
-order by count(o.id) desc;
-""",
-
-"2nd month orders": """
-#2nd month orders
-select
-    o.customer_id,
-    MIN(o.delivery_date) as "first order",
-    MAX(o.delivery_date) as "last order",
-    avg(o.sum),
-    count(o.id),
-    o.first_name,
-    o.last_name,
-    o.phone
-from orders o
-where o.delivery_date BETWEEN '{START_DATE}' and '{END_DATE}'
-  and o.store_id NOT IN ('84', '85')
-  and o.status NOT IN (4,11)
-group by o.customer_id
-order by count(o.id) desc;
-""",
-
-"yearly orders": """
-select
-    o.customer_id,
-    MIN(o.delivery_date) as "first order",
-    MAX(o.delivery_date) as "last order",
-    avg(o.sum),
-    count(o.id),
-    o.first_name,
-    o.last_name,
-    o.phone
-from orders o
-where o.delivery_date BETWEEN '{START_DATE}' and '{END_DATE}'
-  and o.store_id NOT IN ('84', '85')
-  and o.status NOT IN(4,11)
-group by o.customer_id
-order by count(o.id) desc;
-""",
-
-"yearlyOrders-orderedLastWeek": """
-select
-    o.customer_id,
-    MIN(o.delivery_date) as "first order",
-    MAX(o.delivery_date) as "last order",
-    avg(o.sum),
-    count(o.id),
-    o.first_name,
-    o.last_name,
-    o.phone
-from orders o
-where o.delivery_date BETWEEN '{START_DATE}' and '{END_DATE}'
-  and o.store_id NOT IN ('84', '85')
-  and o.status NOT IN (4,11)
-group by o.customer_id
-having MAX(o.delivery_date) >= '{CUSTOMER_CUTOFF_DATE}'
-order by count(o.id) desc;
-""",
-
-"weekly with coupons": """
-#weekly with coupons
-select o.id, o.customer_id, o.created_date, o.sum, o.discount_sum, o.discount_promotions, o.coupons
-from orders o
-where o.delivery_date BETWEEN '{START_DATE}' and '{END_DATE}'
-  and o.store_id NOT IN ('84', '85')
-  and o.status NOT IN(4,11)
-order by o.id desc;
-""",
-
-"weekly by zones": """
-#weekly by zones
-select o.store_id, s.name, cg.description, count(o.id), sum(o.sum)
-from orders o
-         join cities c on c.name = o.city
-         join city_groups cg on cg.id = c.city_group_id
-         join store s on s.id = o.store_id
-WHERE o.delivery_date BETWEEN '{START_DATE}' and '{END_DATE}'
--- and o.store_id NOT IN (84)
-    and cg.description != ''
-    and o.status NOT IN (4,11)
-group by o.store_id, s.name, cg.description;
--- order by cg.description ASC
-""",
-
-"weekly_zones_by_desc": """
-select o.store_id, s.name, count(o.id), cg.description, sum(o.sum)
-from orders o
-         join cities c on c.name = o.city
-         join city_groups cg on cg.id = c.city_group_id
-         join store s on s.id = o.store_id
-    WHERE o.delivery_date BETWEEN '{START_DATE}' and '{END_DATE}'
-    and o.store_id NOT IN (84)
-    and cg.description != ''
-    and o.status NOT IN (4,11)
-group by
-      cg.description
-order by count(o.id) desc
-""",
-
-}
+#the queries themselves are in SB_Weekly_Report_spec.toml (see SB_Report_Spec.py), with the
+#store / status filters they share written once there
+REPORT_SPEC = SB_Report_Spec.load_spec(SB_Report_Spec.get_spec_filename('SB_Weekly_Report'))
+ALL_QUERIES = SB_Report_Spec.get_queries(REPORT_SPEC)
 
 
 def get_date_range():
@@ -319,17 +94,207 @@ def get_date_range():
     
     
 
+def run_report_query(governor, sheet_name, sql_query, DATE_RANGE, budget=None, plan=None):
+    """
+    Runs one report query through the DB governor; a failed query returns an 'Error' table instead.
+    With a memory budget (SB_Memory_Budget.py) a big result can come back spilled to disk.
+    With a plan (SB_Query_Planner.py) the query runs the way its plan says (cache / sharded / stream / memory).
+    """
+    print(f"  > Running query: '{sheet_name}'...")
+    try:
+      #scanning the sql_query (the query itself in the dictionary) and replacing the placeholders with the values from the DATE_RANGE dictionary
+      #if it dosent find any, it just leaves the queryas is)
+        formatted_query = sql_query.format_map(DATE_RANGE)
+
+        #running the query, and using "Pandas" library to read the results, turn them into a table, and store them in a panda DF (dataframe) object we call "results_table_df"
+        #(through the governor: waits for a free query slot / a quiet server, and is cancelled if it runs too long)
+        with SB_Profiler.profile_stage(f"fetch: {sheet_name}"):
+            if plan is not None and sheet_name in plan['queries']:
+                results_table_df = SB_Query_Planner.run_planned_query(governor, plan, sheet_name, sql_query, DATE_RANGE)
+            else:
+                results_table_df = SB_Memory_Budget.read_sql_within_budget(governor, budget, sheet_name, formatted_query)
+        print(f"    > Success! '{sheet_name}' found {SB_Memory_Budget.result_rows(results_table_df)} records.")
+        return results_table_df
+
+    except Exception as e:
+        print(f"    > !!! FAILED !!! Query '{sheet_name}' execution failed: {e}")
+      
+        return pd.DataFrame({'Error': [str(e)]})
+
+
+def run_weekly_products_from_partials(governor, DATE_RANGE):
+    """'weekly products' rolled up from the product x day partials store; a failure returns an 'Error' table."""
+    # imported here: only --product-partials needs the store
+    import SB_Product_Day_Store
+    import SB_Shared_Facts
+
+    print("  > Building 'weekly products' from the product partials...")
+    try:
+        with SB_Profiler.profile_stage("fetch: weekly products (partials)"):
+            product_days = SB_Product_Day_Store.load_product_days(
+                governor, DATE_RANGE['START_DATE'], DATE_RANGE['END_DATE'])
+            results_table_df = SB_Shared_Facts.derive_weekly_products(product_days, DATE_RANGE)
+        print(f"    > Success! 'weekly products' found {len(results_table_df)} records.")
+        return results_table_df
+
+    except Exception as e:
+        print(f"    > !!! FAILED !!! 'weekly products' from the partials failed: {e}")
+        return pd.DataFrame({'Error': [str(e)]})
+
+
+def write_result_sheet(workbook, sheet_name, results_table_df, companion_folder=None, tab_color=None):
+    """Writes one query result into the workbook; returns the sheet names used ([] if writing failed)."""
+    try:
+        with SB_Profiler.profile_stage(f"write: {sheet_name}"):
+            #(a result spilled to disk is streamed back part by part)
+            written_sheets = SB_Excel_Writer.write_sheet(
+                workbook, sheet_name, SB_Memory_Budget.iter_result(results_table_df),
+                companion_folder=companion_folder, tab_color=tab_color,
+                rows=SB_Memory_Budget.result_rows(results_table_df))
+        if len(written_sheets) > 1:
+            print(f"  > '{sheet_name}' was too big for one sheet, split into {len(written_sheets)} sheets.")
+            if companion_folder:
+                print(f"    > Full result saved in folder: {companion_folder}")
+        return written_sheets
+
+    #a failed sheet is reported, but the rest of the workbook is still saved
+    except Exception as e:
+        print(f"  > !!! FAILED !!! writing sheet '{sheet_name}': {e}")
+        return []
+
+
+def parse_args():
+    """Reads the optional command line flags (the dates are still asked for interactively)."""
+    parser = argparse.ArgumentParser(description="Shookbook weekly report")
+    parser.add_argument('--append-master', metavar='MASTER_XLSX',
+                        help="also append this week's results to the stored weeks of a running (year-to-date) master "
+                             "workbook; the .xlsx itself is only written by --rebuild-master")
+    parser.add_argument('--rebuild-master', metavar='MASTER_XLSX',
+                        help="rebuild the master workbook from its stored weeks and exit (no DB access)")
+    parser.add_argument('--master-layout', choices=['rows', 'sheets'], default='rows',
+                        help="'rows' = all weeks stacked in one sheet per query, 'sheets' = a dated sheet per week")
+    parser.add_argument('--full-results-parquet', action='store_true',
+                        help="when a sheet is too big for Excel and gets split, also save the full result as Parquet")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="run the queries as concurrent asyncio tasks (needs an async DB driver, e.g. aiomysql)")
+    parser.add_argument('--profile', action='store_true',
+                        help="measure time/CPU/memory of every stage and save a <report>_profile.txt/.prof next to the report")
+    parser.add_argument('--queue', action='store_true',
+                        help="send the request to the report queue (SB_Report_Queue.py serve) instead of running it here")
+    parser.add_argument('--product-partials', action='store_true',
+                        help="build 'weekly products' from the product x day partials store (SB_Product_Day_Store.py) "
+                             "instead of its query; only days not stored yet are read from the DB")
+    parser.add_argument('--approximate', action='store_true',
+                        help="also add approximate customer reach / top products sheets for the window, "
+                             "merged from the daily sketches (SB_Sketches.py)")
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+                        help="keep the query results under MB megabytes of RAM, the rest is spilled to disk "
+                             "and streamed back when writing [SB_MEMORY_BUDGET_MB, no budget]")
+    parser.add_argument('--preview', nargs='?', type=int, const=0, metavar='N',
+                        help="quick preview on 1 in N days of the window (3 days spread over it when not given), "
+                             "with capped sheets and extrapolated totals - see SB_Preview.py")
+    parser.add_argument('--no-compare', dest='compare', action='store_false',
+                        help="don't add the '... vs last week' sheets (computed from the previous kept run, see SB_Week_Compare.py)")
+    parser.add_argument('--only', metavar='SHEETS',
+                        help="comma separated sheets to write; only the queries they need run (see SB_Report_Spec.py)")
+    parser.add_argument('--skip', metavar='SHEETS',
+                        help="comma separated sheets to leave out")
+    parser.add_argument('--no-plan', dest='plan', action='store_false',
+                        help="run every query in memory instead of the strategy the planner picks for it (see SB_Query_Planner.py)")
+    parser.add_argument('--excel-workers', type=int, metavar='N',
+                        help="serialize the sheets in N worker processes and build the .xlsx at the end "
+                             "(see SB_Parallel_Excel_Writer.py) [SB_EXCEL_WORKERS, 0 = in this process]")
+    args = parser.parse_args()
+
+    # the queue runs the full report with its own settings: a flag it wouldn't apply is an error, never silently dropped
+    if args.queue:
+        local_flags = [flag for flag, is_set in [
+            ('--append-master', args.append_master), ('--full-results-parquet', args.full_results_parquet),
+            ('--async', args.use_async), ('--profile', args.profile), ('--product-partials', args.product_partials),
+            ('--approximate', args.approximate), ('--memory-budget', args.memory_budget is not None),
+            ('--preview', args.preview is not None), ('--no-compare', not args.compare), ('--only', args.only),
+            ('--skip', args.skip), ('--no-plan', not args.plan), ('--excel-workers', args.excel_workers is not None),
+        ] if is_set]
+        if local_flags:
+            parser.error(f"--queue asks the report queue for the full report, it can't be combined with {', '.join(local_flags)}")
+    return args
+
+
 def main():
     print("--- Starting automated report script ---")
+    SB_Profiler.end_stage()
+    args = parse_args()
+
+    # rebuilding the master workbook only reads the stored weeks, no dates or DB needed
+    if args.rebuild_master:
+        SB_Master_Workbook.rebuild_master_workbook(args.rebuild_master, layout=args.master_layout)
+        return
+
+    # --only / --skip: the sheets to write and the queries they need (checked before the dates are asked)
+    try:
+        selected_queries, output_sheets = SB_Report_Spec.select_sheets(
+            REPORT_SPEC, SB_Report_Spec.parse_sheet_names(args.only), SB_Report_Spec.parse_sheet_names(args.skip))
+    except ValueError as e:
+        print(f" ERROR: {e}")
+        return
+
+    # the engine, the first connections and the modules the run needs later are prepared on a
+    # background thread while the dates are typed (see SB_Warmup.py)
+    # (--queue doesn't connect here, with --async the async engine is created by SB_Async_Runner)
+    warmup = None
+    if not args.queue and not args.use_async:
+        warmup_modules = []
+        if args.product_partials:
+            warmup_modules += ['SB_Daily_Partials', 'SB_Product_Day_Store']
+        if args.approximate:
+            warmup_modules.append('SB_Sketches')
+        warmup = SB_Warmup.start_warmup(DB_CONFIG, warmup_modules)
 
     # 1. Get dates from the user
-    start_date, end_date, cutoff_date = get_date_range()
+    with SB_Profiler.profile_stage('user input'):
+        start_date, end_date, cutoff_date = get_date_range()
     
     # Create a filename with the dates
-    output_filename = f"Shookbook_weekly_report_{start_date}_to_{end_date}.xlsx"
+    # (a report of some of the sheets gets their names too, so it never replaces the full report)
+    selection_suffix = SB_Report_Spec.get_selection_suffix(REPORT_SPEC, output_sheets)
+    output_filename = f"Shookbook_weekly_report_{start_date}_to_{end_date}{selection_suffix}.xlsx"
+
+    report_queries = {sheet_name: ALL_QUERIES[sheet_name] for sheet_name in selected_queries}
+    if selection_suffix:
+        print(f"Sheets: {', '.join(sheet_name for sheet_name in SB_Report_Spec.get_output_sheets(REPORT_SPEC) if sheet_name in output_sheets)} "
+              f"({len(report_queries)} of {len(ALL_QUERIES)} queries).")
+        # the master workbook holds full weeks only
+        if args.append_master:
+            print("Note: --append-master is skipped for a report of some of the sheets.")
+            args.append_master = None
+
+    # with --preview every query reads a sample of the window's days (see SB_Preview.py)
+    tab_color = None
+    if args.preview is not None:
+        window_days = SB_Preview.get_days(start_date, end_date)
+        sample_days = SB_Preview.get_sample_days(window_days, args.preview)
+        report_queries = SB_Preview.make_preview_queries(report_queries, sample_days, SB_Preview.get_dialect_name(DB_CONFIG))
+        tab_color = SB_Preview.PREVIEW_TAB_COLOR
+        output_filename = SB_Preview.get_preview_filename(output_filename)
+        print(f"PREVIEW: {len(sample_days)} of {len(window_days)} days ({', '.join(sample_days)}), "
+              f"at most {SB_Preview.PREVIEW_ROW_LIMIT} rows per sheet.")
+        # a preview is not the week's real numbers - it never goes to the master workbook or the partials store
+        args.append_master = None
+        args.product_partials = False
+        args.approximate = False
+        args.compare = False
+
+    # with --queue the report is produced by the report queue (SB_Report_Queue.py), which runs
+    # identical requests only once, and the file is sent back here
+    # (parse_args already refused the flags the queue doesn't apply)
+    if args.queue:
+        import SB_Report_Queue
+        SB_Report_Queue.print_reply(SB_Report_Queue.submit_request({
+            'report': 'weekly', 'start_date': start_date, 'end_date': end_date, 'cutoff_date': cutoff_date}))
+        return
     
     # 2. Create a connection to the database
-    missing_config = [key for key, value in DB_CONFIG.items() if not value]
+    missing_config = SB_DB_Governor.get_missing_config(DB_CONFIG)
     if missing_config:
         print(" ERROR: Not all connection details are defined in/loaded from .env file.")
         print(f"Missing connection info: {', '.join(missing_config)}")
@@ -337,21 +302,20 @@ def main():
         return
         
         #database connection details as a string (url + passward + port + database) 
-        #the createengine uses this string to create a connection to the database
-    connection_string = (
-        f"{DB_CONFIG['driver']}://"
-        f"{DB_CONFIG['username']}:{DB_CONFIG['password']}"
-        f"@{DB_CONFIG['host']}:{DB_CONFIG['port']}"
-        f"/{DB_CONFIG['database']}"
-    )
-    try:
-        engine = create_engine(connection_string)
-        print("Database connection successful!")
+        #the governor builds this string, creates the engine from it, and protects the DB while we run
+        #(read replica, max concurrent queries, statement timeouts, back-off when the server is busy - see SB_DB_Governor.py)
+    # (with --async the async engine is created by SB_Async_Runner when the queries start)
+    governor = None
+    if not args.use_async:
+        try:
+            with SB_Profiler.profile_stage('connect'):
+                governor = SB_Warmup.get_governor(warmup, DB_CONFIG)
+            print("Database connection successful!")
 
-        #if the connection isn't successful, we throw an error and can't run the queries
-    except Exception as e:
-        print(f"Database connection error: {e}")
-        return
+            #if the connection isn't successful, we throw an error and can't run the queries
+        except Exception as e:
+            print(f"Database connection error: {e}")
+            return
 
     # 3. Run the queries and collect the results
     print("Starting to run queries...")
@@ -366,51 +330,165 @@ def main():
         'CUSTOMER_CUTOFF_DATE': cutoff_date #DATE_RANGE['CUSTOMER_CUTOFF_DATE'] is the cutoff date
     }
 
-    #creating an empty dictionary object to store the results of the queries
+    # sheets that are too big for Excel get their full result here (only with --full-results-parquet)
+    companion_folder = None
+    if args.full_results_parquet:
+        companion_folder = f"{os.path.splitext(output_filename)[0]}_full_results"
+
+    # with a memory budget the results over it wait on disk instead of in RAM (normal mode only, see SB_Memory_Budget.py)
+    budget = None
+    if args.preview is None:
+        budget = SB_Memory_Budget.create_budget(args.memory_budget)
+    if budget is not None:
+        if args.use_async:
+            print("Note: the memory budget is used in the normal mode only.")
+            budget = None
+        else:
+            print(f"Memory budget: {budget['limit_bytes'] / 1024 / 1024:.1f} MB for the query results.")
+
+    # 4. exporting all results to one Excel file
+    # SB_Excel_Writer streams the rows to disk in chunks, and a result with more rows than
+    # an Excel sheet can hold continues on "<name> (2)", "<name> (3)"... instead of failing the whole export
+    workbook = SB_Excel_Writer.open_workbook(args.excel_workers)
+    written_sheets_by_query = {}
+    plan = None
+
+    if args.use_async:
+        #async mode: all queries are started as tasks, and each sheet is written as soon as its query finishes
+        #(imported here so the async drivers are only needed when --async is used)
+        import SB_Async_Runner
+        if args.product_partials:
+            print("Note: --product-partials is used in the normal mode only, 'weekly products' runs its query.")
+
+        formatted_queries = {
+            sheet_name: sql_query.format_map(SB_Report_Spec.get_sheet_variables(REPORT_SPEC, sheet_name, DATE_RANGE))
+            for sheet_name, sql_query in report_queries.items()
+        }
+
+        derived_by_source = {}
+
+        def write_finished_query(sheet_name, results_table_df):
+            #(a query that only ran for its derived sheets - e.g. "zones cube" - is not written, unless it failed)
+            if sheet_name in output_sheets or list(results_table_df.columns) == ['Error']:
+                written_sheets_by_query[sheet_name] = write_result_sheet(workbook, sheet_name, results_table_df, companion_folder, tab_color)
+            #the derived sheets (SB_Derived_Sheets.py) of this query are written as soon as it's ready too
+            derived_by_source[sheet_name] = SB_Report_Spec.keep_output_sheets(
+                SB_Derived_Sheets.derive_sheets_for(sheet_name, results_table_df), output_sheets)
+            for derived_sheet_name, derived_df in derived_by_source[sheet_name].items():
+                written_sheets_by_query[derived_sheet_name] = write_result_sheet(workbook, derived_sheet_name, derived_df, companion_folder, tab_color)
 
-    queries_results_to_export = {}
+        try:
+            query_results = SB_Async_Runner.run_report_queries_blocking(
+                DB_CONFIG, formatted_queries, on_result=write_finished_query)
+        except Exception as e:
+            print(f"Database connection error: {e}")
+            return
+
+        #every derived sheet goes right after the query it comes from
+        queries_results_to_export = {}
+        for sheet_name, results_table_df in query_results.items():
+            if sheet_name in written_sheets_by_query:
+                queries_results_to_export[sheet_name] = results_table_df
+            queries_results_to_export.update(derived_by_source.get(sheet_name, {}))
+
+    else:
+        #creating an empty dictionary object to store the results of the queries
+
+        queries_results_to_export = {}
 
 #iterating over the ALL_QUERIES dictionary object and running the queries
 #the .item() method returns a tuple of the key and value
 # it automatically iterates over the dictionary and assigns the key to the 1st parameter and value to the 2nd parameter (in  my case - sheet_name and sql_query respectively)
 # sheet_name will get the key from the dictionary (the query name)
 #sql_query will get the value from the dictionary (the query itself)
-    for sheet_name, sql_query in ALL_QUERIES.items():
-        print(f"  > Running query: '{sheet_name}'...")
+#up to DB_MAX_CONCURRENT_QUERIES queries run at the same time (1 by default = one after the other)
+        #every query gets a strategy from its estimated size and the past runs (SB_Query_Planner.py)
+        #(not in a preview - its sampled queries would teach the planner wrong sizes)
+        if args.plan and args.preview is None and SB_Query_Planner.is_enabled():
+            with SB_Profiler.profile_stage('plan queries'):
+                plan = SB_Query_Planner.plan_queries(governor, REPORT_SPEC, {
+                    sheet_name: sql_query for sheet_name, sql_query in report_queries.items()
+                    if not (args.product_partials and sheet_name == 'weekly products')
+                }, DATE_RANGE, budget)
+            SB_Query_Planner.print_plan(plan)
+
+        max_workers = governor['settings']['max_concurrent_queries']
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running_queries = {
+                sheet_name: executor.submit(run_report_query, governor, sheet_name, sql_query,
+                                            SB_Report_Spec.get_sheet_variables(REPORT_SPEC, sheet_name, DATE_RANGE), budget, plan)
+                for sheet_name, sql_query in report_queries.items()
+                if not (args.product_partials and sheet_name == 'weekly products')
+            }
+            #with --product-partials "weekly products" comes from the stored days (SB_Product_Day_Store.py)
+            if args.product_partials and 'weekly products' in report_queries:
+                running_queries['weekly products'] = executor.submit(
+                    run_weekly_products_from_partials, governor,
+                    SB_Report_Spec.get_sheet_variables(REPORT_SPEC, 'weekly products', DATE_RANGE))
+
+        #we fill our results dictionary object with the query name as the key, and the results table dataframe as the value
+        #(in the ALL_QUERIES order, no matter which query finished first)
+        for sheet_name in report_queries:
+            queries_results_to_export[sheet_name] = running_queries[sheet_name].result()
+
+        #extra sheets computed from the results (e.g. "coupons breakdown"), see SB_Derived_Sheets.py
+        #(with --only / --skip just the chosen ones are kept)
+        queries_results_to_export = SB_Report_Spec.keep_output_sheets(
+            SB_Derived_Sheets.add_derived_sheets(queries_results_to_export), output_sheets)
+
+        print(f"\nExporting all results to file: {output_filename} ...")
+        for sheet_name, results_table_df in queries_results_to_export.items():
+            written_sheets_by_query[sheet_name] = write_result_sheet(workbook, sheet_name, results_table_df, companion_folder, tab_color)
+
+    #the week's own sheets are what the master workbook keeps - the approximate, comparison and preview
+    #sheets added below describe this run only (see SB_Master_Workbook.py)
+    master_results = dict(queries_results_to_export)
+
+    #with --approximate: sheets merged from the daily sketches (SB_Sketches.py), with their error bounds
+    if args.approximate:
+        import SB_Sketches
+        print("\nAdding the approximate sheets (daily sketches)...")
         try:
-          #scanning the sql_query (the query itself in the dictionary) and replacing the placeholders with the values from the DATE_RANGE dictionary
-          #if it dosent find any, it just leaves the queryas is)
-            formatted_query = sql_query.format_map(DATE_RANGE)
-
-            #running the query, and using "Pandas" library to read the results, turn them into a table, and store them in a panda DF (dataframe) object we call "results_table_df"
-
-            results_table_df = pd.read_sql(formatted_query, con=engine)
-            
-
-
-         #we fill our results dictionary object with the query name as the key, and the results table dataframe as the value
-            queries_results_to_export[sheet_name] = results_table_df
-            print(f"    > Success! Found {len(results_table_df)} records.")
-
+            with SB_Profiler.profile_stage('approximate sheets'):
+                approximate_sheets = SB_Sketches.make_approximate_sheets(governor, start_date, end_date)
         except Exception as e:
-            print(f"    > !!! FAILED !!! Query '{sheet_name}' execution failed: {e}")
-          
-            queries_results_to_export[sheet_name] = pd.DataFrame({'Error': [str(e)]})
-
-   
-   
-
-    print(f"\nExporting all results to file: {output_filename} ...")
+            print(f"    > !!! FAILED !!! The approximate sheets could not be computed: {e}")
+            approximate_sheets = {'customer reach (approx)': pd.DataFrame({'Error': [str(e)]})}
+        for sheet_name, results_table_df in approximate_sheets.items():
+            written_sheets_by_query[sheet_name] = write_result_sheet(workbook, sheet_name, results_table_df, companion_folder)
+        queries_results_to_export.update(approximate_sheets)
+
+    #week over week: this week's products / zones / packing joined with the previous kept run (SB_Week_Compare.py)
+    if args.compare:
+        print("\nAdding the comparison with the previous week...")
+        try:
+            with SB_Profiler.profile_stage('week comparison'):
+                comparison_sheets = SB_Week_Compare.make_comparison_sheets(queries_results_to_export, start_date, end_date)
+        except Exception as e:
+            print(f"    > !!! FAILED !!! The comparison sheets could not be computed: {e}")
+            comparison_sheets = {}
+        for sheet_name, results_table_df in comparison_sheets.items():
+            written_sheets_by_query[sheet_name] = write_result_sheet(workbook, sheet_name, results_table_df, companion_folder)
+        queries_results_to_export.update(comparison_sheets)
+
+    #with --preview the "PREVIEW" sheet (sampled days + extrapolated totals) goes first in the file
+    if args.preview is not None:
+        preview_df = SB_Preview.make_preview_sheet(queries_results_to_export, sample_days, len(window_days))
+        written_sheets_by_query[SB_Preview.PREVIEW_SHEET_NAME] = write_result_sheet(
+            workbook, SB_Preview.PREVIEW_SHEET_NAME, preview_df, tab_color=tab_color)
+        queries_results_to_export = {SB_Preview.PREVIEW_SHEET_NAME: preview_df, **queries_results_to_export}
+
+    workbook_saved = False
     try:
-   
-    # 4.using pandas library to export all results to one Excel file 
-    # "writer" is just a pandas object that allows us to write to the Excel file
-        with pd.ExcelWriter(output_filename, engine='openpyxl') as writer:
-            for sheet_name, results_table_df in queries_results_to_export.items():
-                #writing the results table dataframe file into a new Excel file
-                #"sheet_name" will bethe name of the sheet in the Excel file (the query name)
-                #index=False means we don't want to write the index from the DF file column in the Excel file
-                results_table_df.to_excel(writer, sheet_name=sheet_name, index=False)
+        # sheets keep the ALL_QUERIES order even when they were written in the order the queries finished
+        with SB_Profiler.profile_stage('save workbook'):
+            SB_Excel_Writer.order_sheets(workbook, [
+                sheet_title
+                for sheet_name in queries_results_to_export
+                for sheet_title in written_sheets_by_query.get(sheet_name, [])
+            ])
+            SB_Excel_Writer.save_workbook(workbook, output_filename)
+        workbook_saved = True
         
         print("--- Script completed successfully! ---")
         print(f"Open the file '{output_filename}' to see the results.")
@@ -418,7 +496,35 @@ def main():
     except Exception as e:
         print(f"!!! CRITICAL ERROR while saving Excel file: {e}")
 
+    # the results are also kept as Arrow files, so the run can be exported again in another form (SB_Run_Store.py)
+    # (only when the workbook was saved - the planner's cache and the week comparison trust a kept run)
+    kept_run_folder = None
+    if args.preview is None and workbook_saved:
+        with SB_Profiler.profile_stage('keep run'):
+            kept_run_folder = SB_Run_Store.keep_run(output_filename, queries_results_to_export, 'weekly')
+
+    # 5. Append this week to the master workbook's stored weeks (only the new week is written)
+    if args.append_master:
+        print(f"\nAppending this week to master: {args.append_master} ...")
+        try:
+            with SB_Profiler.profile_stage('append master'):
+                appended_sheets = SB_Master_Workbook.append_week_to_master(
+                    args.append_master, master_results, start_date, end_date)
+            print(f"    > Appended {len(appended_sheets)} sheets to the stored weeks (the .xlsx is not changed).")
+            print(f"    > Run with --rebuild-master {args.append_master} to refresh the .xlsx.")
+        except Exception as e:
+            print(f"!!! ERROR while appending to master workbook: {e}")
+
+    # the spilled results are no longer needed once the workbook and the master are written
+    # (the planner's history gets this run's actual rows and seconds, and the kept run, see SB_Query_Planner.py)
+    SB_Memory_Budget.cleanup_budget(budget)
+    SB_Query_Planner.finish_plan(plan, kept_run_folder)
+
+    # 6. With --profile: the per-stage summary and the cProfile dump
+    if args.profile:
+        SB_Profiler.write_profile_report(os.path.splitext(output_filename)[0])
+
 
 # Running the main function
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()